@@ -0,0 +1,131 @@
+##
+# Social Web Comment Ranking
+#
+# Vectorized user activity statistics over raw post histories
+##
+
+import numpy as np
+
+# Every post counts towards the 'GLOBAL' pseudo-subreddit
+GLOBAL = 'GLOBAL'
+
+
+class HistoryBatch(object):
+    """Raw post histories (comments or submissions) for many users, as flat
+    columnar arrays: one element per post, with `user` indexing into
+    `users` and `subreddit` indexing into `subreddit_names`."""
+
+    def __init__(self, histories):
+        """histories: iterable of (user_name, history), where history is
+        the columnar dict produced by commentDB.unpack_history."""
+        self.users = []
+        user, subreddit, ups, downs = [], [], [], []
+        for i, (name, history) in enumerate(histories):
+            self.users.append(name)
+            user.append(np.full(len(history['ups']), i, dtype=np.int64))
+            subreddit.extend(history['subreddit'])
+            ups.extend(history['ups'])
+            downs.extend(history['downs'])
+
+        self.user = np.concatenate(user) if user else np.zeros(0, dtype=np.int64)
+        self.subreddit_names, self.subreddit = \
+            np.unique(np.array(subreddit, dtype=object).astype(str),
+                      return_inverse=True)
+        self.ups = np.array(ups, dtype=np.int64)
+        self.downs = np.array(downs, dtype=np.int64)
+
+    def _subreddit_codes(self, names):
+        """Code of each named subreddit in this batch, or -1 if absent."""
+        names = np.asarray(names, dtype=str)
+        if len(self.subreddit_names) == 0:
+            return np.full(len(names), -1, dtype=np.int64)
+        codes = np.searchsorted(self.subreddit_names, names)
+        codes = np.minimum(codes, len(self.subreddit_names) - 1)
+        return np.where(self.subreddit_names[codes] == names, codes, -1)
+
+
+class ActivityTable(object):
+    """Per-(user, subreddit) totals: count, pos_karma and neg_karma are
+    (users x subreddits) integer arrays."""
+
+    def __init__(self, users, subreddits, count, pos_karma, neg_karma):
+        self.users = users
+        self.subreddits = list(subreddits)
+        self.count = count
+        self.pos_karma = pos_karma
+        self.neg_karma = neg_karma
+        self._user_index = dict((u, i) for i, u in enumerate(users))
+
+    # Output: stats dict for one user and subreddit, in the form
+    # commentDB.UserActivity expects:
+    #  * 'count': count of all posts
+    #  * 'pos_karma': total positive karma
+    #  * 'avg_pos_karma': average positive karma per post
+    #  * 'neg_karma': total negative karma
+    #  * 'avg_neg_karma': average negative karma per post
+    #  * 'net_karma': total karma
+    #  * 'avg_net_karma': average karma per post
+    def stats(self, user_name, subreddit):
+        if user_name not in self._user_index:
+            return _summary(0, 0, 0)
+        i = self._user_index[user_name]
+        j = self.subreddits.index(subreddit)
+        return _summary(int(self.count[i, j]),
+                        int(self.pos_karma[i, j]),
+                        int(self.neg_karma[i, j]))
+
+
+def _summary(count, pos_karma, neg_karma):
+    stats = {'count': count,
+             'pos_karma': pos_karma,
+             'neg_karma': neg_karma,
+             'net_karma': pos_karma - neg_karma}
+    if count == 0:
+        stats['avg_pos_karma'] = None
+        stats['avg_neg_karma'] = None
+        stats['avg_net_karma'] = None
+    else:
+        stats['avg_pos_karma'] = float(stats['pos_karma']) / count
+        stats['avg_neg_karma'] = float(stats['neg_karma']) / count
+        stats['avg_net_karma'] = float(stats['net_karma']) / count
+    return stats
+
+
+# Input: HistoryBatch, subreddit display names (may include 'GLOBAL')
+# Output: ActivityTable over every user in the batch and each subreddit
+#
+# One group-by pass: each post is bucketed by (user, requested subreddit
+# or 'other'), and the GLOBAL column is the sum over all buckets.
+#
+# NOTE: the reddit API only returns a user's last 1000 comments and
+# submissions, so check 'count' before trusting these stats.
+def aggregate(batch, subreddits):
+    subreddits = list(subreddits)
+    n_users, n_slots = len(batch.users), len(subreddits) + 1
+    other = len(subreddits)
+
+    # Map subreddit codes to requested columns; everything else is 'other'
+    slot = np.full(len(batch.subreddit_names), other, dtype=np.int64)
+    codes = batch._subreddit_codes(subreddits)
+    for j, code in enumerate(codes):
+        if code >= 0 and subreddits[j] != GLOBAL:
+            slot[code] = j
+
+    key = batch.user * n_slots + slot[batch.subreddit]
+    ups, downs = batch.ups, batch.downs
+
+    size = n_users * n_slots
+    shape = (n_users, n_slots)
+    count = np.bincount(key, minlength=size).reshape(shape)
+    pos = np.bincount(key, weights=ups, minlength=size).reshape(shape)
+    neg = np.bincount(key, weights=downs, minlength=size).reshape(shape)
+    count, pos, neg = count.astype(np.int64), pos.astype(np.int64), neg.astype(np.int64)
+
+    if GLOBAL in subreddits:
+        j = subreddits.index(GLOBAL)
+        count[:, j] = count.sum(axis=1)
+        pos[:, j] = pos.sum(axis=1)
+        neg[:, j] = neg.sum(axis=1)
+
+    return ActivityTable(batch.users, subreddits,
+                         count[:, :other], pos[:, :other], neg[:, :other])
@@ -0,0 +1,328 @@
+##
+# Social Web Comment Ranking
+#
+# Raw API response cache, and offline replay of cached responses
+##
+
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+from sqlalchemy import (Column, DateTime, Float, Index, Integer, MetaData,
+                        String, Table, create_engine, text)
+from sqlalchemy.pool import StaticPool
+
+REDDIT_URL = 'https://www.reddit.com'
+SHORT_URL = 'http://redd.it/'
+
+# Responses carrying session cookies, modhashes or tokens; never cached
+AUTH_PATHS = ('/api/login', '/api/me', '/api/v1/me', '/api/v1/access_token')
+
+# Index of the things (comments, submissions, users, subreddits) found in
+# each cached response; a thing appears once per response it was seen in
+metadata = MetaData()
+responses = Table('responses', metadata,
+                  Column('hash', String, primary_key=True),
+                  Column('url', String),
+                  Column('size', Integer),
+                  Column('fetched', DateTime))
+things = Table('things', metadata,
+               Column('fullname', String, primary_key=True),
+               Column('hash', String, primary_key=True),
+               Column('position', Integer),     # order within the response
+               Column('kind', String),
+               Column('link_id', String),       # submission a comment belongs to
+               Column('subreddit', String),     # display name, lower case
+               Column('author', String),
+               Column('created', Float),
+               Column('fetched', DateTime),
+               Index('ix_things_kind_link', 'kind', 'link_id'),
+               Index('ix_things_kind_subreddit', 'kind', 'subreddit'),
+               Index('ix_things_kind_author', 'kind', 'author'))
+
+INDEXED_KINDS = ('t1', 't2', 't3', 't5')
+
+# PRAGMA user_version of an index.sqlite with lower-case subreddit names
+INDEX_VERSION = 1
+
+
+def is_auth_url(url):
+    path = urlparse(url).path.rstrip('/')
+    return any(path == p or path.startswith(p + '/') or path.startswith(p + '.')
+               for p in AUTH_PATHS)
+
+
+# A user's 'name' is their username, so build fullnames from kind and ID
+def fullname(kind, data):
+    if 'id' in data:
+        return '%s_%s' % (kind, data['id'])
+    return data['name']
+
+
+# Input: parsed JSON response
+# Output: generator of (kind, data) for every thing in it, in document order
+def iter_things(obj):
+    stack = [obj]
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, list):
+            stack.extend(reversed(obj))
+        elif isinstance(obj, dict):
+            data = obj.get('data')
+            if obj.get('kind') in INDEXED_KINDS and isinstance(data, dict) \
+                    and 'name' in data:
+                yield obj['kind'], data
+            stack.extend(reversed(list(obj.values())))
+
+
+class ResponseCache(object):
+    """Content-addressed store of raw JSON responses: each body is gzipped
+    to <cachedir>/<hash[:2]>/<hash>.json.gz, keyed by its SHA-1, and
+    indexed by the fullnames it contains in <cachedir>/index.sqlite.
+    Safe to share between worker threads."""
+
+    def __init__(self, cachedir, blob_cache_size=64):
+        self.cachedir = cachedir
+        if not os.path.isdir(cachedir):
+            os.makedirs(cachedir)
+        self.engine = create_engine('sqlite:///' + os.path.join(cachedir, 'index.sqlite'),
+                                    connect_args={'check_same_thread': False},
+                                    poolclass=StaticPool)
+        metadata.create_all(self.engine)
+        with self.engine.begin() as conn:
+            if conn.execute(text('PRAGMA user_version')).scalar() < INDEX_VERSION:
+                conn.execute(text('UPDATE things SET subreddit = lower(subreddit) '
+                                  'WHERE subreddit != lower(subreddit)'))
+                conn.execute(text('PRAGMA user_version = %d' % INDEX_VERSION))
+        self._lock = threading.Lock()
+        self._blobs = OrderedDict()     # hash -> {fullname: data}, LRU
+        self._blob_cache_size = blob_cache_size
+
+    def _path(self, digest):
+        return os.path.join(self.cachedir, digest[:2], digest + '.json.gz')
+
+    def store(self, url, body):
+        """Cache a raw response body (bytes). Login and other auth
+        responses are not cached; returns None for them.
+
+        A body already stored is not written again, but it is indexed
+        again with this fetch time, so the latest fetch of each thing
+        wins even when an older response comes back, and a body left
+        unindexed by a crash is indexed now."""
+        if is_auth_url(url):
+            return None
+        digest = hashlib.sha1(body).hexdigest()
+        path = self._path(digest)
+        parsed = json.loads(body.decode('utf-8'))
+        fetched = datetime.utcnow()
+
+        if not os.path.exists(path):
+            if not os.path.isdir(os.path.dirname(path)):
+                try:
+                    os.makedirs(os.path.dirname(path))
+                except OSError:
+                    pass    # created by another thread
+            tmp = '%s.%d.tmp' % (path, threading.current_thread().ident)
+            with gzip.open(tmp, 'wb') as f:
+                f.write(body)
+            os.rename(tmp, path)
+
+        rows = []
+        for position, (kind, data) in enumerate(iter_things(parsed)):
+            name = fullname(kind, data)
+            subreddit = data.get('display_name') if kind == 't5' else data.get('subreddit')
+            rows.append({'fullname': name, 'hash': digest,
+                         'position': position, 'kind': kind,
+                         'link_id': name if kind == 't3' else data.get('link_id'),
+                         'subreddit': subreddit.lower() if subreddit else subreddit,
+                         'author': data.get('name') if kind == 't2'
+                                   else data.get('author'),
+                         'created': data.get('created_utc'),
+                         'fetched': fetched})
+        with self._lock:
+            with self.engine.begin() as conn:
+                conn.execute(responses.insert().prefix_with('OR REPLACE'),
+                             hash=digest, url=url, size=len(body), fetched=fetched)
+                if rows:
+                    conn.execute(things.insert().prefix_with('OR REPLACE'), rows)
+        return digest
+
+    def _things_in(self, digest):
+        with self._lock:
+            if digest in self._blobs:
+                self._blobs[digest] = self._blobs.pop(digest)
+                return self._blobs[digest]
+        with gzip.open(self._path(digest), 'rb') as f:
+            parsed = json.loads(f.read().decode('utf-8'))
+        found = dict((fullname(kind, data), data) for kind, data in iter_things(parsed))
+        with self._lock:
+            self._blobs[digest] = found
+            while len(self._blobs) > self._blob_cache_size:
+                self._blobs.popitem(last=False)
+        return found
+
+    def latest(self, where, params):
+        """Latest cached data for each thing matching an SQL condition on
+        the things index, in order of first appearance."""
+        sql = text('SELECT fullname, hash FROM things WHERE %s '
+                   'ORDER BY fetched, position' % where)
+        with self._lock:
+            with self.engine.connect() as conn:
+                rows = conn.execute(sql, **params).fetchall()
+        latest = OrderedDict()
+        for name, digest in rows:
+            latest[name] = digest   # keeps the first position, latest hash
+        return [self._things_in(digest)[name] for name, digest in latest.items()]
+
+    def thing(self, name):
+        found = self.latest('fullname = :fullname', {'fullname': name})
+        return found[0] if found else None
+
+
+##########################################
+# PRAW-compatible objects built from the #
+# cache, for replay without network      #
+##########################################
+
+class _Named(object):
+    def __init__(self, name):
+        self.name = name
+        self.display_name = name
+
+    def __str__(self):
+        return self.name
+
+
+class _CachedThing(object):
+    kind = None
+
+    def __init__(self, data):
+        self.__dict__.update(data)
+        self.fullname = fullname(self.kind, data) if self.kind else data['name']
+        author = data.get('author')
+        self.author = None if author in (None, '[deleted]') else _Named(author)
+        if 'subreddit' in data:
+            self.subreddit = _Named(data['subreddit'])
+
+
+class CachedComment(_CachedThing):
+    kind = 't1'
+
+    def __init__(self, data, submission=None):
+        super(CachedComment, self).__init__(data)
+        self.replies = []
+        self.submission = submission
+        self.is_root = self.parent_id.startswith('t3_')
+        permalink = data.get('permalink')
+        if permalink:
+            self.permalink = REDDIT_URL + permalink if permalink.startswith('/') else permalink
+        elif submission is not None:
+            self.permalink = submission.permalink + self.id
+
+
+class CachedSubmission(_CachedThing):
+    kind = 't3'
+
+    def __init__(self, cache, data):
+        super(CachedSubmission, self).__init__(data)
+        self._cache = cache
+        self._comments = None
+        self.short_link = SHORT_URL + self.id
+        if self.permalink.startswith('/'):
+            self.permalink = REDDIT_URL + self.permalink
+
+    @property
+    def comments(self):
+        if self._comments is None:
+            self.replace_more_comments()
+        return self._comments
+
+    def replace_more_comments(self, limit=None, threshold=0):
+        """Rebuild the comment tree from every cached comment on this
+        submission, siblings in the order they were first fetched."""
+        comments = [CachedComment(d, self) for d in
+                    self._cache.latest("kind = 't1' AND link_id = :link",
+                                       {'link': self.fullname})]
+        by_id = dict((c.fullname, c) for c in comments)
+        self._comments = []
+        for c in comments:
+            parent = by_id.get(c.parent_id)
+            (parent.replies if parent is not None else self._comments).append(c)
+        return []
+
+
+class CachedRedditor(_CachedThing):
+    kind = 't2'
+
+    def __init__(self, cache, data):
+        super(CachedRedditor, self).__init__(data)
+        self._cache = cache
+
+    def _posts(self, kind, limit):
+        posts = self._cache.latest('kind = :kind AND author = :author',
+                                   {'kind': kind, 'author': self.name})
+        posts.sort(key=lambda d: d.get('created_utc', 0), reverse=True)
+        return [_CachedThing(d) for d in posts[:limit or 1000]]
+
+    def get_comments(self, limit=None):
+        return iter(self._posts('t1', limit))
+
+    def get_submitted(self, limit=None):
+        return iter(self._posts('t3', limit))
+
+
+class CachedSubreddit(object):
+    def __init__(self, cache, name, fullname):
+        self._cache = cache
+        self.display_name = name
+        self.fullname = fullname
+
+    def search(self, query, sort='top', limit=1000):
+        found = self._cache.latest("kind = 't3' AND subreddit = :subreddit",
+                                   {'subreddit': self.display_name.lower()})
+        if query.startswith('flair:'):
+            flair = query[len('flair:'):].strip("'\"")
+            found = [d for d in found if d.get('link_flair_text') == flair]
+        if sort == 'top':
+            found.sort(key=lambda d: d.get('score', 0), reverse=True)
+        return iter([CachedSubmission(self._cache, d) for d in found[:limit]])
+
+
+class CachedReddit(object):
+    """Stands in for praw.Reddit, answering from a ResponseCache only."""
+
+    def __init__(self, cache):
+        self.cache = cache
+
+    # Subreddit names are matched case-insensitively, as reddit does
+    def get_subreddit(self, name):
+        key = {'name': name.lower()}
+        found = self.cache.latest("kind = 't5' AND subreddit = :name", key)
+        if found:
+            return CachedSubreddit(self.cache, found[-1]['display_name'],
+                                   fullname('t5', found[-1]))
+        # Subreddit page not cached; take its ID from a cached submission
+        found = self.cache.latest("kind = 't3' AND subreddit = :name", key)
+        if not found:
+            raise KeyError('subreddit %s is not in the cache' % name)
+        return CachedSubreddit(self.cache, found[0]['subreddit'],
+                               found[0]['subreddit_id'])
+
+    # Output: False if the user's profile is not cached, as safe_praw_call
+    # reports a failed request
+    def get_redditor(self, name, fetch=False):
+        found = self.cache.latest("kind = 't2' AND author = :name", {'name': name})
+        if found:
+            return CachedRedditor(self.cache, found[-1])
+        if fetch:
+            return False
+        return CachedRedditor(self.cache, {'name': name})
@@ -0,0 +1,389 @@
+##
+# Social Web Comment Ranking
+#
+# Optional fetch backend: reddit's JSON endpoints over a pooled keep-alive
+# aiohttp client, with PRAW-compatible objects (needs aiohttp, Python 3)
+##
+
+import asyncio
+import json
+import threading
+from collections import deque
+
+from apicache import (REDDIT_URL, CachedComment, CachedSubmission, _CachedThing,
+                      fullname)
+from instrument import metrics
+from retry import FetchError, header_delay
+
+# Things per listing page, and the most reddit serves for one listing
+PAGE_SIZE = 100
+MAX_LISTING = 1000
+# Comment IDs per /api/morechildren request
+MORE_CHUNK = 100
+# Open connections kept to the API host
+POOL_SIZE = 32
+TIMEOUT = 30.0
+
+
+class AsyncClient(object):
+    """aiohttp session running on an event loop in a background thread.
+
+    get() can be called from any thread: it takes a token from the shared
+    TokenBucket on the calling thread, then waits while the request runs
+    on the loop. Worker threads' requests therefore overlap, over at most
+    `pool_size` reused keep-alive connections, instead of queueing behind
+    PRAW's per-domain lock. get_many() sends several requests at once for
+    a single caller. Every JSON response is saved to `cache` if given.
+    """
+
+    def __init__(self, user_agent, bucket=None, cache=None, base_url=REDDIT_URL,
+                 pool_size=POOL_SIZE, timeout=TIMEOUT):
+        try:
+            import aiohttp
+        except ImportError:
+            raise ImportError('The async fetch backend needs aiohttp '
+                              '(pip install aiohttp)')
+        self._aiohttp = aiohttp
+        self.user_agent = user_agent
+        self.bucket = bucket
+        self.cache = cache
+        self.base_url = base_url.rstrip('/')
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.requests = 0
+
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        name='async-fetch')
+        self._thread.daemon = True
+        self._thread.start()
+        self.session = self._run(self._open())
+
+    def _run(self, coro):
+        return asyncio.run_coroutine_threadsafe(coro, self.loop).result()
+
+    async def _open(self):
+        aiohttp = self._aiohttp
+        connector = aiohttp.TCPConnector(limit=self.pool_size,
+                                         limit_per_host=self.pool_size)
+        return aiohttp.ClientSession(connector=connector,
+                                     headers={'User-Agent': self.user_agent},
+                                     timeout=aiohttp.ClientTimeout(total=self.timeout))
+
+    async def _fetch(self, url, params):
+        try:
+            async with self.session.get(url, params=params) as response:
+                return (response.status, response.headers, str(response.url),
+                        await response.read())
+        except (self._aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise FetchError('%s fetching %s' % (type(e).__name__, url))
+
+    def _submit(self, path, params):
+        if self.bucket is not None:
+            self.bucket.acquire()
+        params = dict((k, v) for k, v in params.items() if v is not None)
+        return asyncio.run_coroutine_threadsafe(
+            self._fetch(self.base_url + path, params), self.loop)
+
+    def _parse(self, status, headers, url, body):
+        metrics.count('requests')
+        self.requests += 1
+        if status != 200:
+            raise FetchError('HTTP %d fetching %s' % (status, url), status, headers)
+        reset = header_delay(headers)
+        if reset and self.bucket is not None:
+            self.bucket.pause(reset)
+        try:
+            parsed = json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise FetchError('Invalid JSON from %s' % url, status, headers)
+        if self.cache is not None:
+            self.cache.store(url, body)
+        return parsed
+
+    # Output: parsed JSON response
+    def get(self, path, **params):
+        future = self._submit(path, params)
+        with metrics.stage('api'):
+            return self._parse(*future.result())
+
+    # Input: list of (path, params)
+    # Output: parsed responses, or the FetchError raised, in request order.
+    #         Each request is sent as soon as it has its token.
+    def get_many(self, requests):
+        futures = [self._submit(path, params) for path, params in requests]
+        results = []
+        with metrics.stage('api'):
+            for future in futures:
+                try:
+                    results.append(self._parse(*future.result()))
+                except FetchError as e:
+                    results.append(e)
+        return results
+
+    # Output: generator of (kind, data) over a paginated listing, fetching
+    # each page as the previous one runs out
+    def listing(self, path, limit=None, **params):
+        limit = MAX_LISTING if limit is None else limit
+        after = None
+        seen = 0
+        while seen < limit:
+            page = self.get(path, limit=min(PAGE_SIZE, limit - seen), after=after,
+                            **params)['data']
+            for child in page['children'][:limit - seen]:
+                seen += 1
+                yield child['kind'], child['data']
+            after = page.get('after')
+            if not after or not page['children']:
+                return
+
+    def close(self):
+        self._run(self.session.close())
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self.loop.close()
+
+
+class AsyncMoreComments(object):
+    """'More comments' stub, as praw.objects.MoreComments."""
+
+    def __init__(self, submission, data):
+        self.submission = submission
+        self.count = data.get('count', 0)
+        self.children = list(data.get('children', ()))
+        self.parent_id = data['parent_id']
+        self._comments = None
+
+    # Output: stubs of at most `size` children each, fetched separately
+    def split(self, size=MORE_CHUNK):
+        if not self.count or len(self.children) <= size:
+            return [self]
+        parts = []
+        for i in range(0, len(self.children), size):
+            part = AsyncMoreComments(self.submission, {'parent_id': self.parent_id,
+                                                       'count': self.count})
+            part.children = self.children[i:i + size]
+            parts.append(part)
+        return parts
+
+    def comments(self, update=True):
+        if self._comments is None:
+            self._comments = self.submission._fetch_more([self])[0]
+        return self._comments
+
+
+class AsyncSubmission(CachedSubmission):
+    """Submission built from listing JSON, with the same attributes as a
+    PRAW submission. Its comment tree is fetched on first access.
+
+    replace_more_comments() expands 'more comments' stubs like PRAW's,
+    but sends every known stub's requests at once rather than one at a
+    time; each round's replies may hold further stubs for the next round.
+    Comments fetched before their parent wait as orphans, as in PRAW. If
+    a request fails, the remaining stubs are kept, so calling it again
+    (e.g. through a retry) carries on from there.
+    """
+
+    resumes_expansion = True
+
+    def __init__(self, client, data):
+        super(AsyncSubmission, self).__init__(None, data)
+        self._client = client
+        self._comments_by_id = {}
+        self._orphaned = {}
+        self._more = deque()        # stubs still to expand
+        self._replaced_more = False
+
+    def _build(self, children):
+        forest = []
+        stack = [(children, forest)]
+        while stack:
+            items, out = stack.pop()
+            for child in items:
+                data = child['data']
+                if child['kind'] == 'more':
+                    out.append(AsyncMoreComments(self, data))
+                    continue
+                replies = data.pop('replies', None)
+                comment = CachedComment(data, self)
+                out.append(comment)
+                if replies:
+                    stack.append((replies['data']['children'], comment.replies))
+        return forest
+
+    def _register(self, comment):
+        stack = [comment]
+        while stack:
+            c = stack.pop()
+            if not isinstance(c, CachedComment):
+                continue
+            self._comments_by_id[c.fullname] = c
+            c.replies.extend(self._orphaned.pop(c.fullname, ()))
+            stack.extend(c.replies)
+
+    def _insert(self, comment):
+        if comment.fullname in self._comments_by_id:
+            return
+        self._register(comment)
+        parent = self._comments_by_id.get(comment.parent_id)
+        if comment.is_root:
+            self._comments.append(comment)
+        elif parent is not None:
+            parent.replies.append(comment)
+        else:
+            self._orphaned.setdefault(comment.parent_id, []).append(comment)
+
+    @property
+    def comments(self):
+        if self._comments is None:
+            listing = self._client.get('/comments/%s.json' % self.id)
+            self._comments = self._build(listing[1]['data']['children'])
+            self._comments_by_id = {}
+            for comment in self._comments:
+                self._register(comment)
+        return self._comments
+
+    def _request(self, stub):
+        if not stub.count:      # 'continue this thread': fetch the parent's subtree
+            return ('/comments/%s/_/%s.json' % (self.id, stub.parent_id.split('_', 1)[1]),
+                    {})
+        return ('/api/morechildren.json',
+                {'api_type': 'json', 'link_id': self.fullname,
+                 'children': ','.join(stub.children)})
+
+    def _things(self, stub, response):
+        if not stub.count:
+            parents = response[1]['data']['children']
+            return self._build(parents[0]['data']['replies']['data']['children']) \
+                if parents and parents[0]['data'].get('replies') else []
+        return self._build(response['json']['data']['things'])
+
+    # Output: for each stub, its fetched comments and stubs, or FetchError
+    def _fetch_parts(self, stubs):
+        responses = self._client.get_many([self._request(s) for s in stubs])
+        return [r if isinstance(r, FetchError) else self._things(s, r)
+                for s, r in zip(stubs, responses)]
+
+    def _fetch_more(self, stubs):
+        results = self._fetch_parts(stubs)
+        for result in results:
+            if isinstance(result, FetchError):
+                raise result
+        return results
+
+    # Take the stubs out of the tree, into the queue to expand
+    def _extract_more(self, comments):
+        stack = [comments]
+        while stack:
+            items = stack.pop()
+            stubs = [c for c in items if isinstance(c, AsyncMoreComments)]
+            if stubs:
+                items[:] = [c for c in items if not isinstance(c, AsyncMoreComments)]
+                self._more.extend(stubs)
+            stack.extend(c.replies for c in items)
+
+    # Output: stubs not expanded (over `limit` requests, or under
+    # `threshold` children)
+    def replace_more_comments(self, limit=32, threshold=1):
+        if self._replaced_more:
+            return []
+        self._extract_more(self.comments)
+        remaining = limit
+        skipped = []
+        while self._more:
+            wave = []
+            while self._more:
+                stub = self._more.popleft()
+                if not stub.children or 0 < stub.count < threshold:
+                    skipped.append(stub)
+                    continue
+                for part in stub.split():
+                    if remaining == 0:
+                        skipped.append(part)
+                        continue
+                    wave.append(part)
+                    if remaining is not None:
+                        remaining -= 1
+
+            error = None
+            for part, result in zip(wave, self._fetch_parts(wave)):
+                if isinstance(result, FetchError):
+                    self._more.append(part)
+                    error = error or result
+                    continue
+                for thing in result:
+                    if isinstance(thing, AsyncMoreComments):
+                        self._more.append(thing)
+                    else:
+                        self._insert(thing)
+                        self._extract_more([thing])     # continued threads nest stubs
+            if error is not None:
+                raise error
+
+        self._replaced_more = True
+        return skipped
+
+
+class AsyncRedditor(_CachedThing):
+    kind = 't2'
+
+    def __init__(self, client, data):
+        super(AsyncRedditor, self).__init__(data)
+        self._client = client
+
+    def _posts(self, part, limit):
+        for _, data in self._client.listing('/user/%s/%s.json' % (self.name, part),
+                                            limit):
+            yield _CachedThing(data)
+
+    def get_comments(self, limit=None):
+        return self._posts('comments', limit)
+
+    def get_submitted(self, limit=None):
+        return self._posts('submitted', limit)
+
+
+class AsyncSubreddit(object):
+    def __init__(self, client, data):
+        self._client = client
+        self.display_name = data['display_name']
+        self.fullname = fullname('t5', data)
+
+    def __str__(self):
+        return self.display_name
+
+    def search(self, query, sort='top', limit=1000):
+        for _, data in self._client.listing('/r/%s/search.json' % self.display_name,
+                                            limit, q=query, sort=sort,
+                                            restrict_sr='on'):
+            yield AsyncSubmission(self._client, data)
+
+
+class AsyncReddit(object):
+    """Stands in for praw.Reddit, with the calls the scraper makes, over an
+    AsyncClient. Requests are anonymous."""
+
+    def __init__(self, client):
+        self.client = client
+
+    def get_subreddit(self, name):
+        return AsyncSubreddit(self.client,
+                              self.client.get('/r/%s/about.json' % name)['data'])
+
+    def get_redditor(self, name, fetch=False):
+        if not fetch:
+            return AsyncRedditor(self.client, {'name': name})
+        return AsyncRedditor(self.client,
+                             self.client.get('/user/%s/about.json' % name)['data'])
+
+    def get_submission(self, submission_id):
+        listing = self.client.get('/comments/%s.json' % submission_id)
+        submission = AsyncSubmission(self.client,
+                                     listing[0]['data']['children'][0]['data'])
+        submission._comments = submission._build(listing[1]['data']['children'])
+        for comment in submission._comments:
+            submission._register(comment)
+        return submission
+
+    def close(self):
+        self.client.close()
@@ -0,0 +1,1895 @@
+#!/usr/bin/env python
+##
+# Social Web Comment Ranking
+#
+# Crawl and database benchmarks, run against local fakes
+##
+
+import bisect
+import json
+import multiprocessing
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+from argparse import ArgumentParser
+from datetime import datetime
+from time import time, sleep
+
+from crawler import TokenBucket, bounded_map
+from instrument import metrics
+from retry import CircuitBreaker, Retrier
+
+try:
+    from http.client import HTTPConnection, HTTPException
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.error import HTTPError
+    from urllib.parse import parse_qs, urlencode, urlparse
+    from urllib.request import urlopen
+except ImportError:     # Python 2
+    from httplib import HTTPConnection, HTTPException
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib2 import HTTPError, urlopen
+    from urllib import urlencode
+    from urlparse import parse_qs, urlparse
+
+
+#############################
+# Fake Reddit API endpoints #
+#############################
+
+class FakeRedditServer(ThreadingMixIn, HTTPServer):
+    """Local HTTP server that answers every GET with an empty listing after
+    an injected delay, and records when each request arrived.
+
+    Faults can be injected: `faults` is a list of (probability, fault),
+    where fault is an HTTP status or 'drop' to close the connection
+    without answering; 429s carry a Retry-After of `retry_after` seconds.
+    During `outage` (start, duration), seconds after start(), every
+    request gets a 503, and so does the n-th request for each n in
+    `fail_at` (counting from 1).
+
+    Given a SyntheticThread, /thread returns its first page and
+    /morechildren?children=id,... the listed comments, flat; reddit's
+    own /comments/<id>.json and /api/morechildren.json return the same
+    in reddit's JSON format, for every submission ID. Given a
+    SyntheticReddit, it answers the endpoints a crawl uses instead, and
+    404s anything else. Connections are kept alive."""
+    daemon_threads = True
+
+    def __init__(self, latency=0.2, faults=(), retry_after=1, outage=None, seed=0,
+                 thread=None, reddit=None, fail_at=()):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), _FakeRedditHandler)
+        self.latency = latency
+        self.thread = thread
+        self.reddit = reddit
+        self.faults = list(faults)
+        self.retry_after = retry_after
+        self.outage = outage
+        self.fail_at = set(fail_at)
+        self.request_times = []
+        self._rng = random.Random(seed)
+        self._started = None
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self.serve_forever)
+        self._thread.daemon = True
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self.server_address[1]
+
+    def start(self):
+        self._started = time()
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    # Output: number of the request, counting from 1
+    def record(self):
+        with self._lock:
+            self.request_times.append(time())
+            return len(self.request_times)
+
+    # Output: fault to inject into the n-th response, or None
+    def fault(self, n=None):
+        if n in self.fail_at:
+            return 503
+        if self.outage is not None:
+            start, duration = self.outage
+            if 0 <= time() - self._started - start < duration:
+                return 503
+        with self._lock:
+            draw = self._rng.random()
+        for probability, fault in self.faults:
+            if draw < probability:
+                return fault
+            draw -= probability
+        return None
+
+
+class _FakeRedditHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    body = json.dumps({'kind': 'Listing',
+                       'data': {'children': [], 'after': None}}).encode('utf-8')
+
+    def do_GET(self):
+        n = self.server.record()
+        sleep(self.server.latency)
+        fault = self.server.fault(n)
+        if fault == 'drop':
+            self.close_connection = True
+            return
+        if fault is not None:
+            self.send_response(fault)
+            if fault == 429:
+                self.send_header('Retry-After', str(self.server.retry_after))
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = self.body
+        url = urlparse(self.path)
+        if self.server.reddit is not None:
+            response = self.server.reddit.respond(url.path, parse_qs(url.query))
+            if response is None:
+                self.send_response(404)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            body = json.dumps(response).encode('utf-8')
+        elif self.server.thread is not None and url.path == '/thread':
+            body = json.dumps(self.server.thread.first_page()).encode('utf-8')
+        elif self.server.thread is not None and url.path == '/morechildren':
+            ids = parse_qs(url.query)['children'][0].split(',')
+            body = json.dumps(self.server.thread.children(ids)).encode('utf-8')
+        elif self.server.thread is not None and url.path.startswith('/comments/'):
+            body = json.dumps(self.server.thread.listing()).encode('utf-8')
+        elif self.server.thread is not None and url.path == '/api/morechildren.json':
+            ids = parse_qs(url.query)['children'][0].split(',')
+            body = json.dumps(self.server.thread.more_children(ids)).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class FakeSubmission(object):
+    """Stands in for a PRAW submission: expanding its comment forest costs
+    `requests` HTTP round trips, each drawn from the shared bucket the way
+    pipeline.TokenBucketHandler does."""
+
+    def __init__(self, index, url, requests, bucket):
+        self.fullname = 't3_fake%d' % index
+        self.url = '%s/comments/%d.json' % (url, index)
+        self.requests = requests
+        self.bucket = bucket
+
+    def replace_more_comments(self, limit=None, threshold=0):
+        for i in range(self.requests):
+            self.bucket.acquire()
+            urlopen('%s?page=%d' % (self.url, i)).read()
+        return []
+
+
+class SyntheticThread(object):
+    """A large comment thread with a heavy-tailed shape: each comment is
+    top-level with probability `top_level`, else a reply to an earlier
+    comment picked in proportion to 1 + its reply count, so a few
+    subthreads get most of the replies. With `spine`, the first `spine`
+    comments are instead a single reply chain, for very deep threads.
+    Comment IDs are in posting order, parents first. The first page holds
+    the first `page_size` comments, nested, and one 'more comments' stub
+    listing the rest."""
+
+    def __init__(self, n_comments, page_size=200, top_level=0.1, body_size=300, seed=0,
+                 spine=0):
+        rng = random.Random(seed)
+        self.fullname = 't3_big'
+        self.page_size = page_size
+        self.body = 'x' * body_size
+        self.parent = []
+        weighted = []       # comment i appears 1 + (replies to i) times
+        for i in range(n_comments):
+            if i < spine:
+                self.parent.append(i - 1)
+            elif not weighted or rng.random() < top_level:
+                self.parent.append(-1)
+            else:
+                p = rng.choice(weighted)
+                self.parent.append(p)
+                weighted.append(p)
+            weighted.append(i)
+
+    def comment_id(self, i):
+        return 'c%d' % i
+
+    def comment_index(self, comment_id):
+        return int(comment_id[1:])
+
+    def data(self, i):
+        p = self.parent[i]
+        return {'id': self.comment_id(i), 'name': 't1_' + self.comment_id(i),
+                'link_id': self.fullname,
+                'parent_id': self.fullname if p < 0 else 't1_' + self.comment_id(p),
+                'body': self.body, 'author': 'user%d' % (i % 997),
+                'subreddit': 'fake', 'subreddit_id': 't5_fake',
+                'score': i % 50, 'ups': i % 50, 'downs': 0,
+                'created_utc': 1400000000 + i, 'num_reports': None,
+                'distinguished': None, 'gilded': 0}
+
+    def first_page(self):
+        n = min(self.page_size, len(self.parent))
+        nodes = [self.data(i) for i in range(n)]
+        roots = []
+        for i, node in enumerate(nodes):
+            node['reply_data'] = []
+            p = self.parent[i]
+            (nodes[p]['reply_data'] if p >= 0 else roots).append(node)
+        more = [self.comment_id(i) for i in range(n, len(self.parent))]
+        return {'comments': roots, 'more': {'children': more, 'count': len(more)}}
+
+    def children(self, ids):
+        return [self.data(self.comment_index(c)) for c in ids]
+
+    # Output: the first page as reddit's /comments/<id>.json returns it
+    def listing(self):
+        def thing(node):
+            replies = [thing(r) for r in node.pop('reply_data')]
+            node['replies'] = {'kind': 'Listing', 'data': {'children': replies}} \
+                if replies else ''
+            return {'kind': 't1', 'data': node}
+        page = self.first_page()
+        children = [thing(node) for node in page['comments']]
+        if page['more']['children']:
+            children.append({'kind': 'more',
+                             'data': dict(page['more'], parent_id=self.fullname,
+                                          id='more', name='t1_more')})
+        return [{'kind': 'Listing',
+                 'data': {'children': [{'kind': 't3', 'data': self.submission_data()}]}},
+                {'kind': 'Listing', 'data': {'children': children}}]
+
+    def submission_data(self):
+        return {'id': 'big', 'name': self.fullname, 'title': 'Big thread',
+                'author': 'op', 'subreddit': 'fake', 'subreddit_id': 't5_fake',
+                'permalink': '/r/fake/comments/big/big_thread/',
+                'score': 1, 'created_utc': 1400000000,
+                'num_comments': len(self.parent)}
+
+    # Output: the comments as reddit's /api/morechildren.json returns them
+    def more_children(self, ids):
+        things = [{'kind': 't1', 'data': dict(self.data(self.comment_index(c)),
+                                              replies='')}
+                  for c in ids]
+        return {'json': {'errors': [], 'data': {'things': things}}}
+
+
+# Output: decoded JSON response; HTTP errors raise retry.FetchError, which
+# pipeline retries as it does a PRAW HTTPException
+def _get_json(url):
+    from retry import FetchError
+    try:
+        body = urlopen(url).read()
+    except HTTPError as e:
+        raise FetchError('HTTP %d fetching %s' % (e.code, url), e.code, dict(e.headers))
+    return json.loads(body.decode('utf-8'))
+
+
+class FakeMoreComments(object):
+    """Stands in for praw.objects.MoreComments, fetching from /morechildren."""
+
+    def __init__(self, url, children, count):
+        self.url = url
+        self.children = children
+        self.count = count
+        self.submission = None
+        self._comments = None
+
+    def comments(self, update=True):
+        from apicache import CachedComment
+        if self._comments is None:
+            data = _get_json('%s/morechildren?children=%s' %
+                             (self.url, ','.join(self.children)))
+            self._comments = [CachedComment(d, self.submission) for d in data]
+        return self._comments
+
+
+class FakeThreadSubmission(object):
+    """Stands in for a PRAW submission of a SyntheticThread: `comments` is
+    the first page, and replace_more_comments expands every stub into
+    the in-memory forest, 100 children per request, as PRAW does. Like
+    PRAW's, it takes the stubs out of the tree before fetching them."""
+
+    def __init__(self, url, num_comments):
+        self.url = url
+        self.fullname = 't3_big'
+        self.id = 'big'
+        self.permalink = url + '/thread/'
+        self.num_comments = num_comments
+        self._comments = None
+
+    @property
+    def comments(self):
+        if self._comments is None:
+            from apicache import CachedComment
+            page = _get_json(self.url + '/thread')
+
+            def build(d):
+                c = CachedComment(d, self)
+                c.replies = [build(r) for r in d['reply_data']]
+                return c
+            self._comments = [build(d) for d in page['comments']]
+            more = page['more']
+            if more['children']:
+                self._comments.append(FakeMoreComments(self.url, more['children'],
+                                                       more['count']))
+        return self._comments
+
+    def replace_more_comments(self, limit=None, threshold=0):
+        comments = self.comments
+        stubs = [c for c in comments if isinstance(c, FakeMoreComments)]
+        by_id = {}
+        stack = [c for c in comments if not isinstance(c, FakeMoreComments)]
+        while stack:
+            c = stack.pop()
+            by_id[c.fullname] = c
+            stack.extend(c.replies)
+        self._comments = [c for c in comments if not isinstance(c, FakeMoreComments)]
+        for stub in stubs:
+            for i in range(0, len(stub.children), 100):
+                part = FakeMoreComments(stub.url, stub.children[i:i + 100], 100)
+                part.submission = self
+                for c in part.comments():
+                    by_id[c.fullname] = c
+                    parent = by_id.get(c.parent_id)
+                    (parent.replies if parent is not None else self._comments).append(c)
+        return []
+
+
+class _SyntheticPost(SyntheticThread):
+    """A self-post of a SyntheticReddit and its comment thread."""
+
+    def __init__(self, reddit, link):
+        post = reddit.posts[link]
+        SyntheticThread.__init__(self, post['comments'], page_size=reddit.page_size,
+                                 body_size=reddit.body_size, seed=post['seed'])
+        rng = random.Random(post['seed'])
+        self.reddit = reddit
+        self.link = link
+        self.fullname = 't3_' + link
+        self.subreddit = post['subreddit']
+        self.created = post['created']
+        self.authors = [reddit.user(rng) for _ in range(post['comments'])]
+
+    def comment_id(self, i):
+        return '%sc%d' % (self.link, i)
+
+    def comment_index(self, comment_id):
+        return int(comment_id[len(self.link) + 1:])
+
+    def data(self, i):
+        data = SyntheticThread.data(self, i)
+        data.update(author=self.authors[i], subreddit=self.subreddit,
+                    subreddit_id='t5_' + self.subreddit,
+                    created_utc=self.created + 60 * i)
+        return data
+
+    def submission_data(self):
+        return self.reddit.submission_data(self.link)
+
+
+class SyntheticReddit(object):
+    """Subreddits, users and comment threads generated from `seed`, which
+    FakeRedditServer(reddit=...) serves as reddit's JSON endpoints do.
+
+    Each of `subreddits` subreddits has `submissions` self-posts. Thread
+    sizes are Pareto-distributed with mean `comments` (capped at 50 times
+    it), each shaped as a SyntheticThread, so fan-out and depth are
+    heavy-tailed too. Authors are drawn from `users` users with Zipf
+    activity, and each user's comment and submission listings hold up
+    to `history` posts spread over the subreddits. Threads are built on
+    first request."""
+
+    def __init__(self, subreddits=3, submissions=50, comments=200, users=500,
+                 history=200, page_size=200, body_size=300, seed=0):
+        rng = random.Random(seed)
+        self.seed = seed
+        self.page_size = page_size
+        self.body_size = body_size
+        self.history = history
+        self.names = ['synth%d' % i for i in range(subreddits)]
+        self.users = ['user%d' % i for i in range(users)]
+        self._weights = []      # cumulative Zipf weights of the users
+        total = 0.0
+        for k in range(users):
+            total += 1.0 / (k + 1)
+            self._weights.append(total)
+
+        self.posts = {}
+        self._listings = dict((name, []) for name in self.names)
+        alpha = 1.5
+        for name in self.names:
+            for _ in range(submissions):
+                link = 's%dx%d' % (len(self.posts), rng.randint(0, 999))
+                n = int(comments * (alpha - 1) / alpha * rng.paretovariate(alpha))
+                self.posts[link] = {'subreddit': name,
+                                    'comments': max(1, min(n, 50 * comments)),
+                                    'seed': rng.randint(0, 2 ** 31),
+                                    'score': int(rng.paretovariate(1.2)),
+                                    'author': self.user(rng),
+                                    'created': 1400000000 + rng.randint(0, 10 ** 7)}
+                self._listings[name].append(link)
+            # Search results come best first
+            self._listings[name].sort(key=lambda link: -self.posts[link]['score'])
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def user(self, rng):
+        return self.users[bisect.bisect(self._weights, rng.random() * self._weights[-1])]
+
+    # Output: total comments over every thread
+    @property
+    def num_comments(self):
+        return sum(post['comments'] for post in self.posts.values())
+
+    def thread(self, link):
+        with self._lock:
+            if link not in self._threads:
+                self._threads[link] = _SyntheticPost(self, link)
+            return self._threads[link]
+
+    def submission_data(self, link):
+        post = self.posts[link]
+        name = post['subreddit']
+        return {'id': link, 'name': 't3_' + link, 'title': 'Post %s' % link,
+                'selftext': 'x' * self.body_size, 'author': post['author'],
+                'subreddit': name, 'subreddit_id': 't5_' + name,
+                'permalink': '/r/%s/comments/%s/post/' % (name, link),
+                'score': post['score'], 'ups': post['score'], 'downs': 0,
+                'created_utc': post['created'], 'num_comments': post['comments'],
+                'is_self': True, 'edited': False, 'stickied': False,
+                'distinguished': None, 'gilded': 0, 'domain': 'self.' + name,
+                'link_flair_text': None}
+
+    # Output: reddit's listing of `things`, the page after `params['after']`
+    def _page(self, things, params):
+        limit = int(params.get('limit', ['25'])[0])
+        start = 0
+        if 'after' in params:
+            names = [t['data']['name'] for t in things]
+            start = names.index(params['after'][0]) + 1
+        page = things[start:start + limit]
+        after = page[-1]['data']['name'] if start + limit < len(things) else None
+        return {'kind': 'Listing', 'data': {'children': page, 'after': after}}
+
+    def _history(self, username, kind):
+        rng = random.Random('%s-%s-%s' % (self.seed, username, kind))
+        things = []
+        for i in range(rng.randint(0, self.history)):
+            score = int(rng.paretovariate(1.5)) - 1
+            things.append({'kind': kind, 'data': {
+                'id': '%s%s%d' % (username, kind, i),
+                'name': '%s_%s%s%d' % (kind, username, kind, i),
+                'author': username, 'subreddit': rng.choice(self.names),
+                'ups': score, 'downs': rng.randint(0, 2),
+                'created_utc': 1400000000 - 3600 * i}})
+        return things
+
+    # Input: URL path and parsed query string
+    # Output: JSON response, or None for a 404
+    def respond(self, path, params):
+        parts = path.strip('/').split('/')
+        if parts[0] == 'r' and len(parts) == 3 and parts[1] in self._listings:
+            name = parts[1]
+            if parts[2] == 'about.json':
+                return {'kind': 't5', 'data': {'display_name': name, 'id': name,
+                                               'name': 't5_' + name}}
+            if parts[2] == 'search.json':
+                return self._page([{'kind': 't3', 'data': self.submission_data(link)}
+                                   for link in self._listings[name]], params)
+        elif parts[0] == 'comments' and parts[1].split('.')[0] in self.posts:
+            return self.thread(parts[1].split('.')[0]).listing()
+        elif path == '/api/morechildren.json':
+            thread = self.thread(params['link_id'][0][3:])
+            return thread.more_children(params['children'][0].split(','))
+        elif parts[0] == 'user' and len(parts) == 3:
+            username = parts[1]
+            if parts[2] == 'about.json':
+                rng = random.Random('%s-%s' % (self.seed, username))
+                return {'kind': 't2', 'data': {
+                    'name': username, 'id': 'u' + username,
+                    'created_utc': 1300000000 + rng.randint(0, 10 ** 8),
+                    'comment_karma': rng.randint(0, 10 ** 5),
+                    'link_karma': rng.randint(0, 10 ** 4),
+                    'is_mod': False, 'is_gold': rng.random() < 0.05,
+                    'has_verified_email': True}}
+            if parts[2] in ('comments.json', 'submitted.json'):
+                kind = 't1' if parts[2] == 'comments.json' else 't3'
+                return self._page(self._history(username, kind), params)
+        return None
+
+
+class BlockingClient(object):
+    """asyncfetch.AsyncClient's get(), get_many() and listing(), made the way PRAW
+    makes requests: each thread keeps its own keep-alive connection, as
+    a requests.Session does, and sends one request at a time, so the
+    'more comments' requests of a thread go out one after another."""
+
+    def __init__(self, url):
+        self.host, self.port = urlparse(url).netloc.split(':')
+        self.requests = 0
+        self._local = threading.local()
+
+    def get(self, path, **params):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = HTTPConnection(self.host, int(self.port))
+        params = dict((k, v) for k, v in params.items() if v is not None)
+        with metrics.stage('api'):
+            conn.request('GET', '%s?%s' % (path, urlencode(params)) if params else path)
+            response = conn.getresponse()
+            body = response.read()
+        metrics.count('requests')
+        self.requests += 1
+        if response.status != 200:
+            from retry import FetchError
+            raise FetchError('HTTP %d fetching %s' % (response.status, path),
+                             response.status, response.getheaders())
+        return json.loads(body.decode('utf-8'))
+
+    def get_many(self, requests):
+        return [self.get(path, **params) for path, params in requests]
+
+    def listing(self, path, limit=None, **params):
+        from asyncfetch import AsyncClient
+        return AsyncClient.listing(self, path, limit, **params)
+
+    def close(self):
+        pass
+
+
+# Output: most requests seen in any sliding window of `window` seconds
+def max_in_window(times, window):
+    times = sorted(times)
+    best, start = 0, 0
+    for end in range(len(times)):
+        while times[end] - times[start] > window:
+            start += 1
+        best = max(best, end - start + 1)
+    return best
+
+
+##############
+# Benchmarks #
+##############
+
+def bench_concurrency(args):
+    results = []
+    for workers in args.workers:
+        server = FakeRedditServer(latency=args.latency).start()
+        bucket = TokenBucket(args.rate, args.burst)
+        submissions = [FakeSubmission(i, server.url, args.requests_per_tree, bucket)
+                       for i in range(args.submissions)]
+
+        start = time()
+        for _ in bounded_map(lambda s: s.replace_more_comments(), submissions, workers):
+            pass
+        elapsed = time() - start
+        server.stop()
+
+        # The bucket guarantees at most burst + rate * T requests per window
+        window = 1.0
+        observed = max_in_window(server.request_times, window)
+        allowed = args.burst + args.rate * window
+        results.append({'workers': workers,
+                        'seconds': elapsed,
+                        'requests': len(server.request_times),
+                        'requests_per_sec': len(server.request_times) / elapsed,
+                        'max_per_window': observed,
+                        'allowed_per_window': allowed,
+                        'within_quota': observed <= allowed,
+                        'bucket_wait': bucket.wait_time})
+
+    serial = results[0]['seconds']
+    for res in results:
+        res['speedup'] = serial / res['seconds']
+        print('workers=%-3d %7.2fs  %6.1f req/s  speedup %5.2fx  '
+              'max %d req/%.0fs (allowed %.1f) %s' %
+              (res['workers'], res['seconds'], res['requests_per_sec'],
+               res['speedup'], res['max_per_window'], window,
+               res['allowed_per_window'],
+               'OK' if res['within_quota'] else 'QUOTA EXCEEDED'))
+    return results
+
+
+# Runs with AsyncReddit over `client`, so both backends parse the same way
+def _fetch_threads(client, submissions, workers):
+    from asyncfetch import AsyncReddit
+    r = AsyncReddit(client)
+
+    def fetch(i):
+        submission = r.get_submission(submission_id='big%d' % i)
+        submission.replace_more_comments(limit=None, threshold=0)
+        n, stack = 0, list(submission.comments)
+        while stack:
+            n += 1
+            stack.extend(stack.pop().replies)
+        return n
+
+    start = time()
+    comments = sum(n for _, n in bounded_map(fetch, range(submissions), workers))
+    elapsed = time() - start
+    r.close()
+    return elapsed, comments
+
+
+def bench_backend(args):
+    from asyncfetch import AsyncClient
+    results = []
+    thread = SyntheticThread(args.comments, page_size=args.page_size)
+    for workers in args.workers:
+        for backend in ('praw', 'async'):
+            server = FakeRedditServer(latency=args.latency, thread=thread).start()
+            if backend == 'async':
+                client = AsyncClient('benchmark', base_url=server.url,
+                                     pool_size=args.pool_size)
+            else:
+                client = BlockingClient(server.url)
+            elapsed, comments = _fetch_threads(client, args.submissions, workers)
+            server.stop()
+            requests = len(server.request_times)
+            results.append({'backend': backend, 'workers': workers,
+                            'seconds': elapsed, 'requests': requests,
+                            'comments': comments,
+                            'requests_per_sec': requests / elapsed,
+                            'comments_per_sec': comments / elapsed})
+
+    expected = args.submissions * args.comments
+    for res in results:
+        print('%-6s workers=%-3d %7.2fs  %5d requests  %7.1f req/s  '
+              '%9.0f comments/s  %s' %
+              (res['backend'], res['workers'], res['seconds'], res['requests'],
+               res['requests_per_sec'], res['comments_per_sec'],
+               'OK' if res['comments'] == expected else
+               'MISSING %d COMMENTS' % (expected - res['comments'])))
+    return results
+
+
+# Runs in a forked child: crawls every subreddit of the fake API, then
+# their users, into a fresh database, as `scraper.py crawl --scrape-users`
+# does
+def _crawl_run(url, names, args, backend, queue):
+    import commentDB
+    import pipeline
+    from asyncfetch import AsyncClient, AsyncReddit
+    from crawlstate import CrawlTracker
+    from dbwriter import BulkWriter
+    from instrument import current_rss, metrics
+    from sqlalchemy.orm import sessionmaker
+
+    tmpdir = tempfile.mkdtemp()
+    engine = commentDB.make_engine(os.path.join(tmpdir, 'crawl.sqlite'),
+                                   performance=args.fast_sqlite)
+    commentDB.upgrade_schema(engine)
+    session = sessionmaker(bind=engine)()
+    writer = BulkWriter(session, batch_size=args.batch_size)
+    tracker = CrawlTracker(session, writer)
+    if backend == 'async':
+        client = AsyncClient('benchmark', base_url=url, pool_size=args.pool_size)
+    else:
+        client = BlockingClient(url)
+    r = AsyncReddit(client)
+
+    baseline = current_rss()
+    peak = [baseline]
+    done = threading.Event()
+    def sample():
+        while not done.wait(0.01):
+            peak[0] = max(peak[0], current_rss())
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+
+    metrics.reset()
+    start = time()
+    subreddits = [r.get_subreddit(name) for name in names]
+    models = {'GLOBAL': commentDB.Subreddit(subreddit_id='GLOBAL', name='GLOBAL')}
+    for name, subreddit in zip(names, subreddits):
+        models[name] = commentDB.Subreddit(subreddit)
+    for model in models.values():
+        writer.add(model)
+    pipeline.load_subreddits(subreddits, writer, tracker, workers=args.workers)
+    writer.flush()
+    crawled = time()
+    if not args.skip_users:
+        pipeline.load_users(r, models, writer, session, workers=args.workers)
+    writer.close()
+    finished = time()
+    done.set()
+    sampler.join()
+
+    snapshot = metrics.snapshot()
+    stats = writer.stats()
+    r.close()
+    session.close()
+    engine.dispose()
+    shutil.rmtree(tmpdir)
+
+    rows = sum(stats['rows_written'].values())
+    write_time = sum(stats['write_time'].values())
+    queue.put({'workers': args.workers,
+               'crawl_seconds': crawled - start,
+               'users_seconds': finished - crawled,
+               'seconds': finished - start,
+               'counts': snapshot['counts'],
+               'stages': dict((name, stage['seconds'])
+                              for name, stage in snapshot['stages'].items()),
+               'rows_written': rows,
+               'insert_rows_per_sec': rows / write_time if write_time else 0.0,
+               'peak_rss_mb': peak[0],
+               'growth_mb': peak[0] - baseline})
+
+
+def bench_crawl(args):
+    reddit = SyntheticReddit(subreddits=args.subreddits, submissions=args.submissions,
+                             comments=args.comments, users=args.users,
+                             history=args.history, seed=args.seed)
+    print('Fixture: %d subreddits, %d submissions, %d comments, %d users' %
+          (args.subreddits, len(reddit.posts), reddit.num_comments, args.users))
+    results = {'fixture': {'subreddits': args.subreddits,
+                           'submissions': len(reddit.posts),
+                           'comments': reddit.num_comments,
+                           'users': args.users, 'history': args.history,
+                           'seed': args.seed},
+               'runs': []}
+    context = multiprocessing.get_context('fork')
+    for backend in args.backend:
+        server = FakeRedditServer(latency=args.latency, reddit=reddit).start()
+        queue = context.Queue()
+        child = context.Process(target=_crawl_run,
+                                args=(server.url, reddit.names, args, backend, queue))
+        child.start()
+        child.join()
+        server.stop()
+        res = queue.get(timeout=1)     # raises Empty if the run failed
+        res['backend'] = backend
+        res['requests'] = len(server.request_times)
+        res['requests_per_sec'] = res['requests'] / res['seconds']
+        res['comments_per_sec'] = res['counts'].get('comments', 0) / res['crawl_seconds']
+        results['runs'].append(res)
+
+        print('%-6s workers=%-3d crawl %6.1fs %9.0f comments/s  users %6.1fs  '
+              '%6d requests %7.1f req/s  insert %8.0f rows/s  peak RSS %6.1f MB' %
+              (backend, res['workers'], res['crawl_seconds'], res['comments_per_sec'],
+               res['users_seconds'], res['requests'], res['requests_per_sec'],
+               res['insert_rows_per_sec'], res['peak_rss_mb']))
+        print('       stages: %s' %
+              ', '.join('%s %.2fs' % (name, res['stages'][name])
+                        for name in sorted(res['stages'])))
+        if res['counts'].get('comments', 0) != reddit.num_comments:
+            print('       MISSING %d COMMENTS' %
+                  (reddit.num_comments - res['counts'].get('comments', 0)))
+    return results
+
+
+# Errors from urlopen: HTTP errors, connection errors and dropped connections
+def _classify_urllib_error(e):
+    if isinstance(e, HTTPError):
+        return e.code, e.headers
+    return None, None
+
+
+def bench_retry(args):
+    faults = [(args.error_rate, 500), (args.throttle_rate, 429),
+              (args.drop_rate, 'drop')]
+    outage = (args.outage_start, args.outage) if args.outage else None
+    server = FakeRedditServer(latency=args.latency, faults=faults,
+                              retry_after=args.retry_after, outage=outage).start()
+    retrier = Retrier((HTTPException, IOError), _classify_urllib_error,
+                      max_attempts=args.max_attempts, base_delay=args.base_delay,
+                      max_delay=args.max_delay,
+                      breaker=CircuitBreaker(args.breaker_threshold,
+                                             args.breaker_cooldown))
+    url = server.url + '/r/fake/search.json?page=%d'
+
+    start = time()
+    results = [result for _, result in
+               bounded_map(lambda i: retrier.call(lambda: urlopen(url % i).read()),
+                           range(args.calls), args.workers)]
+    elapsed = time() - start
+    server.stop()
+
+    stats = retrier.stats.as_dict()
+    failed = sum(1 for result in results if result is False)
+    retries = sum(stats['retries'].values())
+    print('%d calls in %.2fs: %d succeeded, %d failed, %d HTTP requests' %
+          (args.calls, elapsed, args.calls - failed, failed, len(server.request_times)))
+    retrier.stats.report()
+    print('mean wait per retry: %.3fs' %
+          (stats['wait_time'] / retries if retries else 0.0))
+    stats.update({'seconds': elapsed, 'succeeded': args.calls - failed,
+                  'requests': len(server.request_times)})
+    if args.thread_comments:
+        stats['expansion'] = _expansion_retry(args.thread_comments, args.fail_at)
+    return stats
+
+
+# Fails one request partway through expanding a thread's 'more comments'
+# stubs, and checks the pipeline still stores the whole thread
+def _expansion_retry(n_comments, fail_at):
+    import commentDB
+    import pipeline
+    from dbwriter import BulkWriter
+    from sqlalchemy import func
+    from sqlalchemy.orm import sessionmaker
+
+    server = FakeRedditServer(latency=0, thread=SyntheticThread(n_comments),
+                              fail_at=[fail_at]).start()
+    tmpdir = tempfile.mkdtemp()
+    retrier = pipeline.retrier
+    pipeline.retrier = Retrier(pipeline.RETRYABLE_ERRORS, pipeline._classify_error,
+                               base_delay=0.01)
+    try:
+        engine = commentDB.make_engine(os.path.join(tmpdir, 'expansion.sqlite'))
+        commentDB.upgrade_schema(engine)
+        session = sessionmaker(bind=engine)()
+        writer = BulkWriter(session)
+        submission = FakeThreadSubmission(server.url, n_comments)
+        if pipeline._fetch_comments(submission) is not False:
+            pipeline.load_comments(submission.comments, writer, submission.fullname)
+        writer.close()
+        stored = session.query(func.count(commentDB.Comment.com_id)).scalar()
+        session.close()
+        engine.dispose()
+    finally:
+        pipeline.retrier = retrier
+        server.stop()
+        shutil.rmtree(tmpdir)
+
+    print('expansion with request %d failed: %d of %d comments stored, '
+          '%d HTTP requests%s' %
+          (fail_at, stored, n_comments, len(server.request_times),
+           '' if stored == n_comments else '  INCOMPLETE'))
+    return {'comments': n_comments, 'stored': stored,
+            'requests': len(server.request_times),
+            'complete': stored == n_comments}
+
+
+# Input: number of comments to generate, fraction of them that are
+#        top-level; with reply_window, replies go to one of the last
+#        reply_window comments, for deeper threads
+# Output: generator of commentDB models for a synthetic crawl: subreddits,
+#         users with activity rows, submissions and comment trees
+def synthetic_models(n_comments, per_submission=200, n_subreddits=5, seed=0,
+                     root_rate=0.3, reply_window=None):
+    import commentDB
+    rng = random.Random(seed)
+    n_users = max(100, n_comments // 20)
+
+    subreddits = [commentDB.Subreddit(subreddit_id='GLOBAL', name='GLOBAL')]
+    subreddits += [commentDB.Subreddit(subreddit_id='t5_%d' % i, name='sub%d' % i)
+                   for i in range(n_subreddits)]
+    for s in subreddits:
+        yield s
+
+    stats = {'count': 10, 'pos_karma': 50, 'neg_karma': 5, 'net_karma': 45,
+             'avg_pos_karma': 5.0, 'avg_neg_karma': 0.5, 'avg_net_karma': 4.5}
+    for u in range(n_users):
+        yield commentDB.User(name='user%d' % u)
+        for s in (subreddits[0], rng.choice(subreddits[1:])):
+            yield commentDB.UserActivity(user_name='user%d' % u,
+                                         subreddit_id=s.subreddit_id,
+                                         subreddit_name=s.name,
+                                         comment_stats=stats,
+                                         submission_stats=stats)
+
+    created = 1400000000
+    for i in range(0, n_comments, per_submission):
+        sub = rng.choice(subreddits[1:])
+        sub_id = 't3_%d' % i
+        yield commentDB.Submission(sub_id=sub_id, subreddit_id=sub.subreddit_id,
+                                   user_name='user%d' % rng.randrange(n_users),
+                                   title='title %d' % i, text='text %d' % i,
+                                   score=rng.randint(0, 5000),
+                                   timestamp=datetime.utcfromtimestamp(created))
+        for j in range(i, min(i + per_submission, n_comments)):
+            first = i if reply_window is None else max(i, j - reply_window)
+            parent = sub_id if j == i or rng.random() < root_rate else \
+                't1_%d' % rng.randrange(first, j)
+            created += 1
+            yield commentDB.Comment(com_id='t1_%d' % j, sub_id=sub_id,
+                                    subreddit_id=sub.subreddit_id,
+                                    parent_id=parent,
+                                    user_name='user%d' % rng.randrange(n_users),
+                                    text='comment body %d' % j,
+                                    score=rng.randint(-10, 1000),
+                                    timestamp=datetime.utcfromtimestamp(created))
+
+
+DB_QUERIES = [
+    ('comments_by_submission', 'sub_id',
+     'SELECT com_id, score FROM comments WHERE sub_id = :k'),
+    ('comments_by_user', 'user_name',
+     'SELECT com_id, score FROM comments WHERE user_name = :k'),
+    ('replies', 'parent_id',
+     'SELECT com_id FROM comments WHERE parent_id = :k'),
+    ('submissions_by_subreddit', 'subreddit_id',
+     'SELECT count(*) FROM submissions WHERE subreddit_id = :k'),
+    ('author_activity_join', 'sub_id',
+     'SELECT c.com_id, a.comment_net_karma FROM comments c '
+     'JOIN user_activities a ON a.user_name = c.user_name '
+     'AND a.subreddit_id = c.subreddit_id WHERE c.sub_id = :k'),
+]
+
+
+def _time_db(engine, args, rng):
+    from sqlalchemy import text
+    from sqlalchemy.orm import sessionmaker
+    from dbwriter import BulkWriter
+
+    session = sessionmaker(bind=engine)()
+    writer = BulkWriter(session, batch_size=args.batch_size)
+    start = time()
+    for model in synthetic_models(args.comments):
+        writer.add(model)
+    writer.close()
+    insert_time = time() - start
+    rows = sum(writer.rows_written.values())
+
+    result = {'insert_rows': rows,
+              'insert_seconds': insert_time,
+              'insert_rows_per_sec': rows / insert_time,
+              'queries_ms': {}}
+    conn = engine.connect()
+    for name, column, sql in DB_QUERIES:
+        keys = [r[0] for r in conn.execute(
+            text('SELECT DISTINCT %s FROM %s' %
+                 (column, 'submissions' if name.startswith('submissions') else 'comments')))]
+        keys = [rng.choice(keys) for _ in range(args.queries)]
+        start = time()
+        for k in keys:
+            conn.execute(text(sql), k=k).fetchall()
+        result['queries_ms'][name] = 1000 * (time() - start) / len(keys)
+    conn.close()
+    session.close()
+    return result
+
+
+# Runs in a forked child, so each run's peak RSS is its own
+def _memory_run(url, n_comments, stream, max_rss, queue):
+    import commentDB
+    import pipeline
+    from dbwriter import BulkWriter
+    from instrument import current_rss
+    from sqlalchemy.orm import sessionmaker
+
+    tmpdir = tempfile.mkdtemp()
+    # Default pragmas: the performance profile's page cache would
+    # dominate peak RSS
+    engine = commentDB.make_engine(os.path.join(tmpdir, 'memory.sqlite'))
+    commentDB.upgrade_schema(engine)
+    session = sessionmaker(bind=engine)()
+    writer = BulkWriter(session, batch_size=1000)
+    submission = FakeThreadSubmission(url, n_comments)
+
+    baseline = current_rss()
+    peak = [baseline]
+    done = threading.Event()
+    def sample():
+        while not done.wait(0.005):
+            peak[0] = max(peak[0], current_rss())
+    sampler = threading.Thread(target=sample)
+    sampler.start()
+
+    start = time()
+    if stream:
+        count = pipeline.load_comments_streaming(submission, writer, max_rss)
+    else:
+        submission.replace_more_comments()
+        count = pipeline.load_comments(submission.comments, writer,
+                                       submission.fullname)
+    writer.close()
+    elapsed = time() - start
+    done.set()
+    sampler.join()
+    session.close()
+    engine.dispose()
+    shutil.rmtree(tmpdir)
+    queue.put({'comments': count, 'seconds': elapsed,
+               'baseline_mb': baseline, 'peak_mb': peak[0],
+               'growth_mb': peak[0] - baseline})
+
+
+class _TreeNode(object):
+    __slots__ = ('index', 'fullname', 'replies')
+
+    def __init__(self, index):
+        self.index = index
+        self.fullname = 't1_c%d' % index
+        self.replies = []
+
+
+# Walks a SyntheticThread with a reply chain `depth` comments long, and
+# checks every comment's TreeMetrics (and subtree_metrics' arrays)
+# against values computed directly from the parent of each comment. Then
+# stores the thread with its paths, and checks the thread index's answers
+# for comments above, at and below MAX_PATH_DEPTH.
+def bench_tree(args):
+    import numpy as np
+    from treewalk import subtree_metrics, walk_comment_tree
+
+    parent = SyntheticThread(args.comments, spine=args.depth).parent
+    n = len(parent)
+    nodes = [_TreeNode(i) for i in range(n)]
+    roots = []
+    for i, p in enumerate(parent):
+        (nodes[p].replies if p >= 0 else roots).append(nodes[i])
+
+    # Parents come before their children
+    depth = [0] * n
+    for i, p in enumerate(parent):
+        depth[i] = depth[p] + 1 if p >= 0 else 1
+    replies, height, size = [0] * n, [1] * n, [1] * n
+    for i in reversed(range(n)):
+        p = parent[i]
+        if p >= 0:
+            replies[p] += 1
+            height[p] = max(height[p], height[i] + 1)
+            size[p] += size[i]
+
+    start = time()
+    walked = 0
+    errors = 0
+    paths = [None] * n
+    for node, m in walk_comment_tree(roots):
+        i = node.index
+        paths[i] = m.path
+        walked += 1
+        errors += (m.depth, m.num_replies, m.convo_depth, m.subtree_size) != \
+                  (depth[i], replies[i], height[i], size[i])
+    walk_time = time() - start
+
+    start = time()
+    arrays = subtree_metrics(parent)
+    arrays_time = time() - start
+    array_errors = sum(int(np.count_nonzero(a != np.array(b)))
+                       for a, b in zip(arrays, (replies, height, size)))
+
+    result = {'comments': n, 'walked': walked, 'max_depth': max(depth),
+              'walk_seconds': walk_time, 'walk_errors': errors,
+              'subtree_metrics_seconds': arrays_time,
+              'subtree_metrics_errors': array_errors}
+    print('%d comments, %d deep: walked %d in %.2fs, %d wrong; '
+          'subtree_metrics in %.2fs, %d wrong' %
+          (n, result['max_depth'], walked, walk_time, errors, arrays_time, array_errors))
+    if walked != n or errors or array_errors:
+        print('ERROR: tree metrics do not match the thread')
+    if not args.skip_index:
+        result['index'] = _tree_index(parent, depth, paths, args.depth, args.runs)
+    return result
+
+
+def _tree_index(parent, depth, paths, spine, runs):
+    import commentDB
+    import threadindex
+    from sqlalchemy.orm import sessionmaker
+    from treewalk import MAX_PATH_DEPTH, path_segment
+
+    n = len(parent)
+    names = ['t1_c%d' % i for i in range(n)]
+    full = [0] * n          # length of each path without the cap
+    for i, p in enumerate(parent):
+        full[i] = (full[p] if p >= 0 else 0) + len(path_segment(names[i]))
+    result = {'path_mb': sum(len(p) for p in paths) / 1e6,
+              'max_path': max(len(p) for p in paths),
+              'uncapped_path_mb': sum(full) / 1e6, 'uncapped_max_path': max(full)}
+    print('paths: %.1f MB, longest %d characters (uncapped: %.1f MB, longest %d)' %
+          (result['path_mb'], result['max_path'], result['uncapped_path_mb'],
+           result['uncapped_max_path']))
+
+    children = [[] for _ in range(n)]
+    for i, p in enumerate(parent):
+        if p >= 0:
+            children[p].append(i)
+
+    def below(i):
+        found, stack = [], [i]
+        while stack:
+            j = stack.pop()
+            found.append(names[j])
+            stack.extend(children[j])
+        return sorted(found)
+
+    def above(i):
+        found = []
+        while parent[i] >= 0:
+            i = parent[i]
+            found.append(names[i])
+        return found[::-1]
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        engine = commentDB.make_engine(os.path.join(tmpdir, 'tree.sqlite'),
+                                       performance=True)
+        commentDB.upgrade_schema(engine)
+        table = commentDB.Comment.__table__
+        with engine.begin() as conn:
+            conn.execute(table.insert(),
+                         [{'com_id': names[i], 'sub_id': 't3_big', 'text': 'x',
+                           'parent_id': names[parent[i]] if parent[i] >= 0 else 't3_big',
+                           'path': paths[i], 'depth': depth[i]}
+                          for i in range(n)])
+        start = time()
+        arrays = threadindex.ThreadArrays.build(engine)
+        result['arrays_build_seconds'] = time() - start
+
+        # Spine comments: comment i of the chain is i + 1 deep
+        targets = sorted(set(min(d, spine) - 1 for d in
+                             (1, MAX_PATH_DEPTH // 2, MAX_PATH_DEPTH, MAX_PATH_DEPTH + 1,
+                              spine // 5, spine)))
+        session = sessionmaker(bind=engine)()
+        errors = 0
+        result['queries'] = {}
+        for i in targets:
+            comment = session.query(commentDB.Comment).get(names[i])
+            expected_below, expected_above = below(i), above(i)
+            errors += sorted(c.com_id for c in
+                             threadindex.subtree(session, comment)) != expected_below
+            errors += [c.com_id for c in
+                       threadindex.ancestors(session, comment)] != expected_above
+            errors += sorted(arrays.subtree(names[i])) != expected_below
+            errors += arrays.ancestors(names[i]) != expected_above
+            r = result['queries']['depth %d' % (i + 1)] = {
+                'subtree_size': len(expected_below),
+                'subtree': _latency(lambda: threadindex.subtree(session, comment).all(), runs),
+                'ancestors': _latency(lambda: threadindex.ancestors(session, comment).all(),
+                                      runs)}
+            print('depth %5d%s: subtree of %6d in %8.2f ms, %5d ancestors in %8.2f ms '
+                  '(median)' %
+                  (i + 1, ' (capped)' if threadindex.capped(comment) else '         ',
+                   len(expected_below), r['subtree']['median_ms'],
+                   len(expected_above), r['ancestors']['median_ms']))
+        result['index_errors'] = errors
+        session.close()
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+    if errors:
+        print('ERROR: %d thread index answers do not match the thread' % errors)
+    return result
+
+
+def bench_memory(args):
+    results = []
+    context = multiprocessing.get_context('fork')
+    for n in args.comments:
+        server = FakeRedditServer(latency=0, thread=SyntheticThread(n)).start()
+        for stream in (False, True):
+            queue = context.Queue()
+            child = context.Process(target=_memory_run,
+                                    args=(server.url, n, stream, args.max_rss, queue))
+            child.start()
+            child.join()
+            res = queue.get(timeout=1)     # raises Empty if the run failed
+            res['mode'] = 'streaming' if stream else 'in-memory'
+            res['thread_size'] = n
+            results.append(res)
+            print('%-10s %7d comments  %6.1fs  %7.0f comments/s  '
+                  'peak RSS +%6.1f MB' %
+                  (res['mode'], n, res['seconds'], res['comments'] / res['seconds'],
+                   res['growth_mb']))
+        server.stop()
+    return results
+
+
+def bench_db(args):
+    import commentDB
+    rng = random.Random(1)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        # Before: schema without secondary indexes, default pragmas
+        before_file = os.path.join(tmpdir, 'before.sqlite')
+        engine = commentDB.make_engine(before_file)
+        commentDB.Base.metadata.create_all(engine)
+        for table in commentDB.Base.metadata.sorted_tables:
+            for index in table.indexes:
+                index.drop(bind=engine)
+        before = _time_db(engine, args, rng)
+        engine.dispose()
+
+        # Migration of the unindexed file
+        engine = commentDB.make_engine(before_file)
+        start = time()
+        commentDB.upgrade_schema(engine)
+        migrate_time = time() - start
+        engine.dispose()
+
+        # After: indexed schema, performance profile
+        engine = commentDB.make_engine(os.path.join(tmpdir, 'after.sqlite'),
+                                       performance=True)
+        commentDB.upgrade_schema(engine)
+        after = _time_db(engine, args, rng)
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('%-26s %14s %14s' % ('', 'before', 'after'))
+    print('%-26s %14.0f %14.0f' % ('insert rows/s',
+                                   before['insert_rows_per_sec'],
+                                   after['insert_rows_per_sec']))
+    for name, _, _ in DB_QUERIES:
+        print('%-26s %11.3f ms %11.3f ms' % (name, before['queries_ms'][name],
+                                             after['queries_ms'][name]))
+    print('index migration: %.1fs' % migrate_time)
+    return {'comments': args.comments, 'before': before, 'after': after,
+            'migration_seconds': migrate_time}
+
+
+# Input: command line of a Python process
+# Output: {'seconds': wall time, 'import_ms': total import time,
+#          'modules': modules imported, 'slowest': [(module, cumulative ms)]}
+#         from -X importtime, or {'error': ...} if it failed
+def _startup(argv, top=8):
+    start = time()
+    proc = subprocess.Popen([sys.executable, '-X', 'importtime'] + argv,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            cwd=os.path.dirname(os.path.abspath(__file__)))
+    _, err = proc.communicate()
+    elapsed = time() - start
+    if proc.returncode != 0:
+        return {'error': err.decode('utf-8', 'replace').strip().splitlines()[-1]}
+    imports = []    # (module, cumulative microseconds, nesting depth)
+    for line in err.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(cumulative), depth))
+    roots = sorted(((n, us) for n, us, depth in imports if depth == 0),
+                   key=lambda x: -x[1])
+    return {'seconds': elapsed,
+            'import_ms': sum(us for _, us in roots) / 1000.0,
+            'modules': len(imports),
+            'slowest': [(n, us / 1000.0) for n, us in roots[:top]]}
+
+
+# Startup of each scraper.py command, up to argument parsing (--help),
+# against importing the whole crawl pipeline as scraper.py used to
+def bench_startup(args):
+    runs = [('scraper.py --help', ['scraper.py', '--help'])]
+    runs += [('scraper.py %s --help' % c, ['scraper.py', c, '--help'])
+             for c in ('crawl', 'users', 'export', 'stats')]
+    runs.append(('import pipeline', ['-c', 'import pipeline']))
+
+    results = {}
+    for name, argv in runs:
+        samples = [_startup(argv) for _ in range(args.runs)]
+        if 'error' in samples[0]:
+            results[name] = samples[0]
+            print('%-26s failed: %s' % (name, samples[0]['error']))
+            continue
+        samples.sort(key=lambda s: s['seconds'])
+        results[name] = samples[len(samples) // 2]
+        r = results[name]
+        print('%-26s %7.0f ms  imports %7.1f ms  %4d modules  slowest: %s' %
+              (name, 1000 * r['seconds'], r['import_ms'], r['modules'],
+               ', '.join('%s %.0fms' % m for m in r['slowest'][:3])))
+    return results
+
+
+# Input: number of comments, fraction that are edited copies of an
+#        earlier comment
+# Output: list of (com_id, body, ID of the original it copies or None),
+#         with markdown, links and HTML entities like reddit's
+def synthetic_bodies(n_comments, dup_rate=0.1, seed=0):
+    rng = random.Random(seed)
+    vocab = ['w%d' % i for i in range(5000)]
+    comments = []
+    for i in range(n_comments):
+        com_id = 't1_%d' % i
+        if comments and rng.random() < dup_rate:
+            source_id, body, source = rng.choice(comments)
+            words = body.split(' ')
+            for _ in range(len(words) // 25):
+                words[rng.randrange(len(words))] = rng.choice(vocab)
+            body = ' '.join(words).replace('**', '*').replace('https://www.', 'http://')
+            comments.append((com_id, body, source or source_id))
+            continue
+        words = [rng.choice(vocab) for _ in range(rng.randint(3, 80))]
+        if rng.random() < 0.3:
+            words.insert(rng.randrange(len(words)), '**%s**' % rng.choice(vocab))
+        if rng.random() < 0.2:
+            words.append('[link](https://www.example.com/%s/?utm_source=x)' %
+                         rng.choice(vocab))
+        if rng.random() < 0.1:
+            words.insert(0, '&gt;')
+        comments.append((com_id, ' '.join(words), None))
+    return comments
+
+
+def bench_text(args):
+    from textnorm import MIN_WORDS, WORD, DedupIndex, minhash, normalize, shingles
+
+    comments = synthetic_bodies(args.comments, args.dup_rate)
+    result = {'comments': len(comments)}
+
+    start = time()
+    normalized = [normalize(body) for _, body, _ in comments]
+    result['normalize_per_sec'] = len(comments) / (time() - start)
+
+    start = time()
+    for norm in normalized:
+        hashes = shingles(norm)
+        if hashes is not None:
+            minhash(hashes)
+    result['minhash_per_sec'] = len(comments) / (time() - start)
+
+    tmpdir = tempfile.mkdtemp()
+    try:
+        index = DedupIndex(os.path.join(tmpdir, 'dedup.sqlite'))
+        start = time()
+        flagged = {}
+        for (com_id, body, _) in comments:
+            dup_of = index.check(com_id, normalize(body))
+            if dup_of is not None:
+                flagged[com_id] = dup_of
+        index.close()
+        elapsed = time() - start
+    finally:
+        shutil.rmtree(tmpdir)
+    result['pipeline_per_sec'] = len(comments) / elapsed
+
+    # Copies of originals too short to compare are never flagged
+    expected = set(com_id for (com_id, _, source), norm in zip(comments, normalized)
+                   if source is not None and len(WORD.findall(norm)) >= MIN_WORDS)
+    found = set(flagged)
+    result['duplicates_expected'] = len(expected)
+    result['duplicates_found'] = len(found & expected)
+    result['false_positives'] = len(found - expected)
+
+    print('%d comments, %d comparable edited copies' % (len(comments), len(expected)))
+    print('  normalize           %10.0f comments/s' % result['normalize_per_sec'])
+    print('  normalize + minhash %10.0f comments/s' % (
+        1 / (1 / result['normalize_per_sec'] + 1 / result['minhash_per_sec'])))
+    print('  full stage (index)  %10.0f comments/s' % result['pipeline_per_sec'])
+    print('  found %d of %d copies, %d false positives' %
+          (result['duplicates_found'], len(expected), result['false_positives']))
+    return result
+
+
+def bench_features(args):
+    import commentDB
+    from features import FeatureBuilder
+    from sqlalchemy import text
+    from sqlalchemy.orm import sessionmaker
+    from dbwriter import BulkWriter
+
+    rng = random.Random(2)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        engine = commentDB.make_engine(os.path.join(tmpdir, 'features.sqlite'),
+                                       performance=True)
+        commentDB.upgrade_schema(engine)
+        writer = BulkWriter(sessionmaker(bind=engine)(), batch_size=5000)
+        for model in synthetic_models(args.comments):
+            writer.add(model)
+        writer.close()
+
+        result = {'comments': args.comments}
+        for name, full in (('full', True), ('unchanged', False)):
+            builder = FeatureBuilder(engine)
+            builder.refresh(full=full)
+            result[name] = {'submissions': builder.rebuilt, 'rows': builder.rows,
+                            'scan_seconds': builder.scan_time,
+                            'build_seconds': builder.build_time}
+
+        # New scores for the comments of a fraction of submissions
+        with engine.begin() as conn:
+            sub_ids = [r[0] for r in conn.execute(text('SELECT sub_id FROM submissions'))]
+            changed = rng.sample(sub_ids, max(1, int(len(sub_ids) * args.changed)))
+            for sub_id in changed:
+                conn.execute(text('UPDATE comments SET score = score + 1 + abs(random()) % 50 '
+                                  'WHERE sub_id = :k AND abs(random()) % 4 = 0'), k=sub_id)
+        builder = FeatureBuilder(engine)
+        builder.refresh()
+        result['incremental'] = {'submissions': builder.rebuilt, 'rows': builder.rows,
+                                 'changed': len(changed),
+                                 'scan_seconds': builder.scan_time,
+                                 'build_seconds': builder.build_time}
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('%d comments' % args.comments)
+    for name in ('full', 'unchanged', 'incremental'):
+        r = result[name]
+        r['rows_per_sec'] = r['rows'] / r['build_seconds'] if r['build_seconds'] else 0.0
+        print('  %-12s %6d submissions %8d rows  scan %6.2fs  build %6.2fs  %9.0f rows/s' %
+              (name, r['submissions'], r['rows'], r['scan_seconds'],
+               r['build_seconds'], r['rows_per_sec']))
+    return result
+
+
+# Input: number of words
+# Output: pronounceable pseudo-words, most frequent first
+def synthetic_vocabulary(n_words, seed=0):
+    rng = random.Random(seed)
+    syllables = [c + v for c in 'bcdfghjklmnprstvwz' for v in 'aeiou']
+    words = set()
+    while len(words) < n_words:
+        words.add(''.join(rng.choice(syllables) for _ in range(rng.randint(1, 4))))
+    return sorted(words, key=lambda w: (len(w), w))
+
+
+# Output: generator of comment bodies, `size` words on average, with
+# Zipf-distributed word frequencies like natural text
+def synthetic_texts(n_comments, vocabulary, size=30, seed=0):
+    import numpy as np
+    rng = np.random.RandomState(seed)
+    vocabulary = np.array(vocabulary, dtype=object)
+    for _ in range(0, n_comments, 10000):
+        lengths = rng.randint(5, 2 * size - 5, size=10000)
+        words = vocabulary[(rng.zipf(1.3, size=lengths.sum()) - 1) % len(vocabulary)]
+        offsets = np.concatenate(([0], np.cumsum(lengths)))
+        for i in range(len(lengths)):
+            yield ' '.join(words[offsets[i]:offsets[i + 1]])
+
+
+def _insert_texts(conn, texts, first, n):
+    rows = (('t1_%d' % i, 't3_%d' % (i // 200), 't5_%d' % (i // 200 % 5), body)
+            for i, body in zip(range(first, first + n), texts))
+    start = time()
+    with conn:
+        conn.executemany('INSERT INTO comments (com_id, sub_id, subreddit_id, text) '
+                         'VALUES (?, ?, ?, ?)', rows)
+    return n / (time() - start)
+
+
+def _latency(fn, runs):
+    times = []
+    for _ in range(runs):
+        start = time()
+        fn()
+        times.append(1000 * (time() - start))
+    times.sort()
+    return {'median_ms': times[len(times) // 2],
+            'p95_ms': times[min(len(times) - 1, int(len(times) * 0.95))]}
+
+
+def bench_search(args):
+    import sqlite3
+    import commentDB
+    import search
+    from sqlalchemy import text
+    from sqlalchemy.orm import sessionmaker
+
+    vocabulary = synthetic_vocabulary(args.vocabulary)
+    texts = synthetic_texts(args.comments + 2 * args.insert_rows, vocabulary)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmpdir, 'search.sqlite')
+        engine = commentDB.make_engine(path, performance=True)
+        commentDB.upgrade_schema(engine)
+        conn = sqlite3.connect(path)
+        conn.execute('PRAGMA journal_mode=WAL')
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.execute('PRAGMA recursive_triggers=ON')
+
+        start = time()
+        _insert_texts(conn, texts, 0, args.comments)
+        result = {'comments': args.comments, 'load_seconds': time() - start}
+        print('Loaded %d comments in %.1fs' % (args.comments, result['load_seconds']))
+
+        result['insert_rows_per_sec_unindexed'] = _insert_texts(
+            conn, texts, args.comments, args.insert_rows)
+        search.install(engine)
+        result['rebuild_seconds'] = search.rebuild(engine)['comments_fts']
+        result['insert_rows_per_sec_indexed'] = _insert_texts(
+            conn, texts, args.comments + args.insert_rows, args.insert_rows)
+        conn.close()
+        print('Rebuilt the index in %.1fs' % result['rebuild_seconds'])
+
+        session = sessionmaker(bind=engine)()
+        queries = [('common word', vocabulary[3]),
+                   ('mid-frequency word', vocabulary[300]),
+                   ('rare word', vocabulary[len(vocabulary) // 2]),
+                   ('two words', '%s %s' % (vocabulary[50], vocabulary[200])),
+                   ('common-word phrase', '"%s %s"' % (vocabulary[1], vocabulary[2])),
+                   ('subreddit filter', vocabulary[300])]
+        result['queries'] = {}
+        for name, query in queries:
+            subreddit_id = 't5_1' if name == 'subreddit filter' else None
+            def run():
+                return search.search_comments(session, query, limit=args.limit,
+                                              subreddit_id=subreddit_id,
+                                              raw=name.endswith('phrase'),
+                                              candidates=args.candidates or None)
+            hits = run()
+            r = _latency(run, args.runs)
+            r['hits'] = len(hits)
+            result['queries'][name] = r
+
+        # Baseline: the LIKE scan search replaces, finding every match
+        start = time()
+        session.execute(text('SELECT com_id FROM comments WHERE text LIKE :q'),
+                        {'q': '%' + vocabulary[len(vocabulary) // 2] + '%'}).fetchall()
+        result['like_scan_ms'] = 1000 * (time() - start)
+        session.close()
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('insert rows/s without index %10.0f' % result['insert_rows_per_sec_unindexed'])
+    print('insert rows/s with index    %10.0f' % result['insert_rows_per_sec_indexed'])
+    print('%-20s %8s %10s %10s' % ('query', 'hits', 'median', 'p95'))
+    for name, _ in queries:
+        r = result['queries'][name]
+        print('%-20s %8d %7.2f ms %7.2f ms%s' %
+              (name, r['hits'], r['median_ms'], r['p95_ms'],
+               '' if r['p95_ms'] <= args.target_ms else '  over target'))
+    print('%-20s %8s %7.0f ms' % ('LIKE scan', '', result['like_scan_ms']))
+    return result
+
+
+THREAD_QUERIES = [
+    ('subtree', 'recursive CTE',
+     'WITH RECURSIVE t(com_id) AS (SELECT :k UNION ALL SELECT c.com_id '
+     'FROM comments c JOIN t ON c.parent_id = t.com_id) SELECT com_id FROM t'),
+    ('subtree', 'path range',
+     'SELECT com_id FROM comments WHERE sub_id = :s AND path >= :lo AND path < :hi'),
+    ('ancestors', 'recursive CTE',
+     'WITH RECURSIVE a(com_id, parent_id) AS (SELECT com_id, parent_id FROM comments '
+     'WHERE com_id = :k UNION ALL SELECT c.com_id, c.parent_id FROM comments c '
+     'JOIN a ON c.com_id = a.parent_id) SELECT com_id FROM a WHERE com_id != :k'),
+    ('ancestors', 'path prefixes', None),
+    ('siblings', 'parent_id index',
+     'SELECT com_id FROM comments WHERE parent_id = :p AND com_id != :k'),
+]
+
+
+def bench_thread(args):
+    import itertools
+    import commentDB
+    import threadindex
+    from sqlalchemy import bindparam, text
+    from sqlalchemy.orm import sessionmaker
+    from dbwriter import BulkWriter
+
+    rng = random.Random(3)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        engine = commentDB.make_engine(os.path.join(tmpdir, 'thread.sqlite'),
+                                       performance=True)
+        commentDB.upgrade_schema(engine)
+        writer = BulkWriter(sessionmaker(bind=engine)(), batch_size=5000)
+        for model in synthetic_models(args.comments, per_submission=args.per_submission,
+                                      root_rate=args.root_rate,
+                                      reply_window=args.reply_window):
+            writer.add(model)
+        writer.close()
+        result = {'comments': args.comments, 'per_submission': args.per_submission,
+                  'root_rate': args.root_rate, 'reply_window': args.reply_window}
+
+        # Synthetic comments are stored without paths, as an old crawl would be
+        start = time()
+        threadindex.refresh(engine)
+        result['backfill_seconds'] = time() - start
+        start = time()
+        arrays = threadindex.ThreadArrays.build(engine)
+        result['arrays_build_seconds'] = time() - start
+        filename = os.path.join(tmpdir, 'thread.npz')
+        arrays.save(filename)
+        start = time()
+        arrays = threadindex.ThreadArrays.load(filename)
+        result['arrays_load_seconds'] = time() - start
+        result['arrays_mb'] = os.path.getsize(filename) / 1e6
+
+        conn = engine.connect()
+        # Half the targets are top-level comments, which have the largest
+        # subtrees. The raw path queries below only hold for comments
+        # within MAX_PATH_DEPTH; deeper ones are covered by `tree`.
+        rows = conn.execute(text('SELECT com_id, sub_id, parent_id, path, '
+                                 "parent_id LIKE 't3_%' FROM comments")).fetchall()
+        rows = [r for r in rows if r[3].endswith(r[0][3:] + '/')]
+        roots = [r for r in rows if r[4]]
+        sample = [rng.choice(roots if i % 2 else rows)[:4] for i in range(args.queries)]
+        params = []
+        for com_id, sub_id, parent_id, path in sample:
+            params.append({'k': com_id, 's': sub_id, 'p': parent_id, 'lo': path,
+                           'hi': path[:-1] + threadindex.PATH_END, 'path': path})
+        prefixes = text('SELECT com_id FROM comments WHERE sub_id = :s '
+                        'AND path IN :prefixes').bindparams(
+                            bindparam('prefixes', expanding=True))
+
+        def ancestor_paths(p):
+            path = p['path']
+            ends = [i + 1 for i, ch in enumerate(path[:-1]) if ch == '/']
+            if not ends:
+                return []
+            return conn.execute(prefixes, s=p['s'],
+                                prefixes=[path[:i] for i in ends]).fetchall()
+
+        # Every approach must find the same comments
+        answers = {}
+        for query, method, sql in THREAD_QUERIES:
+            run = ancestor_paths if sql is None else \
+                (lambda p, sql=text(sql): conn.execute(sql, **p).fetchall())
+            answers[query, method] = [sorted(r[0] for r in run(p)) for p in params]
+        answers['subtree', 'arrays'] = [sorted(arrays.subtree(p['k'])) for p in params]
+        answers['ancestors', 'arrays'] = [sorted(arrays.ancestors(p['k'])) for p in params]
+        answers['siblings', 'arrays'] = [sorted(arrays.siblings(p['k'])) for p in params]
+        result['mismatches'] = sum(answers[key] != answers[other]
+                                   for key in answers for other in answers
+                                   if key[0] == other[0])
+        result['mean_subtree_size'] = sum(len(a) for a in answers['subtree', 'arrays']) / \
+                                      float(len(params))
+
+        result['queries'] = {}
+        for query, method, sql in THREAD_QUERIES:
+            keys = itertools.cycle(params)
+            if sql is None:
+                run = lambda: ancestor_paths(next(keys))
+            else:
+                run = lambda sql=text(sql): conn.execute(sql, **next(keys)).fetchall()
+            result['queries']['%s %s' % (query, method)] = _latency(run, args.runs)
+        for query in ('subtree', 'ancestors', 'siblings'):
+            keys = itertools.cycle(params)
+            fn = getattr(arrays, query)
+            result['queries']['%s arrays' % query] = \
+                _latency(lambda: fn(next(keys)['k']), args.runs)
+        conn.close()
+        engine.dispose()
+    finally:
+        shutil.rmtree(tmpdir)
+
+    print('%d comments, %d per submission; mean subtree %.1f comments' %
+          (args.comments, args.per_submission, result['mean_subtree_size']))
+    print('path backfill %.1fs, arrays built in %.1fs (%.1f MB, loaded in %.2fs)' %
+          (result['backfill_seconds'], result['arrays_build_seconds'],
+           result['arrays_mb'], result['arrays_load_seconds']))
+    if result['mismatches']:
+        print('WARNING: %d answers differ between methods' % result['mismatches'])
+    print('%-30s %10s %10s' % ('query', 'median', 'p95'))
+    for name in sorted(result['queries']):
+        r = result['queries'][name]
+        print('%-30s %7.3f ms %7.3f ms' % (name, r['median_ms'], r['p95_ms']))
+    return result
+
+
+# Output: {dotted key: value} for every number in nested results; list
+# items are keyed by their 'backend', 'workers' or 'mode' if they have one
+def _flatten(obj, prefix=''):
+    flat = {}
+    if isinstance(obj, dict):
+        for key, value in obj.items():
+            flat.update(_flatten(value, '%s%s.' % (prefix, key)))
+    elif isinstance(obj, list):
+        for i, value in enumerate(obj):
+            label = i
+            if isinstance(value, dict):
+                label = '-'.join(str(value[k]) for k in ('mode', 'backend', 'workers')
+                                 if k in value) or i
+            flat.update(_flatten(value, '%s%s.' % (prefix, label)))
+    elif isinstance(obj, (int, float)) and not isinstance(obj, bool):
+        flat[prefix[:-1]] = obj
+    return flat
+
+
+# Print every number that changed by more than `threshold` (a fraction)
+# from a baseline run of the same benchmark
+def compare(baseline, results, threshold=0.05):
+    old, new = _flatten(baseline['results']), _flatten(results)
+    print('Compared with %s (%s):' % (baseline.get('commit') or 'baseline',
+                                      baseline.get('timestamp', '')))
+    for key in sorted(set(old) & set(new)):
+        if old[key] == new[key]:
+            continue
+        change = (new[key] - old[key]) / abs(old[key]) if old[key] else float('inf')
+        if abs(change) >= threshold:
+            print('  %-60s %12.4g -> %12.4g  %+7.1f%%' %
+                  (key, old[key], new[key], 100 * change))
+
+
+# Output: commit the tree is at, or None outside a git checkout
+def _commit():
+    try:
+        out = subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                      cwd=os.path.dirname(os.path.abspath(__file__)),
+                                      stderr=subprocess.STDOUT)
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    return out.decode('utf-8').strip()
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Benchmark crawl stages against local fakes')
+    parser.add_argument('--json', type=str,
+                        help='Write results to this JSON file')
+    parser.add_argument('--compare', type=str,
+                        help='JSON file of an earlier run of the same benchmark to '
+                             'report changes against')
+    benchmarks = parser.add_subparsers(dest='benchmark')
+
+    p = benchmarks.add_parser('concurrency',
+                              help='Concurrent comment fetching under a shared rate limit')
+    p.add_argument('--submissions', type=int, default=40)
+    p.add_argument('--requests-per-tree', dest='requests_per_tree', type=int, default=3)
+    p.add_argument('--latency', type=float, default=0.2,
+                   help='Injected server latency per request (seconds)')
+    p.add_argument('--rate', type=float, default=20.0,
+                   help='Token bucket rate (requests per second)')
+    p.add_argument('--burst', type=int, default=1)
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4, 8])
+    p.set_defaults(run=bench_concurrency)
+
+    p = benchmarks.add_parser('retry',
+                              help='Retries, backoff and circuit breaking against '
+                                   'a fault-injecting server')
+    p.add_argument('--calls', type=int, default=200)
+    p.add_argument('--workers', type=int, default=8)
+    p.add_argument('--latency', type=float, default=0.01)
+    p.add_argument('--error-rate', dest='error_rate', type=float, default=0.1,
+                   help='Fraction of requests answered with a 500')
+    p.add_argument('--throttle-rate', dest='throttle_rate', type=float, default=0.05,
+                   help='Fraction of requests answered with a 429')
+    p.add_argument('--drop-rate', dest='drop_rate', type=float, default=0.05,
+                   help='Fraction of connections dropped without an answer')
+    p.add_argument('--retry-after', dest='retry_after', type=int, default=1,
+                   help='Retry-After sent with each 429 (seconds)')
+    p.add_argument('--outage', type=float, default=1.0,
+                   help='Length of a total 503 outage (seconds; 0 for none)')
+    p.add_argument('--outage-start', dest='outage_start', type=float, default=0.5)
+    p.add_argument('--max-attempts', dest='max_attempts', type=int, default=5)
+    p.add_argument('--base-delay', dest='base_delay', type=float, default=0.05)
+    p.add_argument('--max-delay', dest='max_delay', type=float, default=5.0)
+    p.add_argument('--breaker-threshold', dest='breaker_threshold', type=int, default=5)
+    p.add_argument('--breaker-cooldown', dest='breaker_cooldown', type=float, default=1.0)
+    p.add_argument('--thread-comments', dest='thread_comments', type=int, default=5000,
+                   help='Comments in the thread expanded with a failed request '
+                        '(0 to skip)')
+    p.add_argument('--fail-at', dest='fail_at', type=int, default=5,
+                   help='Request of the expansion answered with a 503')
+    p.set_defaults(run=bench_retry)
+
+    p = benchmarks.add_parser('backend',
+                              help='Requests per second fetching whole comment '
+                                   'threads, PRAW-style and with the async backend')
+    p.add_argument('--submissions', type=int, default=20)
+    p.add_argument('--comments', type=int, default=2000,
+                   help='Comments per thread')
+    p.add_argument('--page-size', dest='page_size', type=int, default=200,
+                   help='Comments on the first page; the rest are behind '
+                        "'more comments' stubs, 100 per request")
+    p.add_argument('--latency', type=float, default=0.05)
+    p.add_argument('--workers', type=int, nargs='+', default=[1, 4])
+    p.add_argument('--pool-size', dest='pool_size', type=int, default=32)
+    p.set_defaults(run=bench_backend)
+
+    p = benchmarks.add_parser('crawl',
+                              help='End-to-end crawl of a synthetic reddit: crawl '
+                                   'and insert rates, peak memory, stage times')
+    p.add_argument('--subreddits', type=int, default=3)
+    p.add_argument('--submissions', type=int, default=30,
+                   help='Self-posts per subreddit')
+    p.add_argument('--comments', type=int, default=300,
+                   help='Mean comments per thread (Pareto-distributed)')
+    p.add_argument('--users', type=int, default=300)
+    p.add_argument('--history', type=int, default=150,
+                   help='Most comments (and submissions) in a user history')
+    p.add_argument('--seed', type=int, default=0)
+    p.add_argument('--latency', type=float, default=0.0)
+    p.add_argument('--workers', type=int, default=4)
+    p.add_argument('--backend', nargs='+', choices=('praw', 'async'),
+                   default=['praw', 'async'],
+                   help='PRAW-style blocking client and/or the async backend')
+    p.add_argument('--pool-size', dest='pool_size', type=int, default=32)
+    p.add_argument('--batch-size', dest='batch_size', type=int, default=1000)
+    p.add_argument('--fast-sqlite', dest='fast_sqlite', action='store_true')
+    p.add_argument('--skip-users', dest='skip_users', action='store_true')
+    p.set_defaults(run=bench_crawl)
+
+    p = benchmarks.add_parser('startup',
+                              help='Start-up and import time of each scraper.py '
+                                   'command, with -X importtime')
+    p.add_argument('--runs', type=int, default=5,
+                   help='Runs per command; the median is reported')
+    p.set_defaults(run=bench_startup)
+
+    p = benchmarks.add_parser('tree',
+                              help='Tree metrics of a very deep thread, checked '
+                                   'against its parent links')
+    p.add_argument('--comments', type=int, default=100000)
+    p.add_argument('--depth', type=int, default=5000,
+                   help='Length of the reply chain the thread starts with')
+    p.add_argument('--runs', type=int, default=5,
+                   help='Runs of each thread index query')
+    p.add_argument('--skip-index', dest='skip_index', action='store_true',
+                   help='Only check the walk, not the thread index')
+    p.set_defaults(run=bench_tree)
+
+    p = benchmarks.add_parser('memory',
+                              help='Peak memory expanding huge threads in memory '
+                                   'and streaming, against a fake API')
+    p.add_argument('--comments', type=int, nargs='+', default=[5000, 20000, 80000],
+                   help='Thread sizes to run')
+    p.add_argument('--max-rss', dest='max_rss', type=float,
+                   help='Memory ceiling for streaming, in MB')
+    p.set_defaults(run=bench_memory)
+
+    p = benchmarks.add_parser('db',
+                              help='Insert and query latency without and with indexes '
+                                   'and the SQLite performance profile')
+    p.add_argument('--comments', type=int, default=200000)
+    p.add_argument('--queries', type=int, default=20)
+    p.add_argument('--batch-size', dest='batch_size', type=int, default=5000)
+    p.set_defaults(run=bench_db)
+
+    p = benchmarks.add_parser('text',
+                              help='Text normalization and near-duplicate detection '
+                                   'throughput')
+    p.add_argument('--comments', type=int, default=50000)
+    p.add_argument('--dup-rate', dest='dup_rate', type=float, default=0.1,
+                   help='Fraction of comments that are edited copies')
+    p.set_defaults(run=bench_text)
+
+    p = benchmarks.add_parser('features',
+                              help='Full and incremental builds of the comment '
+                                   'feature table')
+    p.add_argument('--comments', type=int, default=200000)
+    p.add_argument('--changed', type=float, default=0.01,
+                   help='Fraction of submissions whose comment scores change '
+                        'before the incremental build')
+    p.set_defaults(run=bench_features)
+
+    p = benchmarks.add_parser('search',
+                              help='Full-text index build, insert overhead and query '
+                                   'latency on a generated corpus')
+    p.add_argument('--comments', type=int, default=3000000)
+    p.add_argument('--vocabulary', type=int, default=50000,
+                   help='Distinct words in the generated corpus')
+    p.add_argument('--insert-rows', dest='insert_rows', type=int, default=50000,
+                   help='Rows inserted without and with the index, to time the triggers')
+    p.add_argument('--runs', type=int, default=20)
+    p.add_argument('--limit', type=int, default=20)
+    p.add_argument('--candidates', type=int, default=0,
+                   help='Most recent matches to rank per query; 0 ranks every match')
+    p.add_argument('--target-ms', dest='target_ms', type=float, default=100.0,
+                   help='p95 latency target per query')
+    p.set_defaults(run=bench_search)
+
+    p = benchmarks.add_parser('thread',
+                              help='Subtree, ancestor and sibling query latency: '
+                                   'recursive SQL against the thread index')
+    p.add_argument('--comments', type=int, default=500000)
+    p.add_argument('--per-submission', dest='per_submission', type=int, default=2000)
+    p.add_argument('--root-rate', dest='root_rate', type=float, default=0.02,
+                   help='Fraction of comments that are top-level')
+    p.add_argument('--reply-window', dest='reply_window', type=int, default=20,
+                   help='Replies go to one of this many latest comments; smaller '
+                        'makes deeper threads')
+    p.add_argument('--queries', type=int, default=200,
+                   help='Comments sampled as query targets')
+    p.add_argument('--runs', type=int, default=1000)
+    p.set_defaults(run=bench_thread)
+
+    args = parser.parse_args()
+    results = args.run(args)
+    if args.compare:
+        with open(args.compare) as f:
+            compare(json.load(f), results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'benchmark': args.benchmark, 'commit': _commit(),
+                       'timestamp': datetime.utcnow().isoformat(),
+                       'results': results}, f, indent=2)
@@ -10,6 +10,7 @@
 ##
 
 from sqlalchemy import *
+from sqlalchemy import event, inspect
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import relation, sessionmaker
 
@@ -32,6 +33,90 @@ def time_from_ms(t_ms):
     dt = datetime.utcfromtimestamp(t_ms)
     return dt.strftime('%Y-%m-%d %H:%M:%S')
 
+# Raw user history is stored column-wise, as zlib-compressed JSON:
+# {'subreddit': [...], 'ups': [...], 'downs': [...], 'created': [...]}
+import json, zlib
+HISTORY_FIELDS = ('subreddit', 'ups', 'downs', 'created')
+def pack_history(history):
+    return zlib.compress(json.dumps(history).encode('utf-8'))
+
+def unpack_history(blob):
+    return json.loads(zlib.decompress(blob).decode('utf-8'))
+
+
+
+# Fingerprint of the tables, columns and indexes defined below. SQLite
+# files keep it in PRAGMA user_version once upgraded.
+def schema_version():
+    parts = []
+    for table in Base.metadata.sorted_tables:
+        parts.append(table.name)
+        parts.extend('%s %s' % (col.name, col.type) for col in table.columns)
+        parts.extend(sorted(index.name for index in table.indexes))
+    return zlib.crc32('\n'.join(parts).encode('utf-8')) & 0x7fffffff
+
+
+# Bring a database up to the current schema: create missing tables,
+# and add columns and indexes introduced since an existing file was created.
+# SQLite files already on the current schema are left alone.
+# Output: False if it was already current
+def upgrade_schema(engine):
+    version = schema_version()
+    sqlite = engine.dialect.name == 'sqlite'
+    if sqlite:
+        with engine.connect() as conn:
+            if conn.execute(text('PRAGMA user_version')).scalar() == version:
+                return False
+
+    Base.metadata.create_all(engine)
+    inspector = inspect(engine)
+    with engine.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = set(c['name'] for c in inspector.get_columns(table.name))
+            for col in table.columns:
+                if col.name in existing:
+                    continue
+                conn.execute(text('ALTER TABLE %s ADD COLUMN %s %s' %
+                                  (table.name, col.name,
+                                   col.type.compile(dialect=engine.dialect))))
+
+            existing = set(i['name'] for i in inspector.get_indexes(table.name))
+            for index in table.indexes:
+                if index.name not in existing:
+                    index.create(bind=conn)
+        if sqlite:
+            conn.execute(text('PRAGMA user_version = %d' % version))
+    return True
+
+
+# Opt-in SQLite settings for crawling and ranking queries on large files:
+# write-ahead logging, fewer fsyncs (a power loss may drop the last
+# transactions, but cannot corrupt the file), memory-mapped reads and a
+# 256MB page cache
+PERFORMANCE_PRAGMAS = ('PRAGMA journal_mode=WAL',
+                       'PRAGMA synchronous=NORMAL',
+                       'PRAGMA mmap_size=1073741824',
+                       'PRAGMA cache_size=-262144',
+                       'PRAGMA temp_store=MEMORY')
+
+# Set on every SQLite connection: INSERT OR REPLACE then fires the delete
+# triggers that keep the full-text indexes in step (see search.py)
+SQLITE_PRAGMAS = ('PRAGMA recursive_triggers=ON',)
+
+# Input: SQLite file name, or any SQLAlchemy URL
+def make_engine(dbfile, performance=False, echo=False):
+    url = dbfile if '://' in dbfile else 'sqlite:///' + dbfile
+    engine = create_engine(url, echo=echo)
+    if engine.dialect.name == 'sqlite':
+        pragmas = SQLITE_PRAGMAS + (PERFORMANCE_PRAGMAS if performance else ())
+        @event.listens_for(engine, 'connect')
+        def set_pragmas(dbapi_conn, connection_record):
+            cursor = dbapi_conn.cursor()
+            for pragma in pragmas:
+                cursor.execute(pragma)
+            cursor.close()
+    return engine
+
 
 
 #####################################
@@ -40,6 +125,10 @@ def time_from_ms(t_ms):
 # - Submission                      #
 # - Comment                         #
 # - User                            #
+# - UserActivity, UserHistory       #
+# - CrawlState, SubmissionState     #
+# - ScoreSnapshot, SnapshotSchedule #
+# - CommentFeatures, FeatureBuild   #
 #####################################
 
 class Subreddit(Base):
@@ -71,7 +160,7 @@ class Submission(Base):
     # Metadata
     # id = Column(Integer, primary_key=True)
     sub_id = Column(String, primary_key=True)   # reddit submission ID
-    subreddit_id = Column(String, ForeignKey('subreddits.subreddit_id'))           # reddit subreddit ID
+    subreddit_id = Column(String, ForeignKey('subreddits.subreddit_id'), index=True) # reddit subreddit ID
     timestamp = Column(DateTime)            # post time
 
     # Set up one->many relationship with comments
@@ -134,12 +223,12 @@ class Comment(Base):
     # id = Column(Integer, primary_key=True)
     com_id = Column(String, primary_key=True)   # reddit comment ID
     subreddit_id = Column(String)           # reddit subreddit ID
-    parent_id = Column(String)              # reddit parent ID (submission, or other comment)
+    parent_id = Column(String, index=True)  # reddit parent ID (submission, or other comment)
     timestamp = Column(DateTime)            # post time
 
     # Relationship: reference submission, user
-    sub_id = Column(String, ForeignKey('submissions.sub_id'))
-    user_name = Column(String, ForeignKey('users.name')) # reddit author.name
+    sub_id = Column(String, ForeignKey('submissions.sub_id'), index=True)
+    user_name = Column(String, ForeignKey('users.name'), index=True) # reddit author.name
 
     # Core data
     text = Column(String, nullable=False)
@@ -155,25 +244,41 @@ class Comment(Base):
     is_root = Column(Boolean)       # top-level comment
     num_replies = Column(Integer)   # number of immediate replies
     convo_depth = Column(Integer)   # max comment tree depth
+    depth = Column(Integer)         # distance from submission; top-level is 1
+    subtree_size = Column(Integer)  # comments in this subtree, including itself
+    dup_of = Column(String)         # earlier near-duplicate comment, see textnorm
+    path = Column(String)           # materialized path of ancestor IDs, see threadindex
 
     # URL info
     permalink = Column(String)
 
+    # Subtrees are ranges of the (sub_id, path) index
+    __table_args__ = (Index('ix_comments_sub_path', 'sub_id', 'path'),)
+
     ##
-    # WARNING: right now this requests c.submission.fullname
-    # if the submission is not cached by PRAW, this may result
-    # in additional API calls.
+    # If sub_id is not given, it is taken from the comment's link_id;
+    # only comments without one fall back to c.submission.fullname, which
+    # may result in additional API calls if PRAW has not cached the
+    # submission.
     def __init__(self, praw_obj=None, sub_id=None,
                  rank=None, num_replies=0, convo_depth=1, 
-                 **kwargs):
+                 depth=1, subtree_size=1, **kwargs):
         if not praw_obj: 
-            return super(Comment, self).__init__(**kwargs)
+            # Column values given by name win over the tree metric defaults
+            if rank is not None:
+                kwargs.setdefault('best_rank', rank)
+            kwargs.setdefault('num_replies', num_replies)
+            kwargs.setdefault('convo_depth', convo_depth)
+            kwargs.setdefault('depth', depth)
+            kwargs.setdefault('subtree_size', subtree_size)
+            return super(Comment, self).__init__(sub_id=sub_id, **kwargs)
     
         # If a PRAW submission object is given
         c = praw_obj
         
         self.com_id = c.fullname    # full identifier: type_id
-        self.sub_id = c.submission.fullname     # submission id
+        self.sub_id = sub_id or getattr(c, 'link_id', None) \
+                      or c.submission.fullname          # submission id
         self.user_name = get_author_name(c)     # reddit author.name        
         self.subreddit_id = c.subreddit_id      # subreddit identifier
         self.parent_id = c.parent_id            # parent identifier
@@ -191,6 +296,8 @@ class Comment(Base):
         self.is_root = c.is_root
         self.num_replies = num_replies
         self.convo_depth = convo_depth
+        self.depth = depth
+        self.subtree_size = subtree_size
 
         self.permalink = c.permalink
 
@@ -257,7 +364,9 @@ class UserActivity(Base):
 
     # Enforce constraint that (subreddit_id,subreddit_name) must match a subreddit entry
     __table_args__ = (ForeignKeyConstraint([subreddit_id, subreddit_name], 
-                                           ['subreddits.subreddit_id','subreddits.name']),)
+                                           ['subreddits.subreddit_id','subreddits.name']),
+                      Index('ix_user_activities_user_subreddit',
+                            user_name, subreddit_id))
 
     # set up many->one relation to subreddits
     subreddit = relation("Subreddit", backref="activities",
@@ -334,3 +443,151 @@ class UserActivity(Base):
         return "UserActivity(%s, %s, %s)" % (self.user_name,
                                              self.subreddit_id,
                                              self.subreddit_name)
+
+
+# Output: user_activities as a selectable named `name`, with only the
+# latest row (highest id) of each (user_name, subreddit_id). Nothing makes
+# the pair unique, and reruns of older crawls stored some twice; joining
+# the table directly would repeat the rows joined to them.
+def latest_activity(name):
+    a = UserActivity.__table__
+    b = a.alias()
+    newer = select([b.c.id]).where(and_(b.c.user_name == a.c.user_name,
+                                        b.c.subreddit_id == a.c.subreddit_id,
+                                        b.c.id > a.c.id))
+    return a.select().where(~exists(newer)).alias(name)
+
+
+
+class UserHistory(Base):
+    __tablename__ = 'user_histories'
+
+    # Raw history from the user's last 1000 comments and submissions,
+    # cached so activity stats can be rebuilt without refetching
+    user_name = Column(String, ForeignKey('users.name'), primary_key=True)
+    timestamp = Column(DateTime)            # fetch time
+    comments = Column(LargeBinary)          # see pack_history
+    submissions = Column(LargeBinary)
+
+    def __repr__(self):
+        return "UserHistory(%s): fetched %s" % (self.user_name, self.timestamp)
+
+
+class CrawlState(Base):
+    __tablename__ = 'crawl_state'
+
+    # One row per (subreddit, flair) crawl; flair is '' if unfiltered
+    subreddit_id = Column(String, ForeignKey('subreddits.subreddit_id'),
+                          primary_key=True)
+    flair = Column(String, primary_key=True)
+
+    # Progress
+    last_sub_id = Column(String)        # last submission fully processed
+    position = Column(Integer)          # search results walked so far
+    comment_count = Column(Integer)     # comments stored so far
+    timestamp = Column(DateTime)        # last update
+    completed = Column(Boolean)         # walked the whole listing
+
+    def __repr__(self):
+        return "CrawlState(%s, '%s'): %s after %s" % (self.subreddit_id,
+                                                    self.flair,
+                                                    self.position,
+                                                    self.last_sub_id)
+
+
+class SubmissionState(Base):
+    __tablename__ = 'submission_state'
+
+    sub_id = Column(String, ForeignKey('submissions.sub_id'), primary_key=True)
+    num_comments = Column(Integer)      # reddit's comment count when fetched
+    comment_count = Column(Integer)     # comments stored
+    timestamp = Column(DateTime)        # fetch time
+
+    def __repr__(self):
+        return "SubmissionState(%s): %s comments at %s" % (self.sub_id,
+                                                           self.num_comments,
+                                                           self.timestamp)
+
+
+class ScoreSnapshot(Base):
+    __tablename__ = 'score_snapshots'
+
+    # Score changes seen by snapshot polls (see snapshot.py). A thing's
+    # first snapshot has every value; later ones only the values that
+    # changed, the others NULL. Bit i of `changed` is set if the i-th
+    # value (snapshot.SNAPSHOT_FIELDS) is stored, so a value that became
+    # NULL can be told apart; rows written before it existed have NULL
+    # there, and only their non-NULL values changed.
+    thing_id = Column(String, primary_key=True)     # comment or submission fullname
+    timestamp = Column(DateTime, primary_key=True)  # poll time
+    score = Column(Integer)
+    ups = Column(Integer)
+    downs = Column(Integer)
+    best_rank = Column(Integer)
+    changed = Column(Integer)                       # bitmask of stored values
+
+    def __repr__(self):
+        return "ScoreSnapshot(%s, %s): %s" % (self.thing_id, self.timestamp,
+                                              self.score)
+
+
+class SnapshotSchedule(Base):
+    __tablename__ = 'snapshot_schedule'
+
+    sub_id = Column(String, ForeignKey('submissions.sub_id'), primary_key=True)
+    created = Column(DateTime)              # submission post time
+    next_poll = Column(DateTime, index=True) # NULL once no longer tracked
+    interval = Column(Float)                # seconds between polls
+    last_poll = Column(DateTime)
+    polls = Column(Integer)
+    last_values = Column(LargeBinary)       # {fullname: [score, ups, downs,
+                                            #  best_rank]}, see pack_history
+
+    def __repr__(self):
+        return "SnapshotSchedule(%s): next poll %s" % (self.sub_id, self.next_poll)
+
+
+class CommentFeatures(Base):
+    __tablename__ = 'comment_features'
+
+    # Ranking features of each comment, materialized by features.py from
+    # comments, submissions and user activity. Ranks and percentiles are
+    # within the comment's submission.
+    com_id = Column(String, ForeignKey('comments.com_id'), primary_key=True)
+    sub_id = Column(String, ForeignKey('submissions.sub_id'), index=True)
+    score = Column(Integer)
+    score_rank = Column(Integer)    # 1 for the highest score; ties share a rank
+    score_pct = Column(Float)       # fraction of the submission's comments scoring lower
+    best_rank = Column(Integer)
+    age = Column(Float)             # seconds from the submission's post time
+    age_rank = Column(Integer)      # 1 for the earliest comment
+    depth = Column(Integer)
+    num_replies = Column(Integer)
+    subtree_size = Column(Integer)
+    is_op = Column(Boolean)         # posted by the submission's author
+    sub_comments = Column(Integer)  # comments stored for the submission
+
+    # Author's comment karma in the comment's subreddit, and across reddit
+    user_comment_karma = Column(Integer)
+    user_avg_comment_karma = Column(Float)
+    user_global_comment_karma = Column(Integer)
+    user_global_avg_comment_karma = Column(Float)
+
+    def __repr__(self):
+        return "CommentFeatures(%s): rank %s of %s" % (self.com_id, self.score_rank,
+                                                       self.sub_comments)
+
+
+class FeatureBuild(Base):
+    __tablename__ = 'feature_builds'
+
+    # When each submission's features were last built, and a signature of
+    # the rows they were built from (see features.py)
+    sub_id = Column(String, ForeignKey('submissions.sub_id'), primary_key=True)
+    signature = Column(String)
+    rows = Column(Integer)
+    timestamp = Column(DateTime)            # build time
+
+    def __repr__(self):
+        return "FeatureBuild(%s): %s rows at %s" % (self.sub_id, self.rows,
+                                                    self.timestamp)
@@ -0,0 +1,93 @@
+##
+# Social Web Comment Ranking
+#
+# Concurrency helpers for crawling: a shared token-bucket
+# rate limiter and a bounded worker pool
+##
+
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from time import sleep, time
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket.
+
+    Tokens accrue at `rate` per second up to `capacity`; acquire() blocks
+    until one is available. Over any window of T seconds at most
+    capacity + rate * T tokens are handed out, so a bucket shared by every
+    worker keeps the whole crawl inside the API quota.
+    """
+
+    def __init__(self, rate, capacity=1):
+        self.rate = float(rate)
+        self.capacity = float(capacity)
+        self._tokens = float(capacity)
+        self._last = time()
+        self._lock = threading.Lock()
+
+        self.acquired = 0
+        self.wait_time = 0.0
+
+    def acquire(self, tokens=1):
+        waited = 0.0
+        while True:
+            with self._lock:
+                now = time()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._last) * self.rate)
+                self._last = now
+                if self._tokens >= tokens:
+                    self._tokens -= tokens
+                    self.acquired += tokens
+                    self.wait_time += waited
+                    return waited
+                delay = (tokens - self._tokens) / self.rate
+            sleep(delay)
+            waited += delay
+
+    # Output: bucket statistics, for the metrics file
+    def stats(self):
+        return {'acquired': self.acquired, 'wait_time': self.wait_time}
+
+    def pause(self, seconds):
+        """Hand out no tokens for the next `seconds`, e.g. until the
+        server's rate-limit window resets."""
+        with self._lock:
+            self._tokens = min(self._tokens, -seconds * self.rate)
+
+
+# Input: function of one item, iterable of items, number of worker threads
+# Output: generator of (item, fn(item)) pairs, in completion order
+#
+# Items are pulled from the iterable lazily on the calling thread, and at
+# most max_pending calls are in flight at once. Results are yielded back on
+# the calling thread, so it can own the database writer.
+def bounded_map(fn, items, workers, max_pending=None):
+    if workers <= 1:
+        for item in items:
+            yield item, fn(item)
+        return
+
+    if max_pending is None:
+        max_pending = 2 * workers
+
+    pool = ThreadPoolExecutor(max_workers=workers)
+    pending = {}
+    try:
+        for item in items:
+            pending[pool.submit(fn, item)] = item
+            if len(pending) < max_pending:
+                continue
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield pending.pop(future), future.result()
+    finally:
+        for future in pending:
+            future.cancel()
+        pool.shutdown(wait=True)
@@ -0,0 +1,115 @@
+##
+# Social Web Comment Ranking
+#
+# Crawl progress tracking: resumable and incremental crawls
+##
+
+from datetime import datetime
+
+import commentDB
+
+
+class CrawlTracker(object):
+    """Records crawl progress through the BulkWriter and decides which
+    submissions still need their comment trees fetched.
+
+    A submission row is only written after all of its comments have been
+    queued, so a stored submission always has a complete tree: an
+    interrupted crawl resumes by skipping stored submissions. In
+    incremental mode stored submissions are fetched again if reddit's
+    comment count or edit time changed since the last fetch.
+    """
+
+    def __init__(self, session, writer, incremental=False, restart=False):
+        self.writer = writer
+        self.incremental = incremental
+        self.restart = restart
+
+        # sub_id -> (num_comments, fetch time, comments stored), in one scan
+        self._fetched = {}
+        for s in session.query(commentDB.SubmissionState):
+            self._fetched[s.sub_id] = (s.num_comments, s.timestamp,
+                                       s.comment_count or 0)
+
+        # Detached, so progress updates only reach the DB via the writer
+        self._states = {}
+        for c in session.query(commentDB.CrawlState):
+            session.expunge(c)
+            self._states[(c.subreddit_id, c.flair)] = c
+
+    # Output: every CrawlState loaded or started so far
+    def states(self):
+        return list(self._states.values())
+
+    # Output: CrawlState of the latest crawl of this subreddit and flair,
+    # or None; call before start() to see the previous crawl
+    def previous(self, subreddit_id, flair):
+        return self._states.get((subreddit_id, flair or ''))
+
+    # Output: CrawlState for this subreddit and flair, or None if the
+    # crawl already completed and there is nothing to resume
+    def start(self, subreddit_id, flair):
+        flair = flair or ''
+        state = self._states.get((subreddit_id, flair))
+        if state is not None and state.completed \
+                and not (self.incremental or self.restart):
+            print('Crawl of %s flair \'%s\' already complete, skipping' %
+                  (subreddit_id, flair))
+            return None
+
+        if state is None or state.completed or self.restart:
+            state = commentDB.CrawlState(subreddit_id=subreddit_id, flair=flair,
+                                         position=0, comment_count=0,
+                                         completed=False)
+            self._states[(subreddit_id, flair)] = state
+        else:
+            print('Resuming crawl of %s flair \'%s\' after %d submissions (%s)' %
+                  (subreddit_id, flair, state.position, state.last_sub_id))
+        state.position = 0
+        return state
+
+    # Input: PRAW submission, whether its row is already stored
+    # Output: True if its comment tree should be fetched
+    def needs_fetch(self, submission, stored):
+        if not stored:
+            return True
+        if not self.incremental:
+            return False
+
+        prev = self._fetched.get(submission.fullname)
+        if prev is None:
+            return True     # stored before crawl state was tracked
+        num_comments, fetched, _ = prev
+        if submission.num_comments != num_comments:
+            return True
+        edited = submission.edited
+        return bool(edited) and datetime.utcfromtimestamp(edited) > fetched
+
+    def skipped(self, state):
+        state.position += 1
+
+    # Record a submission whose comments have all been queued for writing.
+    # comment_count only counts comments new in this fetch, so a refetch
+    # adds them to the count stored by earlier fetches.
+    def done(self, state, submission, comment_count):
+        now = datetime.utcnow()
+        prev = self._fetched.get(submission.fullname)
+        stored = (prev[2] if prev is not None else 0) + comment_count
+        self._fetched[submission.fullname] = (submission.num_comments, now, stored)
+        self.writer.merge(commentDB.SubmissionState(
+            sub_id=submission.fullname,
+            num_comments=submission.num_comments,
+            comment_count=stored,
+            timestamp=now))
+
+        state.position += 1
+        state.last_sub_id = submission.fullname
+        state.comment_count += comment_count
+        state.timestamp = now
+        self.writer.merge(state)
+
+    def finish(self, state):
+        state.completed = True
+        state.timestamp = datetime.utcnow()
+        self.writer.merge(state)
+
@@ -0,0 +1,273 @@
+##
+# Social Web Comment Ranking
+#
+# Buffered bulk writer for commentDB models
+##
+
+from collections import defaultdict
+from itertools import groupby
+from time import time
+
+from sqlalchemy.exc import OperationalError
+
+import commentDB
+from idcache import CACHE_SIZE, VALUE_COLUMNS, IdentityCache
+from instrument import metrics
+
+# High-volume tables whose cache misses, once keys have been evicted, are
+# taken as new rows rather than checked against the database: INSERT OR
+# IGNORE drops the rare duplicate, which is then counted as written
+UNVERIFIED_TABLES = ('comments', 'users')
+
+
+class BulkWriter(object):
+    """Collects commentDB models and writes them in batched transactions.
+
+    Models are de-duplicated in memory against the primary keys already
+    known, held in a bounded IdentityCache per table (warmed from the
+    database the first time a table is touched), then flushed with a
+    single INSERT OR IGNORE per table, all inside one transaction. Use
+    merge() for rows that should overwrite an existing entry (INSERT OR
+    REPLACE).
+
+    A batch the database rejects is written in halves, down to the rows
+    that fail on their own; those are set aside in `rejected` as
+    (table name, row, error) and the crawl carries on.
+    """
+
+    def __init__(self, session, batch_size=1000, cache_size=CACHE_SIZE):
+        self.session = session
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+
+        self._inserts = defaultdict(list)   # table name -> row dicts
+        self._merges = defaultdict(list)    # table name -> row dicts
+        self._pending = 0
+        self._known = {}                    # table name -> IdentityCache
+
+        # Write statistics
+        self.started = time()
+        self.flushes = 0
+        self.rows_written = defaultdict(int)
+        self.write_time = defaultdict(float)
+        self.duplicates = defaultdict(int)
+        self.commit_time = 0.0
+        self.rejected = []
+
+    def _known_keys(self, table):
+        if table.name not in self._known:
+            self._known[table.name] = IdentityCache(
+                self.session, table, self.cache_size,
+                verify=table.name not in UNVERIFIED_TABLES).warm()
+        return self._known[table.name]
+
+    # Warm the identity caches of these models' tables now, rather than
+    # when each is first touched
+    def warm(self, *models):
+        for model in models:
+            self._known_keys(model.__table__)
+
+    def _row(self, table, model):
+        row = {}
+        for col in table.columns:
+            value = getattr(model, col.name)
+            if value is None and col.primary_key:
+                continue    # let SQLite assign autoincrement IDs
+            row[col.name] = value
+        return row
+
+    def _primary_key(self, table, row):
+        cols = list(table.primary_key.columns)
+        key = tuple(row.get(c.name) for c in cols)
+        if None in key:
+            return None     # no natural key (e.g. UserActivity): never a duplicate
+        return key[0] if len(key) == 1 else key
+
+    def _cached_value(self, table, row):
+        column = VALUE_COLUMNS.get(table.name)
+        return row.get(column, True) if column else True
+
+    def _buffer(self, buf, table, row):
+        buf[table.name].append(row)
+        self._pending += 1
+        if self._pending >= self.batch_size:
+            self.flush()
+
+    # Output: True if the model's primary key is already stored or queued
+    def contains(self, model):
+        table = model.__table__
+        key = self._primary_key(table, self._row(table, model))
+        return key is not None and key in self._known_keys(table)
+
+    # Output: True if a row with this primary key is already stored or
+    # queued; cheaper than contains() in hot loops, as no model is built
+    def known(self, model, key):
+        return key in self._known_keys(model.__table__)
+
+    # Output: sub_id of the stored or queued comment, or None if unknown
+    def submission_of(self, com_id):
+        sub_id = self._known_keys(commentDB.Comment.__table__).get(com_id)
+        return sub_id if sub_id is not True else None
+
+    # Input: commentDB model
+    # Output: True if the model was queued, False if its primary key is already known
+    def add(self, model):
+        table = model.__table__
+        row = self._row(table, model)
+        key = self._primary_key(table, row)
+        if key is not None:
+            known = self._known_keys(table)
+            if key in known:
+                self.duplicates[table.name] += 1
+                return False
+            known.add(key, self._cached_value(table, row))
+        self._buffer(self._inserts, table, row)
+        return True
+
+    # Queue a model to be inserted or to replace the existing row
+    def merge(self, model):
+        table = model.__table__
+        row = self._row(table, model)
+        key = self._primary_key(table, row)
+        if key is not None:
+            self._known_keys(table).add(key, self._cached_value(table, row))
+        self._buffer(self._merges, table, row)
+
+    # Queue a row of an append-only table (e.g. ScoreSnapshot), with no
+    # de-duplication against known keys
+    def append(self, model):
+        table = model.__table__
+        self._buffer(self._inserts, table, self._row(table, model))
+
+    # Output: writer for this submission's rows; a BulkWriter is a single
+    # shard (see storage.ShardedWriter)
+    def shard(self, submission):
+        return self
+
+    # Output: sessions of every database rows are written to
+    def sessions(self):
+        return [self.session]
+
+    @property
+    def pending(self):
+        return self._pending
+
+    # Output: write statistics, for the metrics file
+    def stats(self):
+        return {'flushes': self.flushes,
+                'commit_time': self.commit_time,
+                'rows_written': dict(self.rows_written),
+                'write_time': dict(self.write_time),
+                'duplicates': dict(self.duplicates),
+                'rejected': len(self.rejected),
+                'id_cache': dict((name, ids.stats())
+                                 for name, ids in self._known.items())}
+
+    def flush(self):
+        if self._pending == 0:
+            return
+        with metrics.stage('flush'):
+            entries = self._entries()
+            try:
+                self._write(entries)
+            except OperationalError:
+                print('ERROR: Unable to commit batch of %d rows to database; '
+                      'it stays queued.' % self._pending)
+                raise
+            except Exception as e:
+                print('ERROR: Unable to commit batch of %d rows to database (%s); '
+                      'writing it in parts.' % (self._pending, e))
+                self._write_parts(entries)
+            self._inserts, self._merges = defaultdict(list), defaultdict(list)
+            self._pending = 0
+            for ids in self._known.values():
+                ids.flushed()
+            self.flushes += 1
+
+    # Output: [(table, prefix, row)] of every queued row, parents before
+    # children so foreign keys resolve
+    def _entries(self):
+        entries = []
+        for table in commentDB.Base.metadata.sorted_tables:
+            for buf, prefix in ((self._inserts, 'OR IGNORE'), (self._merges, 'OR REPLACE')):
+                entries.extend((table, prefix, row) for row in buf.get(table.name, ()))
+        return entries
+
+    # Writes the rows in one transaction, rolled back if anything fails
+    def _write(self, entries):
+        written = defaultdict(int)
+        timings = defaultdict(float)
+        try:
+            for _, group in groupby(entries, key=lambda e: (e[0].name, e[1])):
+                group = list(group)
+                table, prefix = group[0][0], group[0][1]
+                start = time()
+                self.session.execute(table.insert().prefix_with(prefix),
+                                     [row for _, _, row in group])
+                timings[table.name] += time() - start
+                written[table.name] += len(group)
+            start = time()
+            self.session.commit()
+            self.commit_time += time() - start
+        except BaseException:
+            self.session.rollback()
+            raise
+        for name in written:
+            self.rows_written[name] += written[name]
+            self.write_time[name] += timings[name]
+
+    # Writes a failed batch in halves, setting aside rows that fail alone.
+    # If the database itself fails (locked, disk full), the rows not yet
+    # written stay queued and the error is raised.
+    def _write_parts(self, entries):
+        parts = [entries]
+        while parts:
+            part = parts.pop()
+            try:
+                self._write(part)
+            except OperationalError:
+                self._requeue([e for p in reversed(parts + [part]) for e in p])
+                raise
+            except Exception as e:
+                if len(part) > 1:
+                    middle = len(part) // 2
+                    parts.extend((part[middle:], part[:middle]))
+                    continue
+                table, _, row = part[0]
+                print('ERROR: Skipping %s row that could not be written (%s): %r' %
+                      (table.name, e, row))
+                self.rejected.append((table.name, row, str(e)))
+                key = self._primary_key(table, row)
+                if key is not None:
+                    self._known_keys(table).discard(key)
+
+    def _requeue(self, entries):
+        self._inserts, self._merges = defaultdict(list), defaultdict(list)
+        for table, prefix, row in entries:
+            buf = self._inserts if prefix == 'OR IGNORE' else self._merges
+            buf[table.name].append(row)
+        self._pending = len(entries)
+
+    def close(self):
+        self.flush()
+
+    def report(self):
+        elapsed = time() - self.started
+        print('Wrote %d batches in %.1fs (%.2fs committing)' %
+              (self.flushes, elapsed, self.commit_time))
+        for name in sorted(set(self.rows_written) | set(self.duplicates)):
+            rows = self.rows_written[name]
+            write_rate = rows / self.write_time[name] if self.write_time[name] else 0.0
+            print('  %-16s %8d rows  %9.1f rows/s overall  %10.1f rows/s writing  '
+                  '%6d duplicates skipped' %
+                  (name, rows, rows / elapsed if elapsed else 0.0,
+                   write_rate, self.duplicates[name]))
+        if self.rejected:
+            print('  %d rows could not be written and were skipped' % len(self.rejected))
+        for name, ids in sorted(self._known.items()):
+            stats = ids.stats()
+            print('  %-16s %5.1f%% id cache hits (%d of %d)  %8d keys  '
+                  '%6d evicted  %6d queries' %
+                  (name, 100 * stats['hit_rate'], stats['hits'],
+                   stats['hits'] + stats['misses'], stats['size'],
+                   stats['evictions'], stats['queries']))
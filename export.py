@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+##
+# Social Web Comment Ranking
+#
+# Streaming export of the comment corpus to columnar files
+##
+
+import json
+import os
+from argparse import ArgumentParser
+from datetime import datetime
+
+import numpy as np
+from sqlalchemy import and_, func, select, text
+
+import commentDB
+
+EPOCH = datetime(1970, 1, 1)
+
+# Integer columns use -1 for NULL; float columns use NaN
+INT_NULL = -1
+
+
+def _export_columns():
+    c = commentDB.Comment.__table__
+    s = commentDB.Submission.__table__
+    a = commentDB.latest_activity('activity')
+    g = commentDB.latest_activity('global_activity')
+
+    # (output name, SQL expression, kind)
+    columns = [
+        ('com_id', c.c.com_id, 'text'),
+        ('sub_id', c.c.sub_id, 'text'),
+        ('parent_id', c.c.parent_id, 'text'),
+        ('user_name', c.c.user_name, 'text'),
+        ('text', c.c.text, 'text'),
+        ('timestamp', c.c.timestamp, 'time'),
+        ('score', c.c.score, 'int'),
+        ('ups', c.c.ups, 'int'),
+        ('downs', c.c.downs, 'int'),
+        ('best_rank', c.c.best_rank, 'int'),
+        ('gilded', c.c.gilded, 'int'),
+        ('is_root', c.c.is_root, 'int'),
+        ('num_replies', c.c.num_replies, 'int'),
+        ('convo_depth', c.c.convo_depth, 'int'),
+        ('depth', c.c.depth, 'int'),
+        ('subtree_size', c.c.subtree_size, 'int'),
+        ('sub_timestamp', s.c.timestamp, 'time'),
+        ('sub_score', s.c.score, 'int'),
+        ('sub_user_name', s.c.user_name, 'text'),
+    ]
+    for prefix, act in (('user_', a), ('user_global_', g)):
+        for field in ('comment_count', 'comment_net_karma', 'comment_avg_net_karma',
+                      'sub_count', 'sub_net_karma', 'sub_avg_net_karma'):
+            columns.append((prefix + field, act.c[field], 'float'))
+
+    # Author activity in the comment's subreddit, and across reddit
+    joined = c.join(s, s.c.sub_id == c.c.sub_id). \
+               outerjoin(a, and_(a.c.user_name == c.c.user_name,
+                                 a.c.subreddit_id == c.c.subreddit_id)). \
+               outerjoin(g, and_(g.c.user_name == c.c.user_name,
+                                 g.c.subreddit_id == 'GLOBAL'))
+    query = select([expr.label(name) for name, expr, _ in columns]). \
+            select_from(joined).order_by(c.c.sub_id, c.c.com_id)
+    return columns, query
+
+
+def _convert(kind, values):
+    if kind == 'int':
+        return np.array([INT_NULL if v is None else int(v) for v in values],
+                        dtype=np.int64)
+    if kind == 'float':
+        return np.array([np.nan if v is None else v for v in values],
+                        dtype=np.float64)
+    if kind == 'time':
+        return np.array([INT_NULL if v is None else int((v - EPOCH).total_seconds())
+                         for v in values], dtype=np.int64)
+    return [u'' if v is None else v for v in values]
+
+
+def _chunks(conn, query, chunk_size):
+    result = conn.execution_options(stream_results=True).execute(query)
+    while True:
+        rows = result.fetchmany(chunk_size)
+        if not rows:
+            break
+        yield rows
+
+
+class _NpyWriter(object):
+    """Numeric columns go to memory-mapped .npy files sized up front; text
+    columns go to <name>.bin (concatenated UTF-8) plus <name>.offsets.npy,
+    so row i is bin[offsets[i]:offsets[i+1]]."""
+
+    def __init__(self, outdir, columns, n_rows):
+        self.n = 0
+        self.n_rows = n_rows
+        self.arrays = {}
+        self.text = {}
+        for name, _, kind in columns:
+            if kind == 'text':
+                offsets = np.lib.format.open_memmap(
+                    os.path.join(outdir, name + '.offsets.npy'), mode='w+',
+                    dtype=np.int64, shape=(n_rows + 1,))
+                offsets[0] = 0
+                self.text[name] = (open(os.path.join(outdir, name + '.bin'), 'wb'),
+                                   offsets)
+            else:
+                self.arrays[name] = np.lib.format.open_memmap(
+                    os.path.join(outdir, name + '.npy'), mode='w+',
+                    dtype=np.float64 if kind == 'float' else np.int64,
+                    shape=(n_rows,))
+
+    def write(self, chunk):
+        n = len(chunk[next(iter(chunk))])
+        if self.n + n > self.n_rows:
+            raise ValueError('Export has more than the %d rows counted' % self.n_rows)
+        for name, array in self.arrays.items():
+            array[self.n:self.n + n] = chunk[name]
+        for name, (f, offsets) in self.text.items():
+            end = offsets[self.n]
+            for i, value in enumerate(chunk[name]):
+                data = value.encode('utf-8')
+                f.write(data)
+                end += len(data)
+                offsets[self.n + i + 1] = end
+        self.n += n
+
+    def close(self):
+        for array in self.arrays.values():
+            array.flush()
+        for f, offsets in self.text.values():
+            f.close()
+            offsets.flush()
+
+
+class _ParquetWriter(object):
+    def __init__(self, outdir):
+        import pyarrow
+        import pyarrow.parquet
+        self.pa = pyarrow
+        self.pq = pyarrow.parquet
+        self.path = os.path.join(outdir, 'comments.parquet')
+        self.writer = None
+
+    def write(self, chunk):
+        table = self.pa.Table.from_pydict(chunk)
+        if self.writer is None:
+            self.writer = self.pq.ParquetWriter(self.path, table.schema)
+        self.writer.write_table(table)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+# Input: engine, output directory, format ('npy' or 'parquet')
+# Output: number of rows written
+#
+# Streams comments joined with their submission and author activity,
+# chunk_size rows at a time, so memory use does not grow with the DB.
+# The npy files are sized from a count taken in the same read transaction
+# as the rows, so a crawl writing meanwhile cannot change them in between;
+# if the two still differ, the export fails.
+def export_corpus(engine, outdir, fmt='npy', chunk_size=50000):
+    columns, query = _export_columns()
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+
+    conn = engine.connect()
+    transaction = conn.begin()
+    writer = None
+    n = 0
+    try:
+        if engine.dialect.name == 'sqlite':
+            conn.execute(text('BEGIN'))     # pysqlite only begins before writes
+        if fmt == 'parquet':
+            writer = _ParquetWriter(outdir)
+        else:
+            n_rows = conn.execute(select([func.count()]).
+                                  select_from(query.alias('corpus'))).scalar()
+            writer = _NpyWriter(outdir, columns, n_rows)
+
+        for rows in _chunks(conn, query, chunk_size):
+            chunk = {}
+            for i, (name, _, kind) in enumerate(columns):
+                chunk[name] = _convert(kind, [r[i] for r in rows])
+            writer.write(chunk)
+            n += len(rows)
+            print('Exported %d comments' % n)
+        if fmt != 'parquet' and n != n_rows:
+            raise ValueError('Exported %d rows, but counted %d' % (n, n_rows))
+    finally:
+        if writer is not None:
+            writer.close()
+        transaction.rollback()
+        conn.close()
+
+    with open(os.path.join(outdir, 'manifest.json'), 'w') as f:
+        json.dump({'format': fmt, 'rows': n, 'int_null': INT_NULL,
+                   'columns': [[name, kind] for name, _, kind in columns]},
+                  f, indent=2)
+    return n
+
+
+class TextColumn(object):
+    """Memory-mapped text column from an npy export."""
+
+    def __init__(self, outdir, name):
+        self.offsets = np.load(os.path.join(outdir, name + '.offsets.npy'),
+                               mmap_mode='r')
+        self.data = np.memmap(os.path.join(outdir, name + '.bin'),
+                              dtype=np.uint8, mode='r') \
+                    if self.offsets[-1] > 0 else np.zeros(0, dtype=np.uint8)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        return self.data[self.offsets[i]:self.offsets[i + 1]].tobytes().decode('utf-8')
+
+
+# Output: dict of column name -> memory-mapped array or TextColumn
+def load_corpus(outdir):
+    with open(os.path.join(outdir, 'manifest.json')) as f:
+        manifest = json.load(f)
+    corpus = {}
+    for name, kind in manifest['columns']:
+        if kind == 'text':
+            corpus[name] = TextColumn(outdir, name)
+        else:
+            corpus[name] = np.load(os.path.join(outdir, name + '.npy'), mmap_mode='r')
+    return corpus
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Export the comment corpus to columnar files')
+    parser.add_argument('-d', '--dbfile', type=str,
+                        default='redditDB.sqlite',
+                        help="SQLite database file to export.")
+    parser.add_argument('-o', '--outdir', type=str, default='corpus',
+                        help="Directory to write the export to.")
+    parser.add_argument('--format', type=str, choices=['npy', 'parquet'],
+                        default='npy')
+    parser.add_argument('--chunk-size', dest='chunk_size', type=int, default=50000)
+    args = parser.parse_args()
+
+    engine = commentDB.make_engine(args.dbfile)
+    export_corpus(engine, args.outdir, fmt=args.format, chunk_size=args.chunk_size)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python
+##
+# Social Web Comment Ranking
+#
+# Materialized ranking features: per-comment aggregates over its
+# submission and author, rebuilt incrementally as comments change
+##
+
+import hashlib
+from argparse import ArgumentParser
+from collections import defaultdict
+from datetime import datetime
+from time import time
+
+import numpy as np
+from sqlalchemy import and_, select
+
+import commentDB
+
+# Submissions rebuilt per transaction; also keeps IN (...) lists within
+# SQLite's bound parameter limit
+SUBMISSION_BATCH = 400
+
+
+def _tables():
+    c = commentDB.Comment.__table__
+    s = commentDB.Submission.__table__
+    a = commentDB.latest_activity('activity')
+    g = commentDB.latest_activity('global_activity')
+
+    # Author activity in the comment's subreddit, and across reddit
+    joined = c.join(s, s.c.sub_id == c.c.sub_id). \
+               outerjoin(a, and_(a.c.user_name == c.c.user_name,
+                                 a.c.subreddit_id == c.c.subreddit_id)). \
+               outerjoin(g, and_(g.c.user_name == c.c.user_name,
+                                 g.c.subreddit_id == 'GLOBAL'))
+    return c, s, a, g, joined
+
+
+# Output: query of every input of each comment's features, one row per
+# comment: (com_id, sub_id, ...) as compute_features expects
+def _inputs_query():
+    c, s, a, g, joined = _tables()
+    return select([c.c.com_id, c.c.sub_id, c.c.score, c.c.best_rank, c.c.timestamp,
+                   c.c.depth, c.c.num_replies, c.c.subtree_size, c.c.user_name,
+                   s.c.timestamp, s.c.user_name,
+                   a.c.comment_net_karma, a.c.comment_avg_net_karma,
+                   g.c.comment_net_karma, g.c.comment_avg_net_karma]). \
+           select_from(joined)
+
+
+# Input: rows of _inputs_query, in any order
+# Output: {sub_id: signature} of each submission's inputs
+#
+# A signature is the comment count and the sum, modulo 2^64, of a hash of
+# each comment's inputs, so it does not depend on row order, and any
+# change to one comment changes it; changes to different comments cannot
+# cancel out as they could in sums of the raw values.
+def _signatures(rows):
+    count = defaultdict(int)
+    total = defaultdict(int)
+    for row in rows:
+        sub_id = row[1]
+        digest = hashlib.sha1(repr(tuple(row)).encode('utf-8')).hexdigest()
+        count[sub_id] += 1
+        total[sub_id] = (total[sub_id] + int(digest[:16], 16)) % 2 ** 64
+    return dict((sub_id, '%d:%016x' % (count[sub_id], total[sub_id]))
+                for sub_id in count)
+
+
+def _rows_query(sub_ids):
+    c = commentDB.Comment.__table__
+    return _inputs_query().where(c.c.sub_id.in_(sub_ids)). \
+           order_by(c.c.sub_id, c.c.com_id)
+
+
+# Input: rows of _rows_query, grouped by submission
+# Output: list of comment_features row dicts
+#
+# Ranks are computed for the whole batch at once: each comment's score is
+# keyed by its submission, so one sort of the keys gives every comment
+# the number of comments scoring below and above it in its submission.
+def compute_features(rows):
+    n = len(rows)
+    if not n:
+        return []
+    sub_ids = [r[1] for r in rows]
+    group = np.zeros(n, dtype=np.int64)
+    group[1:] = np.cumsum([b != a for a, b in zip(sub_ids, sub_ids[1:])])
+    counts = np.bincount(group)
+    start = np.concatenate(([0], np.cumsum(counts)[:-1]))[group]
+    size = counts[group]
+
+    score = np.array([r[2] or 0 for r in rows], dtype=np.int64)
+    key = (group << 32) | (score - score.min())
+    ordered = np.sort(key)
+    below = np.searchsorted(ordered, key, 'left') - start
+    above = start + size - np.searchsorted(ordered, key, 'right')
+    score_rank = (above + 1).tolist()
+    score_pct = (below / size.astype(np.float64)).tolist()
+
+    age = np.array([(r[4] - r[9]).total_seconds() if r[4] and r[9] else np.nan
+                    for r in rows])
+    position = np.empty(n, dtype=np.int64)
+    position[np.lexsort((age, group))] = np.arange(n)     # NaN ages last
+    age_rank = (position - start + 1).tolist()
+    size = size.tolist()
+
+    features = []
+    for i, r in enumerate(rows):
+        features.append({'com_id': r[0], 'sub_id': r[1], 'score': r[2],
+                         'score_rank': score_rank[i], 'score_pct': score_pct[i],
+                         'best_rank': r[3],
+                         'age': None if np.isnan(age[i]) else float(age[i]),
+                         'age_rank': age_rank[i], 'depth': r[5],
+                         'num_replies': r[6], 'subtree_size': r[7],
+                         'is_op': r[8] is not None and r[8] == r[10],
+                         'sub_comments': size[i],
+                         'user_comment_karma': r[11],
+                         'user_avg_comment_karma': r[12],
+                         'user_global_comment_karma': r[13],
+                         'user_global_avg_comment_karma': r[14]})
+    return features
+
+
+class FeatureBuilder(object):
+    """Keeps comment_features up to date with the comments it is built from.
+
+    Each refresh computes a signature of every submission's inputs with
+    one scan (see _signatures), and rebuilds only the submissions whose
+    signature differs from the one recorded in feature_builds at their
+    last build (or that were never built), SUBMISSION_BATCH per
+    transaction.
+    Features of submissions whose comments are gone are dropped.
+    """
+
+    def __init__(self, engine, batch_size=SUBMISSION_BATCH):
+        self.engine = engine
+        self.batch_size = batch_size
+        self.submissions = 0
+        self.rebuilt = 0
+        self.removed = 0
+        self.rows = 0
+        self.scan_time = 0.0
+        self.build_time = 0.0
+
+    # Output: [(sub_id, signature)] to rebuild, [sub_id] to drop
+    def stale(self, full=False):
+        builds = commentDB.FeatureBuild.__table__
+        start = time()
+        with self.engine.connect() as conn:
+            built = dict((sub_id, sig) for sub_id, sig in
+                         conn.execute(select([builds.c.sub_id, builds.c.signature])))
+            current = _signatures(conn.execute(_inputs_query()))
+        self.scan_time += time() - start
+        self.submissions = len(current)
+        stale = sorted((sub_id, sig) for sub_id, sig in current.items()
+                       if full or built.get(sub_id) != sig)
+        return stale, sorted(set(built) - set(current))
+
+    def _drop(self, conn, sub_ids):
+        features = commentDB.CommentFeatures.__table__
+        builds = commentDB.FeatureBuild.__table__
+        conn.execute(features.delete().where(features.c.sub_id.in_(sub_ids)))
+        conn.execute(builds.delete().where(builds.c.sub_id.in_(sub_ids)))
+
+    # Output: feature rows written
+    def refresh(self, full=False):
+        stale, gone = self.stale(full)
+        features = commentDB.CommentFeatures.__table__
+        builds = commentDB.FeatureBuild.__table__
+
+        start = time()
+        for i in range(0, len(gone), self.batch_size):
+            with self.engine.begin() as conn:
+                self._drop(conn, gone[i:i + self.batch_size])
+        self.removed += len(gone)
+
+        written = 0
+        for i in range(0, len(stale), self.batch_size):
+            batch = dict(stale[i:i + self.batch_size])
+            sub_ids = list(batch)
+            with self.engine.begin() as conn:
+                rows = compute_features(conn.execute(_rows_query(sub_ids)).fetchall())
+                self._drop(conn, sub_ids)
+                if rows:
+                    conn.execute(features.insert(), rows)
+                counts = dict.fromkeys(sub_ids, 0)
+                for row in rows:
+                    counts[row['sub_id']] += 1
+                now = datetime.utcnow()
+                conn.execute(builds.insert(),
+                             [{'sub_id': sub_id, 'signature': batch[sub_id],
+                               'rows': counts[sub_id], 'timestamp': now}
+                              for sub_id in sub_ids])
+            written += len(rows)
+            self.rebuilt += len(sub_ids)
+            print('Built features of %d of %d submissions' %
+                  (min(i + self.batch_size, len(stale)), len(stale)))
+        self.rows += written
+        self.build_time += time() - start
+        return written
+
+    def report(self):
+        print('Scanned %d submissions in %.2fs; rebuilt %d, dropped %d' %
+              (self.submissions, self.scan_time, self.rebuilt, self.removed))
+        print('Wrote %d feature rows in %.2fs (%.1f rows/s)' %
+              (self.rows, self.build_time,
+               self.rows / self.build_time if self.build_time else 0.0))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Build or refresh the comment_features table')
+    parser.add_argument('-d', '--dbfile', type=str, default='redditDB.sqlite',
+                        help="SQLite database file of comments.")
+    parser.add_argument('--full', action='store_true',
+                        help="Rebuild every submission, not only those that changed.")
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+                        default=SUBMISSION_BATCH,
+                        help="Submissions rebuilt per transaction.")
+    parser.add_argument('--fast-sqlite', dest='fast_sqlite', action='store_true',
+                        help="Use the SQLite performance profile (WAL, relaxed fsync, mmap).")
+    args = parser.parse_args()
+
+    engine = commentDB.make_engine(args.dbfile, performance=args.fast_sqlite)
+    commentDB.upgrade_schema(engine)
+    builder = FeatureBuilder(engine, batch_size=args.batch_size)
+    builder.refresh(full=args.full)
+    builder.report()
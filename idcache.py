@@ -0,0 +1,154 @@
+##
+# Social Web Comment Ranking
+#
+# Bounded in-process identity caches: which primary keys are already
+# stored, and which submission each comment belongs to
+##
+
+from collections import OrderedDict
+
+from sqlalchemy import and_, select
+
+# Keys kept per table
+CACHE_SIZE = 250000
+
+# Cached value per key, for tables where one is useful: a comment's
+# submission
+VALUE_COLUMNS = {'comments': 'sub_id'}
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """Mapping of at most `capacity` entries, evicting the least recently
+    used, with hit and miss counts."""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self._data = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        try:
+            value = self._data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        self._data[key] = value
+        self.hits += 1
+        return value
+
+    # Output: True if an entry was evicted to make room
+    def put(self, key, value=True):
+        self._data.pop(key, None)
+        self._data[key] = value
+        if len(self._data) > self.capacity:
+            self._data.popitem(last=False)
+            self.evictions += 1
+            return True
+        return False
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {'size': len(self._data),
+                'capacity': self.capacity,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits) / lookups if lookups else 0.0}
+
+
+class IdentityCache(object):
+    """Answers "is this primary key stored or queued?" for one table.
+
+    Warmed with one scan of the table's keys. While every stored key fits,
+    the cache is complete and a miss means the key is new. Once keys have
+    been evicted, a miss is checked against the database if `verify` is
+    set, and otherwise taken as new, leaving the rare duplicate to INSERT
+    OR IGNORE. Keys queued since the last flush are kept apart from the
+    LRU, so a key evicted before it is written is never missed.
+    """
+
+    def __init__(self, session, table, capacity=CACHE_SIZE, verify=True):
+        self.session = session
+        self.table = table
+        self.verify = verify
+        self.keys = LRUCache(capacity)
+        self.pending = {}               # queued since the last flush
+        self.complete = True
+        self.queries = 0
+
+        self._pk = list(table.primary_key.columns)
+        self._value = VALUE_COLUMNS.get(table.name)
+
+    def _key(self, row):
+        key = tuple(row[:len(self._pk)])
+        return key[0] if len(key) == 1 else key
+
+    def warm(self):
+        cols = list(self._pk)
+        if self._value:
+            cols.append(self.table.c[self._value])
+        for row in self.session.execute(select(cols)):
+            value = row[-1] if self._value else True
+            if self.keys.put(self._key(row), value):
+                self.complete = False
+        return self
+
+    # Output: value stored with the key (True if none), or `default` if
+    # the key is unknown
+    def get(self, key, default=None):
+        value = self.keys.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        value = self.pending.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+        if self.complete or not self.verify:
+            return default
+
+        self.queries += 1
+        cols = list(self._pk)
+        if self._value:
+            cols.append(self.table.c[self._value])
+        parts = key if len(self._pk) > 1 else (key,)
+        row = self.session.execute(select(cols).where(
+            and_(*[c == v for c, v in zip(self._pk, parts)]))).first()
+        if row is None:
+            return default
+        value = row[-1] if self._value else True
+        self.keys.put(key, value)
+        return value
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def add(self, key, value=True):
+        self.pending[key] = value
+        if self.keys.put(key, value):
+            self.complete = False
+
+    # The key was queued but could not be written
+    def discard(self, key):
+        self.pending.pop(key, None)
+        self.keys.discard(key)
+
+    # The queued keys have been written
+    def flushed(self):
+        self.pending = {}
+
+    def stats(self):
+        stats = self.keys.stats()
+        stats['queries'] = self.queries
+        return stats
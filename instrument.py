@@ -0,0 +1,249 @@
+##
+# Social Web Comment Ranking
+#
+# Crawl instrumentation: stage timers, counters, queue depths, periodic
+# progress and JSON metrics, and optional per-stage profiling
+##
+
+import cProfile
+import json
+import os
+import sys
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from time import time
+
+# Stages timed during a crawl. 'load' (storing one submission) covers
+# 'walk', 'dedup' and 'models', which are timed in aggregate and so can't
+# be profiled on their own.
+STAGES = ('api', 'expand', 'load', 'walk', 'dedup', 'models', 'flush')
+PROFILED_STAGES = ('api', 'expand', 'load', 'flush')
+
+
+class Metrics(object):
+    """Thread-safe crawl metrics.
+
+    Stages are timed with `with metrics.stage(name):` or, in tight loops,
+    accumulated locally and added with record(). Counters are bumped with
+    count(). Gauges are callables polled at report time (e.g. queue
+    depths), and sources are callables returning dicts of other
+    components' statistics (retries, writer), included as-is.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time()
+            self.stage_time = defaultdict(float)
+            self.stage_calls = defaultdict(int)
+            self.counts = defaultdict(int)
+            self.gauges = {}
+            self.sources = {}
+            self._profiled = set()
+            self._profiles = []         # (stage, cProfile.Profile)
+            self._profiling = False     # only one profiler may run at a time
+            self._active = {}           # thread ident -> stack of stage names
+            self.samples = defaultdict(Counter)
+            self._last = (self.started, {})
+
+    @contextmanager
+    def stage(self, name):
+        ident = threading.current_thread().ident
+        stack = self._active.setdefault(ident, [])
+        stack.append(name)
+        profile = self._start_profile(name)
+        start = time()
+        try:
+            yield
+        finally:
+            elapsed = time() - start
+            if profile is not None:
+                profile.disable()
+                with self._lock:
+                    self._profiling = False
+            stack.pop()
+            self.record(name, elapsed)
+
+    def record(self, name, seconds, calls=1):
+        with self._lock:
+            self.stage_time[name] += seconds
+            self.stage_calls[name] += calls
+
+    def count(self, name, n=1):
+        with self._lock:
+            self.counts[name] += n
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    def source(self, name, fn):
+        self.sources[name] = fn
+
+    ###################
+    # Profiling hooks #
+    ###################
+
+    def profile(self, stages):
+        """Run cProfile inside each of these stages. Only one profiler can
+        be active per process, so calls that overlap one already being
+        profiled (on another thread, or a nested stage) are not profiled."""
+        self._profiled = set(stages)
+
+    def _start_profile(self, name):
+        if name not in self._profiled:
+            return None
+        with self._lock:
+            if self._profiling:
+                return None
+            self._profiling = True
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:      # another profiling tool is active
+            with self._lock:
+                self._profiling = False
+            return None
+        with self._lock:
+            self._profiles.append((name, profile))
+        return profile
+
+    def dump_profiles(self, outdir):
+        """Write <outdir>/<stage>.prof for each profiled stage, for
+        pstats or snakeviz."""
+        import pstats   # slow to import; only needed here
+        if not os.path.isdir(outdir):
+            os.makedirs(outdir)
+        by_stage = defaultdict(list)
+        for name, profile in self._profiles:
+            by_stage[name].append(profile)
+        for name, profiles in by_stage.items():
+            stats = pstats.Stats(profiles[0])
+            for profile in profiles[1:]:
+                stats.add(profile)
+            stats.dump_stats(os.path.join(outdir, name + '.prof'))
+
+    def sample(self):
+        """Record the innermost frame of every thread that is inside a
+        stage; called periodically by the Reporter."""
+        frames = sys._current_frames()
+        for ident, stack in list(self._active.items()):
+            if not stack or ident not in frames:
+                continue
+            code = frames[ident].f_code
+            self.samples[stack[-1]]['%s (%s:%d)' % (
+                code.co_name, os.path.basename(code.co_filename),
+                frames[ident].f_lineno)] += 1
+
+    #############
+    # Reporting #
+    #############
+
+    def snapshot(self):
+        now = time()
+        with self._lock:
+            elapsed = now - self.started
+            stages = dict((name, {'seconds': self.stage_time[name],
+                                  'calls': self.stage_calls[name]})
+                          for name in self.stage_time)
+            counts = dict(self.counts)
+        return {'timestamp': now,
+                'elapsed': elapsed,
+                'stages': stages,
+                'counts': counts,
+                'rates': dict((name, n / elapsed if elapsed else 0.0)
+                              for name, n in counts.items()),
+                'gauges': dict((name, fn()) for name, fn in self.gauges.items()),
+                'sources': dict((name, fn()) for name, fn in self.sources.items()),
+                'samples': dict((name, dict(c.most_common(20)))
+                                for name, c in self.samples.items())}
+
+    def progress_line(self):
+        now = time()
+        with self._lock:
+            counts = dict(self.counts)
+            stage_time = dict(self.stage_time)
+            last_time, last_counts = self._last
+            self._last = (now, counts)
+        interval = now - last_time or 1.0
+        parts = ['%ds' % (now - self.started)]
+        for name in sorted(counts):
+            parts.append('%s %d (%.1f/s)' % (name, counts[name],
+                                             (counts[name] - last_counts.get(name, 0)) /
+                                             interval))
+        for name, fn in sorted(self.gauges.items()):
+            parts.append('%s %d' % (name, fn()))
+        busy = ' '.join('%s %.0fs' % (name, stage_time[name])
+                        for name in STAGES if name in stage_time)
+        return ' | '.join(parts) + (' | ' + busy if busy else '')
+
+    def write(self, path):
+        """Write a JSON snapshot, replacing the file atomically."""
+        tmp = path + '.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(self.snapshot(), f, indent=2, sort_keys=True)
+        os.rename(tmp, path)
+
+
+class Reporter(object):
+    """Background thread that prints a progress line every `interval`
+    seconds, rewrites the JSON metrics file if given one, and samples
+    stage stacks every `sample_interval` seconds if given one."""
+
+    def __init__(self, metrics, interval=10.0, path=None, sample_interval=None):
+        self.metrics = metrics
+        self.interval = interval
+        self.path = path
+        self.sample_interval = sample_interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+
+    def _run(self):
+        tick = self.sample_interval or self.interval
+        next_report = time() + self.interval
+        while not self._stop.wait(tick):
+            if self.sample_interval:
+                self.metrics.sample()
+            if self.interval and time() >= next_report:
+                self.report()
+                next_report = time() + self.interval
+
+    def report(self):
+        if self.interval:
+            print(self.metrics.progress_line())
+        if self.path:
+            self.metrics.write(self.path)
+
+    def start(self):
+        if self.interval or self.sample_interval:
+            self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread.is_alive():
+            self._thread.join()
+        self.report()
+
+
+# Output: resident set size of this process in MB, or None if unknown
+def current_rss():
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return pages * os.sysconf('SC_PAGE_SIZE') / (1024.0 * 1024)
+    except (IOError, OSError, ValueError):
+        try:
+            import resource     # peak, not current, RSS; KB on Linux, bytes on macOS
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak / (1024.0 * 1024 if sys.platform == 'darwin' else 1024.0)
+        except ImportError:
+            return None
+
+
+# Shared by every component of a crawl
+metrics = Metrics()
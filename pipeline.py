@@ -0,0 +1,621 @@
+##
+# Social Web Comment Ranking
+#
+# Crawl pipeline: subreddit listings, comment trees and user histories
+# fetched through PRAW (or a stand-in) and queued to the database writer
+##
+
+import gc
+import threading
+from collections import defaultdict
+from datetime import datetime
+from time import sleep, time
+
+import praw
+from praw.handlers import RateLimitHandler
+from requests.exceptions import ConnectionError, HTTPError, Timeout
+
+import commentDB
+from activity import HistoryBatch, aggregate
+from apicache import CachedComment
+from crawler import bounded_map
+from instrument import current_rss, metrics
+from retry import DeadLetterQueue, FetchError, Retrier, header_delay
+from scheduler import CrawlJob, CrawlScheduler, job_weight, mean_yield
+from snapshot import TRACK_DAYS, load_schedule, record_poll, save_task
+from streaming import CommentStream, update_tree_metrics
+from textnorm import is_removed
+from treewalk import walk_comment_tree
+
+
+# Input: PRAW generator object for comments/submissions (posts)
+# Output: columnar history of the posts, see commentDB.pack_history
+def _post_history(gen):
+    history = dict((field, []) for field in commentDB.HISTORY_FIELDS)
+    for obj in gen:
+        history['subreddit'].append(obj.subreddit.display_name)
+        history['ups'].append(obj.ups)
+        history['downs'].append(obj.downs)
+        history['created'].append(obj.created_utc)
+    return history
+
+
+# Each user is fetched as three independent requests, so the worker pool
+# can run a user's profile, comment and submission listings at once
+USER_PARTS = ('about', 'comments', 'submitted')
+USER_BATCH = 500
+
+def _fetch_user_part(r, task):
+    username, part = task
+    if part == 'about':
+        return safe_praw_call(lambda: r.get_redditor(username, fetch=True))
+    redditor = r.get_redditor(username)
+    if part == 'comments':
+        return safe_praw_call(lambda: _post_history(redditor.get_comments(limit=None)))
+    return safe_praw_call(lambda: _post_history(redditor.get_submitted(limit=None)))
+
+
+# Input: list of (username, comment history, submission history,
+#        names of subreddits still missing activity rows)
+# Stats for the whole batch are aggregated in one vectorized pass
+def _write_user_activity(batch, subreddit_models, writer):
+    if not batch:
+        return
+    names = list(subreddit_models)
+    comment_stats = aggregate(HistoryBatch((u, c) for u, c, _, _ in batch), names)
+    submission_stats = aggregate(HistoryBatch((u, s) for u, _, s, _ in batch), names)
+    for username, _, _, missing in batch:
+        for subreddit in missing:
+            activity_model = commentDB.UserActivity(
+                user_name=username,
+                subreddit_id=subreddit_models[subreddit].subreddit_id,
+                subreddit_name=subreddit_models[subreddit].name,
+                comment_stats=comment_stats.stats(username, subreddit),
+                submission_stats=submission_stats.stats(username, subreddit))
+            writer.add(activity_model)
+
+
+# Output: names of everyone who posted or commented in these subreddits,
+# in every database the writer stores submissions in
+def _crawled_users(writer, subreddit_ids):
+    users = set()
+    for session in writer.sessions():
+        for model in (commentDB.Submission, commentDB.Comment):
+            query = session.query(model.user_name).distinct(). \
+                            filter(model.subreddit_id.in_(subreddit_ids))
+            users.update(name for (name,) in query if name is not None)
+    return users
+
+
+# Scrape profiles and post history of the users in the crawled
+# subreddits, `workers` requests at a time. Raw histories are cached in
+# user_histories and reused for `ttl` (a timedelta) instead of
+# refetching, e.g. when crawling another subreddit. Users whose activity
+# rows already exist for every subreddit are done, so an interrupted run
+# resumes where it stopped.
+def load_users(r, subreddit_models, writer, session, workers=1, ttl=None):
+    writer.flush()
+
+    wanted = set(m.subreddit_id for m in subreddit_models.values())
+    users = _crawled_users(writer, [m.subreddit_id for k, m in subreddit_models.items()
+                                    if k != 'GLOBAL'])
+    have = defaultdict(set)
+    for name, subreddit_id in session.query(commentDB.UserActivity.user_name,
+                                            commentDB.UserActivity.subreddit_id):
+        have[name].add(subreddit_id)
+
+    cached = set()
+    if ttl is not None:
+        query = session.query(commentDB.UserHistory.user_name). \
+                        filter(commentDB.UserHistory.timestamp >= datetime.utcnow() - ttl)
+        cached = set(name for (name,) in query)
+
+    todo = [u for u in users if not wanted <= have[u]]
+    print('Scraping %d users (%d done, %d cached)' %
+          (len(todo), len(users) - len(todo), len(cached.intersection(todo))))
+
+    def missing(username):
+        return [k for k, m in subreddit_models.items()
+                if m.subreddit_id not in have[username]]
+
+    # Users are aggregated in batches of USER_BATCH
+    pending = []
+    def queue(username, comments, submissions):
+        pending.append((username, comments, submissions, missing(username)))
+        if len(pending) >= USER_BATCH:
+            _write_user_activity(pending, subreddit_models, writer)
+            del pending[:]
+
+    # Cached users need no network access
+    for username in todo:
+        if username not in cached:
+            continue
+        history = session.query(commentDB.UserHistory).get(username)
+        queue(username,
+              commentDB.unpack_history(history.comments),
+              commentDB.unpack_history(history.submissions))
+
+    def store(username, fetched):
+        writer.merge(commentDB.User(fetched['about']))
+        writer.merge(commentDB.UserHistory(
+            user_name=username,
+            timestamp=datetime.utcnow(),
+            comments=commentDB.pack_history(fetched['comments']),
+            submissions=commentDB.pack_history(fetched['submitted'])))
+        queue(username, fetched['comments'], fetched['submitted'])
+
+    tasks = ((u, part) for u in todo if u not in cached for part in USER_PARTS)
+    parts = defaultdict(dict)
+    dead = DeadLetterQueue()
+    for (username, part), result in bounded_map(lambda t: _fetch_user_part(r, t),
+                                                tasks, workers):
+        parts[username][part] = result
+        if len(parts[username]) < len(USER_PARTS):
+            continue
+
+        fetched = parts.pop(username)
+        if any(v is False for v in fetched.values()):
+            dead.add(username, username)
+            continue
+        store(username, fetched)
+
+    # Failed users get one more try at the end
+    for username in dead.drain():
+        fetched = dict((part, _fetch_user_part(r, (username, part)))
+                       for part in USER_PARTS)
+        if any(v is False for v in fetched.values()):
+            print('ERROR: Failed to get user %s' % username)
+            continue
+        store(username, fetched)
+
+    _write_user_activity(pending, subreddit_models, writer)
+
+
+def _is_comment(obj):
+    return isinstance(obj, (praw.objects.Comment, CachedComment))
+
+
+# Input: PRAW comment, textnorm.TextFilter or None
+# Output: (keep, ID of the comment it duplicates or None)
+def _filter_comment(c, text_filter):
+    if is_removed(c.body):
+        return False, None
+    if text_filter is None:
+        return True, None
+    return text_filter.check(c)
+
+
+# Comments are ranked by 'best' among their siblings:
+#    http://www.redditblog.com/2009/10/reddits-new-comment-sorting-system.html
+# Stores every comment in the tree, with tree metrics from a single walk.
+# Removed comments are skipped; with a text_filter, so are bot comments,
+# and near-duplicates are stored with dup_of set.
+# Output: number of comments queued for writing
+def load_comments(comments, writer, sub_id, text_filter=None):
+    count = 0
+    new_users = 0
+    walk_time = dedup_time = model_time = 0.0
+    tree = walk_comment_tree(comments, is_comment=_is_comment)
+    while True:
+        start = time()
+        try:
+            c, m = next(tree)
+        except StopIteration:
+            break
+        walked = time()
+        walk_time += walked - start
+        keep, dup_of = _filter_comment(c, text_filter)
+        filtered = time()
+        dedup_time += filtered - walked
+        if not keep:
+            continue
+        if c.author is not None and not writer.known(commentDB.User, c.author.name):
+            user_model = commentDB.User(name=c.author.name)
+            writer.add(user_model)
+            new_users += 1
+
+        comment_model = commentDB.Comment(c, sub_id=sub_id, rank=m.rank,
+                                          num_replies=m.num_replies,
+                                          convo_depth=m.convo_depth,
+                                          depth=m.depth,
+                                          subtree_size=m.subtree_size)
+        comment_model.dup_of = dup_of
+        comment_model.path = m.path
+        model_time += time() - filtered
+        if writer.add(comment_model):
+            count += 1
+
+    # Model time includes queueing, and any flush that triggers
+    metrics.record('walk', walk_time)
+    if text_filter is not None:
+        metrics.record('dedup', dedup_time)
+    metrics.record('models', model_time)
+    metrics.count('comments', count)
+    metrics.count('users', new_users)
+    return count
+
+
+# Comments between memory checks when streaming
+RSS_CHECK_INTERVAL = 1000
+
+
+# Streaming counterpart of load_comments for huge threads: comments are
+# written as 'more comments' stubs are expanded, so memory does not grow
+# with the thread. If the process grows past max_rss MB, buffered rows
+# are written out early. Subtree metrics are filled in once the whole
+# thread is stored.
+# Output: number of comments queued for writing, or False if part of the
+#         thread could not be fetched
+def load_comments_streaming(submission, writer, max_rss=None, text_filter=None):
+    count = 0
+    new_users = 0
+    dedup_time = 0.0
+    stream = CommentStream(submission, _is_comment, call=safe_praw_call)
+    for i, (c, rank, depth) in enumerate(stream):
+        if max_rss and i % RSS_CHECK_INTERVAL == 0 and current_rss() > max_rss:
+            writer.flush()
+            gc.collect()
+        start = time()
+        keep, dup_of = _filter_comment(c, text_filter)
+        dedup_time += time() - start
+        if not keep:
+            continue
+        if c.author is not None and not writer.known(commentDB.User, c.author.name):
+            user_model = commentDB.User(name=c.author.name)
+            writer.add(user_model)
+            new_users += 1
+
+        comment_model = commentDB.Comment(c, sub_id=submission.fullname,
+                                          rank=rank, depth=depth)
+        comment_model.dup_of = dup_of
+        if writer.add(comment_model):
+            count += 1
+
+    if text_filter is not None:
+        metrics.record('dedup', dedup_time)
+    metrics.count('comments', count)
+    metrics.count('users', new_users)
+    if stream.failed:
+        return False
+    writer.flush()
+    update_tree_metrics(writer.session, stream)
+    return count
+
+
+# Generator over search results that still need their comments fetched.
+# Runs on the calling thread, so all writes stay on the writer's thread.
+def _new_submissions(submissions, writer, tracker, state):
+    for submission in submissions:
+        # print ">> Submission %s" % submission.fullname
+        if not submission.is_self:
+            tracker.skipped(state)
+            continue
+
+        # Skip submissions already stored, unless they changed (--incremental)
+        shard = writer.shard(submission)
+        stored = shard.contains(commentDB.Submission(submission))
+        if not tracker.needs_fetch(submission, stored):
+            tracker.skipped(state)
+            continue
+
+        if submission.author is not None and \
+                not shard.known(commentDB.User, submission.author.name):
+            user_model = commentDB.User(name=submission.author.name)
+            shard.add(user_model)
+            metrics.count('users')
+
+        yield submission
+
+
+def _streams(submission, stream_threshold):
+    return stream_threshold is not None and \
+           submission.num_comments >= stream_threshold
+
+
+# Drops the submission's comment tree, so it is fetched again on access
+def _reset_comments(submission):
+    submission._comments = None
+    submission._replaced_more = False
+    for name in ('_comments_by_id', '_orphaned'):
+        fetched = getattr(submission, name, None)
+        if fetched is not None:
+            fetched.clear()
+
+
+# PRAW's replace_more_comments takes every 'more comments' stub out of
+# the tree before fetching them, so once it fails partway the stubs not
+# yet fetched are gone, and calling it again would 'succeed' on a
+# truncated tree. Unless the backend carries on where it stopped
+# (asyncfetch.AsyncSubmission), each attempt starts from a fresh tree.
+def _expand_comments(submission):
+    def attempt():
+        if not getattr(submission, 'resumes_expansion', False):
+            _reset_comments(submission)
+        return submission.replace_more_comments(limit=None, threshold=0)
+    return safe_praw_call(attempt)
+
+
+# Expand the full comment forest; runs on a worker thread. Threads of
+# stream_threshold comments or more only get their first page, and are
+# expanded as they are stored.
+def _fetch_comments(submission, stream_threshold=None):
+    with metrics.stage('expand'):
+        if _streams(submission, stream_threshold):
+            return safe_praw_call(lambda: submission.comments)
+        return _expand_comments(submission)
+
+
+# Output: False if the submission's comments could not all be fetched
+def _store_submission(submission, writer, tracker, state,
+                      stream_threshold=None, max_rss=None, text_filter=None):
+    shard = writer.shard(submission)
+    with metrics.stage('load'):
+        if _streams(submission, stream_threshold):
+            count = load_comments_streaming(submission, shard, max_rss, text_filter)
+            if count is False:
+                return False
+        else:
+            count = load_comments(submission.comments, shard, submission.fullname,
+                                  text_filter)
+
+    # Queue the submission after its comments, so a stored
+    # submission always has a complete comment tree
+    shard.merge(commentDB.Submission(submission))
+    tracker.done(state, submission, count)
+    metrics.count('submissions')
+
+
+def _search(subreddit, flair):
+    if flair == None:
+        return subreddit.search("", sort='top', limit=1000)
+    return subreddit.search("flair:'%s'" % flair, sort='top', limit=1000)
+
+
+# Give failed submissions one more try once the job's listing is done.
+# A crawl with failures stays incomplete, so the next run retries them.
+def _finish_job(job, fetch, store, tracker):
+    if job.dead:
+        print('Retrying %d failed submissions from %s' % (len(job.dead), job))
+    failed = []
+    for submission in job.dead.drain():
+        if fetch(submission) is False or store(job, submission) is False:
+            failed.append(submission.fullname)
+
+    if failed:
+        print('ERROR: Failed to get comments for %s' % ', '.join(failed))
+    else:
+        tracker.finish(job.state)
+
+
+# Crawl every (subreddit, flair) listing in one pool of `workers`
+# threads. Listings are interleaved by CrawlScheduler, stalest and
+# highest-yield first; all writes happen on the calling thread. With the
+# ThreadReddit the subreddits came from as `reddit`, each submission is
+# adopted by the thread fetching or storing it.
+def load_subreddits(subreddits, writer, tracker, flairs=None, workers=1,
+                    stream_threshold=None, max_rss=None, text_filter=None,
+                    reddit=None):
+    # flairs = ['Physics', 'Maths', 'Astro', 'Computing', 'Geo',
+    #           'Eng', 'Chem', 'Soc', 'Bio', 'Psych', 'Med', 'Neuro']
+
+    if flairs == None: flairs = [None]
+    scheduler = CrawlScheduler()
+    default_yield = mean_yield(tracker.states())
+    for subreddit in subreddits:
+        for flair in flairs:
+            weight = job_weight(tracker.previous(subreddit.fullname, flair),
+                                default_yield)
+            state = tracker.start(subreddit.fullname, flair)
+            if state is None:
+                continue
+            submissions = _new_submissions(_search(subreddit, flair), writer,
+                                           tracker, state)
+            scheduler.add(CrawlJob(subreddit, flair, state, submissions, weight))
+    metrics.gauge('jobs', lambda: len(scheduler))
+    metrics.gauge('in_flight', lambda: scheduler.in_flight)
+
+    adopt = reddit.adopt if isinstance(reddit, ThreadReddit) else lambda s: s
+
+    def fetch(submission):
+        return _fetch_comments(adopt(submission), stream_threshold)
+
+    def store(job, submission):
+        adopt(submission)
+        return _store_submission(submission, writer, tracker, job.state,
+                                 stream_threshold, max_rss, text_filter)
+
+    fetched = bounded_map(lambda task: fetch(task[1]), scheduler.tasks(), workers)
+    for (job, submission), success in fetched:
+        if success is False or store(job, submission) is False:
+            job.dead.add(submission.fullname, submission)
+        scheduler.completed(job)
+        for finished in scheduler.finished():
+            _finish_job(finished, fetch, store, tracker)
+
+    for finished in scheduler.finished():
+        _finish_job(finished, fetch, store, tracker)
+
+
+def load_subreddit(subreddit, writer, tracker, flairs=None, workers=1,
+                   stream_threshold=None, max_rss=None, text_filter=None,
+                   reddit=None):
+    load_subreddits([subreddit], writer, tracker, flairs=flairs,
+                    workers=workers, stream_threshold=stream_threshold,
+                    max_rss=max_rss, text_filter=text_filter, reddit=reddit)
+
+
+# Input: sub_id of a tracked submission, number of 'more comments' stubs
+#        to expand (0 for the first page only)
+# Output: {fullname: [score, ups, downs, best_rank]} of the submission and
+#         its comments, or False if it could not be fetched. Runs on a
+#         worker thread.
+def _poll_scores(r, sub_id, more_limit=0):
+    def fetch():
+        submission = r.get_submission(submission_id=sub_id[3:])
+        if more_limit:
+            submission.replace_more_comments(limit=more_limit, threshold=0)
+        return submission
+
+    with metrics.stage('expand'):
+        submission = safe_praw_call(fetch)
+    if submission is False:
+        return False
+    values = {submission.fullname: [submission.score, submission.ups,
+                                    submission.downs, None]}
+    for c, m in walk_comment_tree(submission.comments, is_comment=_is_comment):
+        if not is_removed(c.body):
+            values[c.fullname] = [c.score, c.ups, c.downs, m.rank]
+    return values
+
+
+# Re-poll the scores of submissions posted in the last track_days, each on
+# its own adaptive schedule (see snapshot.py), `workers` at a time. Runs
+# for `hours`, sleeping until the next poll is due; with hours=0, polls
+# the submissions due now once.
+def take_snapshots(r, session, writer, hours=0, workers=1, track_days=TRACK_DAYS,
+                   more_limit=0):
+    scheduler = load_schedule(session, writer.sessions(), writer, track_days)
+    metrics.gauge('tracked', lambda: len(scheduler))
+    end = time() + hours * 3600
+
+    def poll(task):
+        return datetime.utcnow(), _poll_scores(r, task.sub_id, more_limit)
+
+    while True:
+        for task, (timestamp, values) in bounded_map(poll, scheduler.due(), workers):
+            if values is False:
+                # Retried after the same interval; the stored schedule is
+                # left as it was
+                scheduler.reschedule(task, None)
+                continue
+            changed = record_poll(session, task, timestamp, values, writer)
+            tracked = scheduler.reschedule(task, changed)
+            save_task(task, tracked, timestamp, writer)
+            metrics.count('polls')
+
+        writer.flush()
+        next_poll = scheduler.next_poll()
+        if not hours or next_poll is None or time() >= end:
+            break
+        wait = (next_poll - datetime.utcnow()).total_seconds()
+        sleep(min(max(wait, 0), max(end - time(), 0)))
+
+
+# Errors worth retrying: HTTP errors (client errors other than 408/429
+# fail at once), dropped connections and timeouts
+RETRYABLE_ERRORS = (HTTPError, ConnectionError, Timeout, praw.errors.HTTPException,
+                    FetchError)
+
+
+# Input: exception raised by a PRAW call or the async backend
+# Output: (HTTP status or None, response headers or None)
+def _classify_error(e):
+    if isinstance(e, FetchError):
+        return e.status, e.headers
+    response = getattr(e, 'response', None)
+    if response is None:
+        response = getattr(e, '_raw', None)     # praw.errors.HTTPException
+    if response is None:
+        return None, None
+    return response.status_code, response.headers
+
+
+# Shared by every worker, so repeated server errors pause the whole crawl
+retrier = Retrier(RETRYABLE_ERRORS, _classify_error)
+
+
+# Input: function call to attempt
+# Output: None or commentDB object on success, False on failure
+def safe_praw_call(f):
+    return retrier.call(f)
+
+
+class TokenBucketHandler(RateLimitHandler):
+    """PRAW request handler that draws every HTTP request from a shared
+    TokenBucket instead of PRAW's rate limiter, which holds a per-domain
+    lock and sleeps api_request_delay between requests. With one
+    praw.Reddit per worker (see ThreadReddit), workers overlap their
+    network waits while the bucket keeps the total rate within quota.
+    If given a ResponseCache, every JSON response is saved to it.
+    When the server reports the rate-limit window is used up, the bucket
+    is paused until it resets."""
+
+    def __init__(self, bucket, cache=None):
+        super(TokenBucketHandler, self).__init__()
+        self.bucket = bucket
+        self.cache = cache
+
+    # As RateLimitHandler.request, without its rate_limit wrapper; the
+    # _rate_domain and _rate_delay arguments meant for it are ignored
+    def request(self, request, proxies, timeout, verify, **_):
+        self.bucket.acquire()
+        with metrics.stage('api'):
+            settings = self.http.merge_environment_settings(request.url, proxies,
+                                                            False, verify, None)
+            response = self.http.send(request, timeout=timeout, allow_redirects=False,
+                                      **settings)
+        metrics.count('requests')
+        reset = header_delay(response.headers) if response.status_code == 200 else None
+        if reset:
+            self.bucket.pause(reset)
+        if self.cache is not None and response.status_code == 200 and \
+                'json' in response.headers.get('content-type', ''):
+            self.cache.store(response.url, response.content)
+        return response
+
+
+class DeferredLogin(object):
+    """Wraps a praw.Reddit, logging in on the first call made through it
+    rather than at startup, so runs that never reach the API skip the
+    login round trip."""
+
+    def __init__(self, reddit, username, password):
+        self._reddit = reddit
+        self._credentials = (username, password)
+        self._lock = threading.Lock()
+
+    # Output: the wrapped praw.Reddit, logged in
+    def logged_in(self):
+        if self._credentials is not None:
+            with self._lock:
+                if self._credentials is not None:
+                    username, password = self._credentials
+                    self._reddit.login(username=username, password=password)
+                    self._credentials = None
+        return self._reddit
+
+    def __getattr__(self, name):
+        return getattr(self.logged_in(), name)
+
+
+class ThreadReddit(object):
+    """Stands in for praw.Reddit with one instance per thread, made by
+    `factory` (e.g. a DeferredLogin over a TokenBucketHandler that shares
+    the crawl's bucket), since PRAW is not thread-safe.
+
+    PRAW objects fetch through the instance that built them, so an object
+    handed from one thread to another is adopt()ed by the thread that
+    goes on to use it."""
+
+    def __init__(self, factory):
+        self._factory = factory
+        self._local = threading.local()
+
+    # Output: this thread's instance, made on first use
+    def current(self):
+        reddit = getattr(self._local, 'reddit', None)
+        if reddit is None:
+            reddit = self._local.reddit = self._factory()
+        return reddit
+
+    def __getattr__(self, name):
+        return getattr(self.current(), name)
+
+    # Rebind a PRAW object (e.g. a search result) to this thread's instance.
+    # Objects it already fetched (its 'more comments' stubs) keep theirs, so
+    # adopt before the first fetch.
+    def adopt(self, thing):
+        reddit = self.current()
+        thing.reddit_session = reddit.logged_in() if isinstance(reddit, DeferredLogin) \
+                               else reddit
+        return thing
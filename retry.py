@@ -0,0 +1,212 @@
+##
+# Social Web Comment Ranking
+#
+# Retry policy for API calls: backoff with jitter, rate-limit headers,
+# a circuit breaker for server errors, and a dead-letter queue
+##
+
+import random
+import threading
+from collections import Counter, OrderedDict
+from email.utils import mktime_tz, parsedate_tz
+from time import sleep, time
+
+
+class RetryStats(object):
+    """Thread-safe counters for retries and time spent waiting."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.retries = Counter()        # reason -> count
+        self.wait_time = 0.0            # backoff sleeps
+        self.breaker_wait_time = 0.0    # waiting on an open circuit
+        self.circuit_opens = 0
+        self.failures = 0               # calls that gave up
+
+    def add(self, **counts):
+        with self._lock:
+            for name, value in counts.items():
+                setattr(self, name, getattr(self, name) + value)
+
+    def retried(self, reason, delay):
+        with self._lock:
+            self.retries[reason] += 1
+            self.wait_time += delay
+
+    def as_dict(self):
+        with self._lock:
+            return {'calls': self.calls,
+                    'retries': dict(self.retries),
+                    'wait_time': self.wait_time,
+                    'breaker_wait_time': self.breaker_wait_time,
+                    'circuit_opens': self.circuit_opens,
+                    'failures': self.failures}
+
+    def report(self):
+        stats = self.as_dict()
+        print('API calls: %d, retries: %d (%s), failed: %d' %
+              (stats['calls'], sum(stats['retries'].values()),
+               ', '.join('%s: %d' % kv for kv in sorted(stats['retries'].items())),
+               stats['failures']))
+        print('Retry wait: %.1fs backoff, %.1fs on open circuit (%d opens)' %
+              (stats['wait_time'], stats['breaker_wait_time'], stats['circuit_opens']))
+
+
+class CircuitBreaker(object):
+    """Opens after `threshold` consecutive server errors. While open, every
+    caller waits until `cooldown` seconds have passed since it opened; the
+    next failure after that re-opens it, and a success closes it."""
+
+    def __init__(self, threshold=5, cooldown=60.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._failures = 0
+        self._opened_at = None
+        self._lock = threading.Lock()
+
+    # Output: seconds spent waiting for the circuit
+    def wait(self):
+        waited = 0.0
+        while True:
+            with self._lock:
+                if self._opened_at is None:
+                    return waited
+                remaining = self._opened_at + self.cooldown - time()
+            if remaining <= 0:
+                return waited
+            sleep(remaining)
+            waited += remaining
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    # Output: True if this failure opened the circuit
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures < self.threshold:
+                return False
+            now = time()
+            if self._opened_at is not None and now < self._opened_at + self.cooldown:
+                return False
+            self._opened_at = now
+            return True
+
+
+class FetchError(Exception):
+    """A request made without PRAW failed. `status` and `headers` are the
+    response's, or None if no response arrived (dropped connection,
+    timeout)."""
+
+    def __init__(self, message, status=None, headers=None):
+        super(FetchError, self).__init__(message)
+        self.status = status
+        self.headers = headers
+
+
+# Input: response headers (a case-insensitive mapping, or None)
+# Output: seconds the server asked us to wait, or None
+def header_delay(headers):
+    if not headers:
+        return None
+    retry_after = headers.get('retry-after')
+    if retry_after:
+        try:
+            return max(0.0, float(retry_after))
+        except ValueError:
+            parsed = parsedate_tz(retry_after)
+            if parsed is not None:
+                return max(0.0, mktime_tz(parsed) - time())
+    remaining = headers.get('x-ratelimit-remaining')
+    reset = headers.get('x-ratelimit-reset')
+    if remaining is not None and reset is not None:
+        try:
+            if float(remaining) < 1:
+                return max(0.0, float(reset))
+        except ValueError:
+            pass
+    return None
+
+
+class Retrier(object):
+    """Calls a function, retrying `retryable` exceptions.
+
+    classify(exception) returns (HTTP status or None, response headers or
+    None). Client errors other than 408/429 fail immediately. The delay
+    before retry n is the server's Retry-After or rate-limit reset if it
+    sent one, else exponential backoff with equal jitter. Server errors
+    feed a shared CircuitBreaker.
+    """
+
+    def __init__(self, retryable, classify, max_attempts=5, base_delay=2.0,
+                 max_delay=300.0, breaker=None, stats=None):
+        self.retryable = retryable
+        self.classify = classify
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.breaker = breaker or CircuitBreaker()
+        self.stats = stats or RetryStats()
+
+    def delay(self, attempt, headers=None):
+        delay = header_delay(headers)
+        if delay is not None:
+            return min(delay, self.max_delay)
+        backoff = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return backoff / 2 + random.uniform(0, backoff / 2)
+
+    # Output: f() on success, False on failure
+    def call(self, f):
+        self.stats.add(calls=1)
+        for attempt in range(self.max_attempts):
+            self.stats.add(breaker_wait_time=self.breaker.wait())
+            try:
+                result = f()
+            except self.retryable as e:
+                status, headers = self.classify(e)
+                reason = str(status) if status else type(e).__name__
+                if status is not None and 400 <= status < 500 \
+                        and status not in (408, 429):
+                    print('Error %s making request, not retrying' % reason)
+                    break
+                if status is not None and status >= 500 and self.breaker.failure():
+                    self.stats.add(circuit_opens=1)
+                    print('Repeated server errors, pausing requests for %.0fs' %
+                          self.breaker.cooldown)
+                if attempt + 1 == self.max_attempts:
+                    break
+                delay = self.delay(attempt, headers)
+                print('Error %s making request, retrying in %.1fs' % (reason, delay))
+                self.stats.retried(reason, delay)
+                sleep(delay)
+            else:
+                self.breaker.success()
+                return result
+        self.stats.add(failures=1)
+        return False
+
+
+class DeadLetterQueue(object):
+    """Items that failed, keyed by fullname, to retry once the rest of a
+    crawl is done."""
+
+    def __init__(self):
+        self._items = OrderedDict()
+
+    def add(self, key, item, reason=None):
+        self._items[key] = (item, reason)
+
+    def __len__(self):
+        return len(self._items)
+
+    def keys(self):
+        return list(self._items)
+
+    # Output: list of queued items; the queue is left empty
+    def drain(self):
+        items = [item for item, _ in self._items.values()]
+        self._items.clear()
+        return items
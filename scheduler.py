@@ -0,0 +1,119 @@
+##
+# Social Web Comment Ranking
+#
+# Scheduling of crawl jobs (subreddit listings) sharing one worker pool
+##
+
+import heapq
+from datetime import datetime
+from itertools import islice
+
+from retry import DeadLetterQueue
+
+# Staleness, in hours, of a listing that was never crawled
+NEVER_CRAWLED = 24 * 365.0
+# Submissions handed out each time a job is picked
+QUANTUM = 10
+
+
+# Input: CrawlState list
+# Output: comments per listing position over all previous crawls, the
+# expected yield of a listing with no history
+def mean_yield(states):
+    positions = sum(s.position or 0 for s in states)
+    comments = sum(s.comment_count or 0 for s in states)
+    return float(comments) / positions if positions else 1.0
+
+
+# Input: CrawlState of the previous crawl of a listing (or None),
+#        expected yield for listings without one
+# Output: job weight, staleness in hours x expected comments per submission
+def job_weight(state, default_yield=1.0, now=None):
+    now = now or datetime.utcnow()
+    if state is None or state.timestamp is None:
+        staleness = NEVER_CRAWLED
+    else:
+        staleness = max((now - state.timestamp).total_seconds() / 3600, 1 / 60.0)
+    if state is not None and state.position:
+        expected = float(state.comment_count or 0) / state.position
+    else:
+        expected = default_yield
+    return staleness * max(expected, 0.1)
+
+
+class CrawlJob(object):
+    """One listing (a subreddit, optionally filtered by flair) to crawl.
+    `submissions` is an iterator over the submissions that need their
+    comments fetched; `pending` counts those handed out and not yet
+    stored."""
+
+    def __init__(self, subreddit, flair, state, submissions, weight):
+        self.subreddit = subreddit
+        self.flair = flair
+        self.state = state
+        self.submissions = iter(submissions)
+        self.weight = weight
+        self.pending = 0
+        self.exhausted = False
+        self.dead = DeadLetterQueue()
+
+    def __str__(self):
+        return '%s flair \'%s\'' % (self.subreddit.display_name, self.flair or '')
+
+
+class CrawlScheduler(object):
+    """Interleaves the submissions of many crawl jobs by stride scheduling.
+
+    Each time a job is picked it hands out `quantum` submissions and its
+    pass advances by quantum / weight, so jobs share the worker pool in
+    proportion to their weight and the stalest, highest-yield listings
+    go first. A job is finished once its listing is exhausted and every
+    submission it handed out has been completed.
+    """
+
+    def __init__(self, quantum=QUANTUM):
+        self.quantum = quantum
+        self._heap = []
+        self._seq = 0
+        self._finished = []
+        self.in_flight = 0      # submissions handed out, not yet completed
+
+    def add(self, job):
+        heapq.heappush(self._heap, (0.0, -job.weight, self._seq, job))
+        self._seq += 1
+
+    def __len__(self):
+        return len(self._heap)
+
+    # Output: generator of (job, submission) in scheduled order. Listings
+    # are read lazily on the calling thread.
+    def tasks(self):
+        while self._heap:
+            stride, neg_weight, seq, job = heapq.heappop(self._heap)
+            n = 0
+            for submission in islice(job.submissions, self.quantum):
+                job.pending += 1
+                self.in_flight += 1
+                n += 1
+                yield job, submission
+            if n < self.quantum:
+                job.exhausted = True
+                self._check(job)
+            else:
+                heapq.heappush(self._heap, (stride + float(self.quantum) / job.weight,
+                                            neg_weight, seq, job))
+
+    def completed(self, job):
+        job.pending -= 1
+        self.in_flight -= 1
+        self._check(job)
+
+    def _check(self, job):
+        if job.exhausted and job.pending == 0:
+            self._finished.append(job)
+
+    # Output: jobs finished since the last call
+    def finished(self):
+        jobs = self._finished
+        self._finished = []
+        return jobs
@@ -1,258 +1,383 @@
 #!/usr/bin/env python
+##
+# Social Web Comment Ranking
+#
+# Command line: crawl, users, export and stats subcommands. Each command
+# imports the modules it needs when it runs, so --help and short jobs
+# do not pay for praw, sqlalchemy or numpy up front.
+##
 
-import praw
-import commentDB
+import sys
 from argparse import ArgumentParser
-from datetime import datetime
-from collections import defaultdict
-from sqlalchemy import create_engine
-from sqlalchemy.orm import relation, sessionmaker
-from requests.exceptions import HTTPError
-from time import sleep
-
-
-def _build_summary_stats(stats):
-    stats['net_karma'] = stats['pos_karma'] - stats['neg_karma']
-
-    if stats['count'] == 0:
-        stats['avg_pos_karma'] = None
-        stats['avg_neg_karma'] = None
-        stats['avg_net_karma'] = None
-    else:
-        stats['avg_pos_karma'] = float(stats['pos_karma']) / stats['count']
-        stats['avg_neg_karma'] = float(stats['neg_karma']) / stats['count']
-        stats['avg_net_karma'] = float(stats['net_karma']) / stats['count']
-
-
-# Input: PRAW generator object for comments/submissions (posts), subreddit list
-# Output: dicts with the following stats for all of reddit and for specified subreddits
-#  * 'count': count of all posts
-#  * 'pos_karma': total positive karma
-#  * 'avg_pos_karma': average positive karma per post
-#  * 'neg_karma': total negative karma
-#  * 'avg_neg_karma': average negative karma per post
-#  * 'net_karma': total karma
-#  * 'avg_net_karma': average karma per post
-#
-# NOTE: we should histogram 'count' and 'count_filtered' before trusting these stats, since
-# the reddit API only allows you to pull 1000 previous submissions/comments
-#   --  another flaw: these stats don't reflect stats at time of posting
-def user_stats(gen, subreddits):
-    stats = defaultdict(lambda: defaultdict(int))
-    for obj in gen:
-        obj_subreddit = obj.subreddit.display_name
-        if obj_subreddit in subreddits:
-            stats[obj_subreddit]['count'] += 1
-            stats[obj_subreddit]['pos_karma'] += obj.ups
-            stats[obj_subreddit]['neg_karma'] += obj.downs
-        stats['GLOBAL']['count'] += 1
-        stats['GLOBAL']['pos_karma'] += obj.ups
-        stats['GLOBAL']['neg_karma'] += obj.downs
-
-    for subreddit in subreddits:
-        _build_summary_stats(stats[subreddit])
-
-    return stats
-
-
-def load_users(r, users, subreddit_models, session):
-    for username in users:
-        user = safe_praw_call(lambda: r.get_redditor(username))
-        if user is False:
-            print('ERROR: Failed to get user %s' % username)
-            continue
-        comment_stats = \
-            user_stats(user.get_comments(limit=None), subreddit_models)
-        submission_stats = \
-            user_stats(user.get_submitted(limit=None), subreddit_models)
-
-        user_model = commentDB.User(user)
-        merge_model(user_model, session)
-
-        for subreddit in subreddit_models:
-            activity_model = commentDB.UserActivity(
-                user_name=user.name,
-                subreddit_id=subreddit_models[subreddit].subreddit_id,
-                subreddit_name=subreddit_models[subreddit].name,
-                comment_stats=comment_stats[subreddit],
-                submission_stats=submission_stats[subreddit])
-            add_model(activity_model, session)
-
-
-def _max_tree_depth(comment):
-    if len(comment.replies) == 0:
-        return 1
-    return 1 + max(_max_tree_depth(reply) for reply in comment.replies)
-
-
-# Comments are ranked by 'best':
-#    http://www.redditblog.com/2009/10/reddits-new-comment-sorting-system.html
-# Only storing top-level comments for now
-def load_comments(comments, users, session):
-    for rank, c in enumerate(comments, start=1):
-        text = c.body.encode('ascii', 'ignore')
-        if text == '[deleted]':
-            continue
-        if c.author is not None and c.author.name not in users:
-            users.add(c.author.name)
-            user_model = commentDB.User(name=c.author.name)
-            add_model(user_model, session)
-
-        comment_model = commentDB.Comment(c, rank, len(c.replies), _max_tree_depth(c))
-        add_model(comment_model, session)
-
-
-def load_subreddit(subreddit, users, session, flairs=None):
-    # flairs = ['Physics', 'Maths', 'Astro', 'Computing', 'Geo',
-    #           'Eng', 'Chem', 'Soc', 'Bio', 'Psych', 'Med', 'Neuro']
-
-    if flairs == None: flairs = [None]
-    for flair in flairs:
-
-        # Filter to target flair, if desired
-        if flair == None:
-            submissions = subreddit.search("", sort='top', limit=1000)
-        else:
-            submissions = subreddit.search("flair:'%s'" % flair,
-                                           sort='top', limit=1000)
-
-        for submission in submissions:
-            # print ">> Submission %s" % submission.fullname
-            if not submission.is_self:
-                continue
-
-            if submission.author is not None and submission.author.name not in users:
-                users.add(submission.author.name)
-                user_model = commentDB.User(name=submission.author.name)
-                add_model(user_model, session)
-
-            submission_model = commentDB.Submission(submission)
-
-            # Add submission to database; skip on fail
-            added = add_model(submission_model, session)
-            if not added:
-                continue
-
-            # print submission.comments # DEBUG
-            success = safe_praw_call(lambda: \
-                                     submission.replace_more_comments(limit=None,
-                                                                     threshold=0)
-                                     )
-            if success is False:
-                print('ERROR: Failed to get comments for %s' % submission.fullname)
-                return False
-
-            load_comments(submission.comments, users, session)
-
-
-# Input: function call to attempt
-# Output: None or commentDB object on success, False on failure
-def safe_praw_call(f):
-    attempt_count = 1
-    while attempt_count <= 5:
-        try:
-            obj = f()
-            return obj
-        except HTTPError as e:
-            status_code = e.response.status_code
-            print('Error %d making PRAW request, trying again' % status_code)
-            sleep(15)
-        attempt_count += 1
-    return False
-
-
-def add_model(model, session):
-    obj = None
-    if isinstance(model, commentDB.Subreddit):
-        obj = session.query(commentDB.Subreddit). \
-                      filter(commentDB.Subreddit.subreddit_id == model.subreddit_id). \
-                      first()
-    elif isinstance(model, commentDB.Submission):
-        obj = session.query(commentDB.Submission). \
-                      filter(commentDB.Submission.sub_id == model.sub_id). \
-                      first()
-    elif isinstance(model, commentDB.Comment):
-        obj = session.query(commentDB.Comment). \
-                      filter(commentDB.Comment.com_id == model.com_id). \
-                      first()
-    elif isinstance(model, commentDB.User):
-        obj = session.query(commentDB.User). \
-                      filter(commentDB.User.name == model.name). \
-                      first()
-    if obj is not None:
-        print('WARNING: object already in database.')
-        return False
 
+from instrument import PROFILED_STAGES, Reporter, current_rss, metrics
+
+COMMANDS = ('crawl', 'users', 'export', 'stats')
+USER_AGENT = ("NLU project: comment scraper "
+              "by /u/nlu_comment_ranker (smnguyen@stanford.edu)")
+
+
+# Output: praw.Reddit or a stand-in (CachedReddit, AsyncReddit, or
+# ThreadReddit: one logged-in praw.Reddit per worker thread, as PRAW is
+# not thread-safe); PRAW logs in on each thread's first request
+def _connect(args):
+    from crawler import TokenBucket
+
+    if args.replay:
+        from apicache import CachedReddit, ResponseCache
+        return CachedReddit(ResponseCache(args.replay))
+
+    bucket = TokenBucket(args.rate, args.burst)
+    metrics.source('rate_limit', bucket.stats)
+    cache = None
+    if args.cache:
+        from apicache import ResponseCache
+        cache = ResponseCache(args.cache)
+    if args.backend == 'async':
+        from asyncfetch import AsyncClient, AsyncReddit
+        return AsyncReddit(AsyncClient(USER_AGENT, bucket, cache,
+                                       pool_size=args.pool_size))
+
+    import praw
+    from pipeline import DeferredLogin, ThreadReddit, TokenBucketHandler
+    return ThreadReddit(lambda: DeferredLogin(
+        praw.Reddit(user_agent=USER_AGENT, handler=TokenBucketHandler(bucket, cache)),
+        args.username, args.password))
+
+
+def _disconnect(args, r):
+    if args.backend == 'async' and not args.replay:
+        r.close()
+
+
+# Output: (session, writer) on the database, or its shards with --shard
+def _open_writer(args):
+    from sqlalchemy.orm import sessionmaker
+
+    import commentDB
+    from dbwriter import BulkWriter
+    from idcache import CACHE_SIZE
+    from storage import ShardRouter, ShardedWriter, open_database
+
+    cache_size = CACHE_SIZE if args.id_cache is None else args.id_cache
+    engine = open_database(args.dbfile, performance=args.fast_sqlite,
+                           echo=args.echo)
+    session = sessionmaker(bind=engine)()
+    writer = BulkWriter(session, batch_size=args.batch_size, cache_size=cache_size)
+    if args.shard:
+        writer = ShardedWriter(writer, ShardRouter(args.shard),
+                               batch_size=args.batch_size, cache_size=cache_size,
+                               performance=args.fast_sqlite, echo=args.echo)
+    writer.warm(commentDB.User, commentDB.Submission, commentDB.Comment)
+    metrics.source('writer', writer.stats)
+    metrics.gauge('write_buffer', lambda: writer.pending)
+    metrics.gauge('rss_mb', lambda: current_rss() or 0)
+    return session, writer
+
+
+# Input: (name, PRAW subreddit) pairs
+# Output: {name: commentDB.Subreddit}, with the GLOBAL pseudo-subreddit
+def _subreddit_models(writer, subreddits):
+    import commentDB
+
+    models = {}
+    sr_global = commentDB.Subreddit(subreddit_id='GLOBAL', name='GLOBAL')
+    writer.add(sr_global)
+    models['GLOBAL'] = sr_global
+    for name, subreddit in subreddits:
+        model = commentDB.Subreddit(subreddit)
+        writer.add(model)
+        models[name] = model
+    return models
+
+
+# Runs `work` under the progress reporter, then flushes and reports
+def _instrumented(args, writer, work):
+    if args.profile:
+        metrics.profile(args.profile)
+    reporter = Reporter(metrics, interval=args.progress, path=args.metrics,
+                        sample_interval=args.sample / 1000.0 if args.sample else None)
+    reporter.start()
     try:
-        session.add(model)
-        session.commit()
-        return True
-    except:
-        session.rollback()
-        print('ERROR: Unable to commit to database.')
-        return False
+        work()
+    finally:
+        writer.close()
+        reporter.stop()
+        writer.report()
+        from pipeline import retrier
+        retrier.stats.report()
+        if args.profile:
+            metrics.dump_profiles(args.profile_dir)
+
+
+def crawl(args):
+    from datetime import timedelta
+
+    import pipeline
+    from crawlstate import CrawlTracker
+    from snapshot import TRACK_DAYS
+
+    r = _connect(args)
+    session, writer = _open_writer(args)
+    metrics.source('retry', pipeline.retrier.stats.as_dict)
+    tracker = CrawlTracker(session, writer,
+                           incremental=args.incremental, restart=args.restart)
+    text_filter = None
+    if args.dedup:
+        from textnorm import DedupIndex, TextFilter
+        text_filter = TextFilter(DedupIndex(args.dedup), skip_bots=not args.keep_bots)
+        metrics.source('dedup', text_filter.stats)
+
+    subreddits = [r.get_subreddit(name) for name in args.subreddit]
+    subreddit_models = _subreddit_models(writer, zip(args.subreddit, subreddits))
+
+    def work():
+        if args.snapshot is not None:
+            pipeline.take_snapshots(r, session, writer, hours=args.snapshot,
+                                    workers=args.workers,
+                                    track_days=TRACK_DAYS if args.track_days is None
+                                    else args.track_days,
+                                    more_limit=args.snapshot_more)
+            return
+
+        # Scrape subreddits, sharing one API budget, worker pool and writer
+        pipeline.load_subreddits(subreddits, writer, tracker, flairs=args.flair,
+                                 workers=args.workers,
+                                 stream_threshold=args.stream_threshold,
+                                 max_rss=args.max_rss, text_filter=text_filter,
+                                 reddit=r)
+        if args.scrape_users:
+            pipeline.load_users(r, subreddit_models, writer, session,
+                                workers=args.workers,
+                                ttl=timedelta(days=args.user_ttl))
 
-
-def merge_model(model, session):
     try:
-        session.merge(model)
-        session.commit()
-    except:
-        session.rollback()
-
-
-if __name__ == '__main__':
-    parser = ArgumentParser(description='Scrape comments of Reddit self-posts')
+        _instrumented(args, writer, work)
+    finally:
+        if text_filter is not None:
+            text_filter.close()
+        _disconnect(args, r)
+
+
+# Subreddits already in the database are not fetched again
+def users(args):
+    from datetime import timedelta
+
+    import commentDB
+    import pipeline
+
+    r = _connect(args)
+    session, writer = _open_writer(args)
+    metrics.source('retry', pipeline.retrier.stats.as_dict)
+    stored = dict((s.name, s) for s in session.query(commentDB.Subreddit).
+                  filter(commentDB.Subreddit.name.in_(args.subreddit)))
+    subreddit_models = _subreddit_models(writer, [(name, r.get_subreddit(name))
+                                                  for name in args.subreddit
+                                                  if name not in stored])
+    subreddit_models.update(stored)
+    try:
+        _instrumented(args, writer, lambda: pipeline.load_users(
+            r, subreddit_models, writer, session, workers=args.workers,
+            ttl=timedelta(days=args.user_ttl)))
+    finally:
+        _disconnect(args, r)
+
+
+def export(args):
+    import commentDB
+    from export import export_corpus
+
+    engine = commentDB.make_engine(args.dbfile)
+    export_corpus(engine, args.outdir, fmt=args.format, chunk_size=args.chunk_size)
+
+
+# Row counts of every table, and the progress of each crawl. The
+# database is only read, never upgraded.
+def stats(args):
+    from sqlalchemy import func, inspect
+    from sqlalchemy.orm import sessionmaker
+
+    import commentDB
+
+    engine = commentDB.make_engine(args.dbfile)
+    existing = set(inspect(engine).get_table_names())
+    session = sessionmaker(bind=engine)()
+    for table in commentDB.Base.metadata.sorted_tables:
+        if table.name in existing:
+            print('%-20s %12d' % (table.name,
+                                  session.query(func.count()).select_from(table).scalar()))
+
+    if commentDB.CrawlState.__tablename__ not in existing:
+        return
+    names = dict(session.query(commentDB.Subreddit.subreddit_id,
+                               commentDB.Subreddit.name))
+    for state in session.query(commentDB.CrawlState). \
+            order_by(commentDB.CrawlState.subreddit_id, commentDB.CrawlState.flair):
+        print('%-20s %-12s %6s results %9s comments  %s  %s' %
+              (names.get(state.subreddit_id, state.subreddit_id), state.flair or '-',
+               state.position, state.comment_count,
+               'complete' if state.completed else 'in progress', state.timestamp))
+    session.close()
+
+
+def _database_arguments(parser):
+    parser.add_argument('-d', '--dbfile', type=str,
+                        default='redditDB.sqlite',
+                        help="SQLite database file (or SQLAlchemy URL) to save output. "
+                             "Will accumulate if file exists.")
+    parser.add_argument('--shard', type=str,
+                        help="Store submissions and comments in shards named by this "
+                             "template of {subreddit} and {month}, e.g. "
+                             "'shards/{subreddit}-{month}.sqlite'; the main database "
+                             "keeps crawl state and users. Combine with storage.py.")
+    parser.add_argument('--fast-sqlite', dest='fast_sqlite', action='store_true',
+                        help="Use the SQLite performance profile (WAL, relaxed fsync, mmap).")
+    parser.add_argument('--echo', action='store_true',
+                        help="Log every SQL statement.")
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+                        default=1000,
+                        help="Number of rows to buffer before each database write.")
+    parser.add_argument('--id-cache', dest='id_cache', type=int,
+                        help="Primary keys of each table to keep in memory for "
+                             "de-duplication; least recently used keys are evicted "
+                             "(default: idcache.CACHE_SIZE).")
+
+
+def _api_arguments(parser):
     parser.add_argument('-u', '--username', type=str,
                         default='nlu_comment_ranker',
                         help='reddit username')
     parser.add_argument('-p', '--password', type=str,
                         default='cardinal_cs224u',
                         help='reddit password')
-    parser.add_argument('-s', '--subreddit', type=str,
-                        default='askscience',
-                        help='subreddit to scrape')
-    parser.add_argument('-f', '--flair', type=str, nargs='+',
-                        help="List of flair to scrape; useful for expanding endpoints.")
-
-    parser.add_argument('-d', '--dbfile', type=str,
-                        default='redditDB.sqlite',
-                        help="SQLite database file to save output. Will accumulate if file exists.")
+    parser.add_argument('-s', '--subreddit', type=str, nargs='+',
+                        default=['askscience'],
+                        help='subreddits to scrape')
+
+    # Concurrency and API quota
+    parser.add_argument('-w', '--workers', type=int, default=1,
+                        help="Number of submissions to fetch comments for at once.")
+    parser.add_argument('--rate', type=float, default=0.5,
+                        help="Maximum API requests per second, shared by all workers.")
+    parser.add_argument('--burst', type=int, default=1,
+                        help="Number of API requests allowed back-to-back.")
+    parser.add_argument('--max-attempts', dest='max_attempts', type=int, default=5,
+                        help="Attempts per API call before giving up on it.")
+    parser.add_argument('--retry-delay', dest='retry_delay', type=float, default=2.0,
+                        help="Base retry delay in seconds; doubles on each attempt.")
+    parser.add_argument('--backend', choices=('praw', 'async'), default='praw',
+                        help="HTTP client: PRAW (logged in, one session per worker) or "
+                             "an aiohttp connection pool on reddit's public JSON "
+                             "endpoints (anonymous; requests from all workers overlap, "
+                             "and 'more comments' requests of a thread go out together).")
+    parser.add_argument('--pool-size', dest='pool_size', type=int, default=32,
+                        help="Keep-alive connections of the async backend.")
+
+    # Raw response cache
+    parser.add_argument('--cache', type=str,
+                        help="Directory to save raw API responses to.")
+    parser.add_argument('--replay', type=str,
+                        help="Rebuild the database from a response cache directory, "
+                             "without network access.")
+
+    # Instrumentation
+    parser.add_argument('--progress', type=float, default=10,
+                        help="Seconds between progress lines; 0 for none.")
+    parser.add_argument('--metrics', type=str,
+                        help="JSON file to write crawl metrics to, updated with each progress line.")
+    parser.add_argument('--profile', type=str, nargs='+', choices=PROFILED_STAGES,
+                        help="Stages to run cProfile in.")
+    parser.add_argument('--profile-dir', dest='profile_dir', type=str, default='profiles',
+                        help="Directory to write <stage>.prof files to.")
+    parser.add_argument('--sample', type=float,
+                        help="Sample the stack of each stage every this many milliseconds.")
+
+    parser.add_argument('--user-ttl', dest='user_ttl', type=float, default=7,
+                        help="Days to reuse a cached user history before refetching it.")
+
+
+def make_parser():
+    parser = ArgumentParser(description='Scrape comments of Reddit self-posts')
+    commands = parser.add_subparsers(dest='command')
+
+    p = commands.add_parser('crawl', help='Crawl subreddits (the default command)')
+    _database_arguments(p)
+    _api_arguments(p)
+    p.add_argument('-f', '--flair', type=str, nargs='+',
+                   help="List of flair to scrape in each subreddit; useful for expanding endpoints.")
+
+    # Memory use on huge threads
+    p.add_argument('--stream', type=int, dest='stream_threshold',
+                   help="Stream threads with at least this many comments to the "
+                        "database as they are expanded, instead of in memory.")
+    p.add_argument('--max-rss', dest='max_rss', type=float,
+                   help="Memory ceiling in MB; buffered rows are written out early "
+                        "when streaming past it.")
+
+    # Score snapshots
+    p.add_argument('--snapshot', type=float,
+                   help="Instead of crawling, re-poll the scores of tracked submissions "
+                        "for this many hours (0 polls those due now once).")
+    p.add_argument('--track-days', dest='track_days', type=float,
+                   help="Days after posting to keep polling a submission's scores "
+                        "(default: snapshot.TRACK_DAYS).")
+    p.add_argument('--snapshot-more', dest='snapshot_more', type=int, default=0,
+                   help="'More comments' stubs to expand per poll; 0 polls only "
+                        "the first page of comments.")
+
+    # Comment text filtering
+    p.add_argument('--dedup', type=str,
+                   help="Dedup index file: skip bot comments, and mark near-duplicates "
+                        "of comments already seen (kept across runs).")
+    p.add_argument('--keep-bots', dest='keep_bots', action='store_true',
+                   help="Store bot comments even when deduplicating.")
+
+    # Resuming and re-crawling
+    p.add_argument('--incremental', action='store_true',
+                   help="Re-fetch stored submissions whose comment count or edit time changed.")
+    p.add_argument('--restart', action='store_true',
+                   help="Walk listings of crawls already marked complete again.")
 
     # Optionally, scrape user posts / metadata
-    parser.add_argument('--scrape-users',
-                        dest='scrape_users',
-                        action='store_true')
-
-    # parser.add_argument('subreddits', type=str, nargs='+',
-    #                     help='List of subreddits to scrape')
-    args = parser.parse_args()
-
-    user_agent = ("NLU project: comment scraper "
-                  "by /u/nlu_comment_ranker (smnguyen@stanford.edu)")
-    r = praw.Reddit(user_agent=user_agent)
-    r.login(username=args.username, password=args.password)
-
-    engine = create_engine('sqlite:///' + args.dbfile, echo=True)
-    commentDB.Base.metadata.create_all(engine)
-    Session = sessionmaker(bind=engine)
-    session = Session()
-
-    subreddit_models = {}
-    users = set()
-    sr_global = commentDB.Subreddit(subreddit_id='GLOBAL', name='GLOBAL')
-    add_model(sr_global, session)
-    subreddit_models['GLOBAL'] = sr_global
+    p.add_argument('--scrape-users', dest='scrape_users', action='store_true',
+                   help="Scrape users of the subreddits after crawling them.")
+    p.set_defaults(run=crawl)
+
+    p = commands.add_parser('users',
+                            help='Scrape profiles and post history of the users of '
+                                 'crawled subreddits')
+    _database_arguments(p)
+    _api_arguments(p)
+    p.set_defaults(run=users)
+
+    p = commands.add_parser('export', help='Export the comment corpus to columnar files')
+    p.add_argument('-d', '--dbfile', type=str,
+                   default='redditDB.sqlite',
+                   help="SQLite database file to export.")
+    p.add_argument('-o', '--outdir', type=str, default='corpus',
+                   help="Directory to write the export to.")
+    p.add_argument('--format', type=str, choices=['npy', 'parquet'],
+                   default='npy')
+    p.add_argument('--chunk-size', dest='chunk_size', type=int, default=50000)
+    p.set_defaults(run=export)
+
+    p = commands.add_parser('stats', help='Row counts and crawl progress')
+    p.add_argument('-d', '--dbfile', type=str,
+                   default='redditDB.sqlite',
+                   help="SQLite database file (or SQLAlchemy URL) to read.")
+    p.set_defaults(run=stats)
+    return parser
 
-    # Initialize subreddit object
-    subreddit = r.get_subreddit(args.subreddit)
-    subreddit_model = commentDB.Subreddit(subreddit)
-    subreddit_models[args.subreddit] = subreddit_model
-    add_model(subreddit_model, session)
 
-    # Scrape subreddit
-    load_subreddit(subreddit, users, session, flairs=args.flair)
-
-    # Scrape users
-    if args.scrape_users:
-        load_users(r, users, subreddit_models, session)
+if __name__ == '__main__':
+    argv = sys.argv[1:]
+    # Without a command, crawl, as before subcommands existed
+    if not argv or argv[0] not in COMMANDS + ('-h', '--help'):
+        argv = ['crawl'] + argv
+    args = make_parser().parse_args(argv)
+
+    if args.command in ('crawl', 'users'):
+        from pipeline import retrier
+        retrier.max_attempts = args.max_attempts
+        retrier.base_delay = args.retry_delay
+    args.run(args)
@@ -0,0 +1,230 @@
+#!/usr/bin/env python
+##
+# Social Web Comment Ranking
+#
+# Full-text search over comments and submissions, with SQLite FTS5
+# indexes kept in sync by triggers
+##
+
+import re
+import sys
+from argparse import ArgumentParser
+from collections import namedtuple
+from time import time
+
+from sqlalchemy import text
+from sqlalchemy.orm import sessionmaker
+
+import commentDB
+
+TOKENIZER = 'porter unicode61 remove_diacritics 2'
+
+# (index, table, indexed columns). The indexes are external-content FTS5
+# tables: they hold only the inverted index, and read text back from the
+# table by rowid.
+INDEXES = (('comments_fts', 'comments', ('text',)),
+           ('submissions_fts', 'submissions', ('title', 'text')))
+
+WORD = re.compile(r'\w+', re.U)
+
+# One search result, best first. relevance is the negated BM25 score
+# (higher is better); snippet is the matching text with hits in [brackets].
+# comment is None for submission hits.
+Hit = namedtuple('Hit', ['relevance', 'snippet', 'comment', 'submission'])
+
+
+# Output: statements creating the index on `table` and the triggers that
+# index rows as they are inserted, updated or deleted. INSERT OR REPLACE
+# fires the delete trigger through recursive triggers, which
+# commentDB.make_engine turns on.
+def _ddl(index, table, columns):
+    fields = {'index': index, 'table': table, 'tokenizer': TOKENIZER,
+              'cols': ', '.join(columns),
+              'new': ', '.join('new.' + c for c in columns),
+              'old': ', '.join('old.' + c for c in columns)}
+    insert = "INSERT INTO {index}(rowid, {cols}) VALUES (new.rowid, {new});"
+    delete = ("INSERT INTO {index}({index}, rowid, {cols}) "
+              "VALUES ('delete', old.rowid, {old});")
+    statements = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {index} USING fts5({cols}, "
+        "content='{table}', content_rowid='rowid', tokenize='{tokenizer}')",
+        "CREATE TRIGGER IF NOT EXISTS {index}_insert AFTER INSERT ON {table} "
+        "BEGIN " + insert + " END",
+        "CREATE TRIGGER IF NOT EXISTS {index}_delete AFTER DELETE ON {table} "
+        "BEGIN " + delete + " END",
+        "CREATE TRIGGER IF NOT EXISTS {index}_update AFTER UPDATE OF {cols} ON {table} "
+        "BEGIN " + delete + " " + insert + " END"]
+    return [s.format(**fields) for s in statements]
+
+
+# Output: names of the search indexes present in the database
+def installed(engine):
+    if engine.dialect.name != 'sqlite':
+        return []
+    with engine.connect() as conn:
+        names = set(r[0] for r in conn.execute(
+            text("SELECT name FROM sqlite_master WHERE type = 'table'")))
+    return [index for index, _, _ in INDEXES if index in names]
+
+
+# Creates the indexes and triggers; from then on every writer keeps them
+# in sync. Existing rows are only indexed by rebuild().
+# Output: names of the indexes created
+def install(engine):
+    if engine.dialect.name != 'sqlite':
+        raise ValueError('Full-text search needs an SQLite database')
+    present = installed(engine)
+    with engine.begin() as conn:
+        for index, table, columns in INDEXES:
+            for statement in _ddl(index, table, columns):
+                conn.execute(text(statement))
+    return [index for index, _, _ in INDEXES if index not in present]
+
+
+def drop(engine):
+    with engine.begin() as conn:
+        for index, _, _ in INDEXES:
+            for trigger in ('insert', 'delete', 'update'):
+                conn.execute(text('DROP TRIGGER IF EXISTS %s_%s' % (index, trigger)))
+            conn.execute(text('DROP TABLE IF EXISTS %s' % index))
+
+
+# Re-indexes every row of the installed indexes, e.g. after they were
+# created on an existing database, or after VACUUM renumbered rowids
+# Output: {index: seconds taken}
+def rebuild(engine, optimize=True):
+    timings = {}
+    for index in installed(engine):
+        start = time()
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO %s(%s) VALUES ('rebuild')" % (index, index)))
+            if optimize:
+                conn.execute(text("INSERT INTO %s(%s) VALUES ('optimize')" % (index, index)))
+        timings[index] = time() - start
+    return timings
+
+
+# Input: free text
+# Output: FTS5 query matching every word of it, in any order; FTS5
+# operators and punctuation in the text are taken literally
+def match_query(terms):
+    return ' '.join('"%s"' % w for w in WORD.findall(terms))
+
+
+def _load(session, model, key, ids):
+    found = {}
+    ids = list(set(ids))
+    for i in range(0, len(ids), 400):
+        for obj in session.query(model).filter(key.in_(ids[i:i + 400])):
+            found[getattr(obj, key.key)] = obj
+    return found
+
+
+# Output: [(rowid, key, sub_id, bm25, snippet)], best first
+def _search(session, index, table, key, query, limit, subreddit_id, raw, candidates):
+    match = query if raw else match_query(query)
+    if not match:
+        return []
+    params = {'query': match, 'limit': limit, 'subreddit_id': subreddit_id,
+              'candidates': candidates}
+    # Matches are filtered by subreddit before any cap. Ranking every match
+    # of a word found in most documents costs as much as a scan, so with
+    # `candidates` only that many of the most recently stored matches
+    # (walked in rowid order, which FTS5 does without scoring) are ranked
+    inner = ('SELECT {index}.rowid, t.{key}, t.sub_id, {index}.rank FROM {index} '
+             'JOIN {table} t ON t.rowid = {index}.rowid WHERE {index} MATCH :query')
+    if subreddit_id:
+        inner += ' AND t.subreddit_id = :subreddit_id'
+    if candidates:
+        inner += ' ORDER BY {index}.rowid DESC LIMIT :candidates'
+    sql = ('SELECT * FROM (' + inner + ') ORDER BY rank LIMIT :limit'). \
+          format(index=index, table=table, key=key)
+    rows = session.execute(text(sql), params).fetchall()
+    if not rows:
+        return []
+
+    # Snippets only for the hits returned
+    sql = ("SELECT rowid, snippet({index}, -1, '[', ']', '...', 16) FROM {index} "
+           "WHERE {index} MATCH :query AND rowid IN ({rowids})"). \
+          format(index=index, rowids=','.join(str(int(r[0])) for r in rows))
+    snippets = dict((rowid, snippet) for rowid, snippet in
+                    session.execute(text(sql), params))
+    return [tuple(r) + (snippets.get(r[0]),) for r in rows]
+
+
+# Input: session, free text (or an FTS5 query with raw=True), number of
+#        hits, optional subreddit ID to search within, optional number of
+#        the most recent matches to rank (None ranks every match)
+# Output: list of Hit, most relevant first, with their Comment and
+#         Submission loaded
+def search_comments(session, query, limit=20, subreddit_id=None, raw=False,
+                    candidates=None):
+    rows = _search(session, 'comments_fts', 'comments', 'com_id', query, limit,
+                   subreddit_id, raw, candidates)
+    comments = _load(session, commentDB.Comment, commentDB.Comment.com_id,
+                     [r[1] for r in rows])
+    submissions = _load(session, commentDB.Submission, commentDB.Submission.sub_id,
+                        [r[2] for r in rows])
+    return [Hit(-r[3], r[4], comments.get(r[1]), submissions.get(r[2])) for r in rows]
+
+
+# As search_comments, over submission titles and text
+def search_submissions(session, query, limit=20, subreddit_id=None, raw=False,
+                       candidates=None):
+    rows = _search(session, 'submissions_fts', 'submissions', 'sub_id', query, limit,
+                   subreddit_id, raw, candidates)
+    submissions = _load(session, commentDB.Submission, commentDB.Submission.sub_id,
+                        [r[1] for r in rows])
+    return [Hit(-r[3], r[4], None, submissions.get(r[1])) for r in rows]
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Search comments and submissions, or build '
+                                        'the full-text indexes')
+    parser.add_argument('query', type=str, nargs='*',
+                        help="Words to search for.")
+    parser.add_argument('-d', '--dbfile', type=str, default='redditDB.sqlite',
+                        help="SQLite database file of comments.")
+    parser.add_argument('--rebuild', action='store_true',
+                        help="Create the indexes if needed, and index every stored row.")
+    parser.add_argument('--drop', action='store_true',
+                        help="Remove the indexes and their triggers.")
+    parser.add_argument('--submissions', action='store_true',
+                        help="Search submission titles and text instead of comments.")
+    parser.add_argument('--subreddit', type=str,
+                        help="Only search within this subreddit ID.")
+    parser.add_argument('--raw', action='store_true',
+                        help="Pass the query to FTS5 as is (phrases, OR, NEAR, prefix*).")
+    parser.add_argument('-n', '--limit', type=int, default=20)
+    parser.add_argument('--candidates', type=int, default=0,
+                        help="Only rank this many of the most recent matches, to bound "
+                             "the cost of very common words; 0 ranks every match.")
+    args = parser.parse_args()
+
+    engine = commentDB.make_engine(args.dbfile)
+    commentDB.upgrade_schema(engine)
+    if args.drop:
+        drop(engine)
+        print('Dropped the search indexes')
+        sys.exit(0)
+    if args.rebuild:
+        install(engine)
+        for index, seconds in sorted(rebuild(engine).items()):
+            print('Rebuilt %s in %.1fs' % (index, seconds))
+    if not args.query:
+        sys.exit(0)
+    if not installed(engine):
+        print('ERROR: no search index in %s; create one with --rebuild' % args.dbfile)
+        sys.exit(1)
+
+    session = sessionmaker(bind=engine)()
+    search = search_submissions if args.submissions else search_comments
+    start = time()
+    hits = search(session, ' '.join(args.query), limit=args.limit,
+                  subreddit_id=args.subreddit, raw=args.raw,
+                  candidates=args.candidates or None)
+    elapsed = time() - start
+    for hit in hits:
+        key = hit.comment.com_id if hit.comment else hit.submission.sub_id
+        print('%8.2f  %-12s %s' % (hit.relevance, key, hit.snippet.replace('\n', ' ')))
+    print('%d hits in %.1f ms' % (len(hits), 1000 * elapsed))
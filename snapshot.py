@@ -0,0 +1,229 @@
+##
+# Social Web Comment Ranking
+#
+# Score snapshots: tracked submissions are re-polled on an adaptive
+# schedule, and only the score values that changed are stored
+##
+
+import heapq
+from datetime import datetime, timedelta
+
+from sqlalchemy import and_, select
+
+import commentDB
+from instrument import metrics
+
+# Values tracked per comment; submissions have no best_rank
+SNAPSHOT_FIELDS = ('score', 'ups', 'downs', 'best_rank')
+
+# Poll intervals, in seconds. A thread is polled about every AGE_FRACTION
+# of its age, within [MIN_INTERVAL, MAX_INTERVAL]; intervals halve while
+# at least HOT_FRACTION of its values change between polls, and double
+# while none do.
+MIN_INTERVAL = 15 * 60.0
+MAX_INTERVAL = 7 * 24 * 3600.0
+AGE_FRACTION = 0.1
+HOT_FRACTION = 0.05
+# Submissions older than this are no longer polled
+TRACK_DAYS = 30
+
+
+# Input: thread age and previous poll interval (None before the first
+#        poll) in seconds, fraction of values that changed at this poll
+# Output: seconds until the next poll
+def next_interval(age, interval, changed):
+    by_age = min(max(age * AGE_FRACTION, MIN_INTERVAL), MAX_INTERVAL)
+    if interval is None:
+        return by_age
+    if changed >= HOT_FRACTION:
+        return max(MIN_INTERVAL, min(interval, by_age) / 2)
+    if changed == 0:
+        return min(MAX_INTERVAL, max(interval, by_age) * 2)
+    return by_age
+
+
+# Input: {fullname: [score, ups, downs, best_rank]} from the previous poll
+#        (empty before the first), the same for this poll, poll time
+# Output: ScoreSnapshot models for the things whose values changed, with
+#         unchanged values left NULL and the changed ones flagged in its
+#         `changed` bitmask; number of values that changed
+def diff_values(old, new, timestamp):
+    snapshots = []
+    changed = 0
+    for thing_id, values in new.items():
+        prev = old.get(thing_id)
+        if prev is None:    # first snapshot of a thing has every value
+            mask = (1 << len(SNAPSHOT_FIELDS)) - 1
+            n = sum(1 for v in values if v is not None)
+        else:
+            mask = sum(1 << i for i, (v, p) in enumerate(zip(values, prev)) if v != p)
+            n = bin(mask).count('1')
+        if not mask:
+            continue
+        changed += n
+        row = dict((f, v if mask & (1 << i) else None)
+                   for i, (f, v) in enumerate(zip(SNAPSHOT_FIELDS, values)))
+        snapshots.append(commentDB.ScoreSnapshot(thing_id=thing_id, timestamp=timestamp,
+                                                 changed=mask, **row))
+    return snapshots, changed
+
+
+class SnapshotTask(object):
+    """One tracked submission. `values` holds the values stored at its
+    last poll, once loaded."""
+
+    def __init__(self, sub_id, created, next_poll=None, interval=None, polls=0):
+        self.sub_id = sub_id
+        self.created = created
+        self.next_poll = next_poll or datetime.utcnow()
+        self.interval = interval
+        self.polls = polls
+        self.values = None
+
+    def age(self, now):
+        return max((now - self.created).total_seconds(), 0.0)
+
+    # Output: how late the poll is, in poll intervals; young, fast-moving
+    # threads have short intervals and so rank first when both are due
+    def lateness(self, now):
+        interval = self.interval or MIN_INTERVAL
+        return (now - self.next_poll).total_seconds() / interval
+
+
+class SnapshotScheduler(object):
+    """Holds the tracked submissions, ordered by next poll time.
+
+    due() hands out the submissions whose poll time has passed, most
+    overdue (in units of their own interval) first, so when polls fall
+    behind the API budget, cold threads wait and young ones do not.
+    """
+
+    def __init__(self, track_days=TRACK_DAYS):
+        self.track = timedelta(days=track_days)
+        self._heap = []
+        self._seq = 0
+
+    def add(self, task):
+        heapq.heappush(self._heap, (task.next_poll, self._seq, task))
+        self._seq += 1
+
+    def __len__(self):
+        return len(self._heap)
+
+    # Output: time of the next poll, or None if nothing is tracked
+    def next_poll(self):
+        return self._heap[0][0] if self._heap else None
+
+    def due(self, now=None):
+        now = now or datetime.utcnow()
+        tasks = []
+        while self._heap and self._heap[0][0] <= now:
+            tasks.append(heapq.heappop(self._heap)[2])
+        tasks.sort(key=lambda t: t.lateness(now), reverse=True)
+        return tasks
+
+    # Input: task just polled (or failed), fraction of its values that
+    #        changed (None if the poll failed)
+    # Output: True if it stays tracked
+    def reschedule(self, task, changed, now=None):
+        now = now or datetime.utcnow()
+        if now - task.created > self.track:
+            return False
+        if changed is None:     # failed: try again after the same interval
+            interval = task.interval or MIN_INTERVAL
+        else:
+            interval = next_interval(task.age(now), task.interval, changed)
+        task.interval = interval
+        task.next_poll = now + timedelta(seconds=interval)
+        self.add(task)
+        return True
+
+
+# Input: session of the home database, sessions of every database with
+#        submissions (see BulkWriter.sessions), writer
+# Output: SnapshotScheduler of the submissions posted in the last
+#         track_days. Submissions without a schedule row are enrolled,
+#         due at once.
+def load_schedule(session, sessions, writer, track_days=TRACK_DAYS):
+    cutoff = datetime.utcnow() - timedelta(days=track_days)
+    schedule = commentDB.SnapshotSchedule.__table__
+    scheduler = SnapshotScheduler(track_days)
+
+    known = set()
+    query = select([schedule.c.sub_id, schedule.c.created, schedule.c.next_poll,
+                    schedule.c.interval, schedule.c.polls]). \
+            where(and_(schedule.c.created >= cutoff, schedule.c.next_poll != None))
+    for sub_id, created, next_poll, interval, polls in session.execute(query):
+        known.add(sub_id)
+        scheduler.add(SnapshotTask(sub_id, created, next_poll, interval, polls or 0))
+
+    submissions = commentDB.Submission.__table__
+    enrolled = 0
+    for s in sessions:
+        query = select([submissions.c.sub_id, submissions.c.timestamp]). \
+                where(submissions.c.timestamp >= cutoff)
+        for sub_id, created in s.execute(query):
+            if sub_id in known or writer.contains(commentDB.SnapshotSchedule(sub_id=sub_id)):
+                continue
+            known.add(sub_id)
+            task = SnapshotTask(sub_id, created)
+            writer.merge(commentDB.SnapshotSchedule(sub_id=sub_id, created=created,
+                                                    next_poll=task.next_poll, polls=0))
+            scheduler.add(task)
+            enrolled += 1
+    print('Tracking scores of %d submissions (%d newly enrolled)' %
+          (len(scheduler), enrolled))
+    return scheduler
+
+
+# Input: home database session, task polled, poll time, this poll's
+#        {fullname: [score, ups, downs, best_rank]}, writer
+# Output: fraction of tracked values that changed
+#
+# Writes the changed values as ScoreSnapshot rows, and the new values
+# and schedule of the submission
+def record_poll(session, task, timestamp, values, writer):
+    if task.values is None:
+        packed = session.execute(
+            select([commentDB.SnapshotSchedule.last_values]).
+            where(commentDB.SnapshotSchedule.sub_id == task.sub_id)).scalar()
+        task.values = commentDB.unpack_history(packed) if packed else {}
+
+    merged = dict(task.values)
+    merged.update(values)
+    snapshots, changed = diff_values(task.values, values, timestamp)
+    for snapshot in snapshots:
+        writer.append(snapshot)
+    metrics.count('snapshots', len(snapshots))
+    task.values = merged
+    task.polls += 1
+    n_values = sum(1 for v in values.values() for x in v if x is not None)
+    return float(changed) / n_values if n_values else 0.0
+
+
+# Queue the schedule row of a task after it is rescheduled; next_poll is
+# NULL once it is no longer tracked
+def save_task(task, tracked, timestamp, writer):
+    writer.merge(commentDB.SnapshotSchedule(
+        sub_id=task.sub_id, created=task.created,
+        next_poll=task.next_poll if tracked else None,
+        interval=task.interval, last_poll=timestamp, polls=task.polls,
+        last_values=commentDB.pack_history(task.values or {})))
+
+
+# Input: session, comment or submission fullname
+# Output: list of (time, score, ups, downs, best_rank), with the deltas
+#         stored by snapshot polls filled in
+def score_history(session, thing_id):
+    snapshots = commentDB.ScoreSnapshot.__table__
+    query = select([snapshots.c.timestamp, snapshots.c.changed] +
+                   [snapshots.c[f] for f in SNAPSHOT_FIELDS]). \
+            where(snapshots.c.thing_id == thing_id).order_by(snapshots.c.timestamp)
+    history = []
+    current = [None] * len(SNAPSHOT_FIELDS)
+    for row in session.execute(query):
+        mask = row[1]
+        current = [v if (mask & (1 << i) if mask is not None else v is not None) else c
+                   for i, (v, c) in enumerate(zip(row[2:], current))]
+        history.append((row[0],) + tuple(current))
+    return history
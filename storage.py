@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+##
+# Social Web Comment Ranking
+#
+# Sharded storage: crawl output partitioned by subreddit or month into
+# separate databases, and merging of shards into one analysis database
+##
+
+import os
+import re
+from argparse import ArgumentParser
+from collections import OrderedDict, defaultdict
+from datetime import datetime
+from glob import glob
+from time import time
+
+from sqlalchemy import and_, bindparam, inspect, select, text, tuple_
+from sqlalchemy.orm import sessionmaker
+
+import commentDB
+from dbwriter import BulkWriter
+from idcache import CACHE_SIZE
+from search import rebuild
+
+SHARD_KEYS = ('subreddit', 'month')
+
+# Rows read from a source per transaction when merging
+MERGE_CHUNK = 5000
+# Keys per IN (...) lookup, within SQLite's bound parameter limit
+LOOKUP_BATCH = 400
+
+
+# Input: SQLite file name or SQLAlchemy URL
+# Output: engine on an up-to-date schema; directories of new SQLite files
+#         are created
+def open_database(target, performance=False, echo=False):
+    if '://' not in target:
+        dirname = os.path.dirname(target)
+        if dirname and not os.path.isdir(dirname):
+            os.makedirs(dirname)
+    engine = commentDB.make_engine(target, performance=performance, echo=echo)
+    commentDB.upgrade_schema(engine)
+    return engine
+
+
+class ShardRouter(object):
+    """Picks the database a submission is stored in.
+
+    `template` is an SQLite file name or SQLAlchemy URL containing
+    {subreddit} (lowercased display name) and/or {month} (YYYY-MM of the
+    submission's post time), e.g. 'shards/{subreddit}-{month}.sqlite'.
+    """
+
+    def __init__(self, template):
+        fields = set(re.findall(r'{(\w*)}', template))
+        unknown = fields - set(SHARD_KEYS)
+        if unknown:
+            raise ValueError('Unknown shard key %s in %s; use %s' %
+                             (', '.join(sorted(unknown)), template,
+                              ' or '.join('{%s}' % k for k in SHARD_KEYS)))
+        if not fields:
+            raise ValueError('Shard template %s has no shard key' % template)
+        self.template = template
+
+    # Output: targets of the shards already created under this template,
+    # found by globbing it; only SQLite files can be found this way
+    def existing(self):
+        prefix = 'sqlite:///' if self.template.startswith('sqlite:///') else ''
+        if '://' in self.template and not prefix:
+            return []
+        pattern = self.template[len(prefix):].format(subreddit='*', month='*')
+        return [prefix + path for path in sorted(glob(pattern))]
+
+    def target(self, subreddit, created_utc):
+        month = datetime.utcfromtimestamp(created_utc).strftime('%Y-%m')
+        return self.template.format(subreddit=subreddit.lower(), month=month)
+
+    # Input: PRAW (or cached) submission
+    def route(self, submission):
+        return self.target(submission.subreddit.display_name,
+                           submission.created_utc)
+
+
+class ShardedWriter(object):
+    """BulkWriter front end for sharded crawls.
+
+    Each submission's rows (the submission, its comments and their
+    authors) go to the shard the router picks, through
+    shard(submission); shards are opened on first use, one BulkWriter
+    each. Everything added or merged directly (subreddits, crawl and fetch
+    state, user profiles and activity) goes to the home writer, so a crawl
+    resumes from the home database alone. Subreddit rows are copied to
+    every shard too, so each shard can be analysed on its own.
+
+    Shards only take writes from this process: crawl machines should each
+    use their own home database and shard files, then combine them with
+    ShardMerger.
+    """
+
+    def __init__(self, home, router, batch_size=1000, cache_size=CACHE_SIZE,
+                 performance=False, echo=False):
+        self.home = home
+        self.router = router
+        self.batch_size = batch_size
+        self.cache_size = cache_size
+        self.performance = performance
+        self.echo = echo
+        self._shards = OrderedDict()        # target -> BulkWriter
+        self._subreddits = []
+
+    @property
+    def session(self):
+        return self.home.session
+
+    # Output: writer for this submission's rows
+    def shard(self, submission):
+        return self._open(self.router.route(submission))
+
+    def _open(self, target):
+        writer = self._shards.get(target)
+        if writer is None:
+            engine = open_database(target, self.performance, self.echo)
+            writer = BulkWriter(sessionmaker(bind=engine)(), self.batch_size,
+                                self.cache_size)
+            for model in self._subreddits:
+                writer.add(model)
+            self._shards[target] = writer
+        return writer
+
+    # Output: sessions of the home database and every shard, including
+    # shards created by earlier runs (e.g. for `users` or `--snapshot`
+    # runs, which route no submissions themselves)
+    def sessions(self):
+        home = self.home.session.bind.url.database
+        for target in self.router.existing():
+            path = target[len('sqlite:///'):] if '://' in target else target
+            if not (home and os.path.abspath(path) == os.path.abspath(home)):
+                self._open(target)
+        return [self.home.session] + [w.session for w in self._shards.values()]
+
+    # Shards' identity caches are warmed as they are opened
+    def warm(self, *models):
+        self.home.warm(*models)
+
+    def contains(self, model):
+        return self.home.contains(model)
+
+    def known(self, model, key):
+        return self.home.known(model, key)
+
+    def submission_of(self, com_id):
+        for writer in [self.home] + list(self._shards.values()):
+            sub_id = writer.submission_of(com_id)
+            if sub_id is not None:
+                return sub_id
+        return None
+
+    def add(self, model):
+        if isinstance(model, commentDB.Subreddit):
+            self._subreddits.append(model)
+            for writer in self._shards.values():
+                writer.add(model)
+        return self.home.add(model)
+
+    def merge(self, model):
+        self.home.merge(model)
+
+    def append(self, model):
+        self.home.append(model)
+
+    @property
+    def pending(self):
+        return self.home.pending + sum(w.pending for w in self._shards.values())
+
+    def stats(self):
+        stats = self.home.stats()
+        stats['shards'] = dict((target, writer.stats())
+                               for target, writer in self._shards.items())
+        return stats
+
+    # Shards first, so fetch state in the home database never runs ahead
+    # of the rows it describes
+    def flush(self):
+        for writer in self._shards.values():
+            writer.flush()
+        self.home.flush()
+
+    def close(self):
+        self.flush()
+
+    def report(self):
+        print('Home database:')
+        self.home.report()
+        for target, writer in self._shards.items():
+            print('Shard %s:' % target)
+            writer.report()
+
+
+#####################
+# Merge and compact #
+#####################
+
+# How rows found in more than one source are resolved:
+#   fill    - fields are combined; non-null values from later sources win
+#   newest  - the row with the latest timestamp (fetch or update time) wins
+#   replace - the row from the later source wins
+# user_activities rows have no natural primary key; they are matched on
+# (user_name, subreddit_id), and the later source wins. Within a source the
+# latest row (highest id) of each pair wins, as in commentDB.latest_activity.
+MERGE_POLICY = {'subreddits': 'fill',
+                'users': 'fill',
+                'user_histories': 'newest',
+                'crawl_state': 'newest',
+                'submission_state': 'newest'}
+ACTIVITY_KEY = ('user_name', 'subreddit_id')
+
+
+def _key(row, cols):
+    key = tuple(row[c] for c in cols)
+    return key[0] if len(key) == 1 else key
+
+
+class ShardMerger(object):
+    """Combines crawl databases into one output database.
+
+    Sources are read MERGE_CHUNK rows at a time and should be given
+    oldest first, so later crawls win where MERGE_POLICY says so. Tables
+    are copied parents before children, and a source missing columns
+    added since it was created leaves those columns as they are in the
+    output (NULL in rows new to it).
+    """
+
+    def __init__(self, engine, chunk_size=MERGE_CHUNK):
+        self.engine = engine
+        self.chunk_size = chunk_size
+        self.started = time()
+        self.rows_read = defaultdict(int)
+        self.rows_written = defaultdict(int)
+        self.write_time = defaultdict(float)
+        self.conflicts = defaultdict(int)
+
+    # Output: {primary key: row dict} of the output rows matching `keys`
+    def _existing(self, conn, table, keys):
+        pk = [c.name for c in table.primary_key.columns]
+        if len(pk) == 1:
+            match = lambda batch: table.c[pk[0]].in_(batch)
+        else:
+            match = lambda batch: tuple_(*[table.c[c] for c in pk]).in_(batch)
+        found = {}
+        for i in range(0, len(keys), LOOKUP_BATCH):
+            for r in conn.execute(table.select().where(match(keys[i:i + LOOKUP_BATCH]))):
+                row = dict(r)
+                found[_key(row, pk)] = row
+        return found
+
+    def _merge_rows(self, conn, table, rows):
+        policy = MERGE_POLICY.get(table.name, 'replace')
+        pk = [c.name for c in table.primary_key.columns]
+        existing = self._existing(conn, table, [_key(r, pk) for r in rows])
+        self.conflicts[table.name] += len(existing)
+
+        # A winning row is laid over the existing one, so columns an older
+        # source lacks keep their values rather than being replaced by NULL
+        merged = []
+        for row in rows:
+            old = existing.get(_key(row, pk))
+            if old is None:
+                merged.append(row)
+                continue
+            combined = dict(old)
+            if policy == 'fill':
+                combined.update((k, v) for k, v in row.items() if v is not None)
+            elif policy == 'newest':
+                if old['timestamp'] is not None and \
+                        (row['timestamp'] is None or row['timestamp'] < old['timestamp']):
+                    continue
+                combined.update(row)
+            else:
+                combined.update(row)
+            merged.append(combined)
+
+        if merged:
+            conn.execute(table.insert().prefix_with('OR REPLACE'), merged)
+        return len(merged)
+
+    # Rows arrive in id order, so the last row of each pair is its latest
+    def _merge_activities(self, conn, table, rows):
+        latest = OrderedDict()
+        for row in rows:
+            key = _key(row, ACTIVITY_KEY)
+            if key in latest:
+                self.conflicts[table.name] += 1
+            latest[key] = row
+        rows = list(latest.values())
+
+        delete = table.delete().where(and_(*[table.c[c] == bindparam('_' + c)
+                                             for c in ACTIVITY_KEY]))
+        result = conn.execute(delete, [dict(('_' + c, row[c]) for c in ACTIVITY_KEY)
+                                       for row in rows])
+        self.conflicts[table.name] += max(result.rowcount, 0)
+        for row in rows:
+            row.pop('id', None)     # assigned afresh in the output
+        conn.execute(table.insert(), rows)
+        return len(rows)
+
+    # Input: engine of a source database
+    # Output: rows written from it
+    def merge(self, source):
+        inspector = inspect(source)
+        present = set(inspector.get_table_names())
+        total = 0
+        for table in commentDB.Base.metadata.sorted_tables:
+            if table.name not in present:
+                continue
+            have = set(c['name'] for c in inspector.get_columns(table.name))
+            cols = [c for c in table.columns if c.name in have]
+
+            conn = source.connect().execution_options(stream_results=True)
+            try:
+                query = select(cols)
+                if table.name == commentDB.UserActivity.__tablename__:
+                    query = query.order_by(table.c.id)
+                result = conn.execute(query)
+                while True:
+                    chunk = result.fetchmany(self.chunk_size)
+                    if not chunk:
+                        break
+                    rows = [dict(r) for r in chunk]
+                    self.rows_read[table.name] += len(rows)
+                    start = time()
+                    with self.engine.begin() as out:
+                        if table.name == commentDB.UserActivity.__tablename__:
+                            n = self._merge_activities(out, table, rows)
+                        else:
+                            n = self._merge_rows(out, table, rows)
+                    self.write_time[table.name] += time() - start
+                    self.rows_written[table.name] += n
+                    total += n
+            finally:
+                conn.close()
+        return total
+
+    def compact(self, vacuum=False):
+        """Refresh query planner statistics, and with vacuum=True rebuild
+        the output file without free pages (SQLite only). VACUUM may
+        renumber rowids, so search indexes are rebuilt after it."""
+        with self.engine.connect() as conn:
+            conn.execute(text('ANALYZE'))
+            if vacuum and self.engine.dialect.name == 'sqlite':
+                conn.execute(text('VACUUM'))
+        if vacuum:
+            rebuild(self.engine)
+
+    def report(self):
+        elapsed = time() - self.started
+        print('Merged in %.1fs' % elapsed)
+        for name in sorted(self.rows_read):
+            print('  %-16s %8d rows read  %8d written  %6d duplicates resolved  '
+                  '%9.1f rows/s  %6.1fs writing' %
+                  (name, self.rows_read[name], self.rows_written[name],
+                   self.conflicts[name],
+                   self.rows_read[name] / elapsed if elapsed else 0.0,
+                   self.write_time[name]))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Merge crawl databases and shards into '
+                                        'one analysis database')
+    parser.add_argument('sources', type=str, nargs='+',
+                        help="SQLite files or SQLAlchemy URLs to merge, oldest crawl first.")
+    parser.add_argument('-o', '--output', type=str, required=True,
+                        help="SQLite file or SQLAlchemy URL to merge into; "
+                             "existing rows are kept unless a source wins over them.")
+    parser.add_argument('--vacuum', action='store_true',
+                        help="Rebuild the output file once merged, to reclaim free space.")
+    parser.add_argument('--fast-sqlite', dest='fast_sqlite', action='store_true',
+                        help="Use the SQLite performance profile (WAL, relaxed fsync, mmap).")
+    args = parser.parse_args()
+
+    merger = ShardMerger(open_database(args.output, performance=args.fast_sqlite))
+    for source in args.sources:
+        if os.path.abspath(source) == os.path.abspath(args.output):
+            print('Skipping %s: it is the output database' % source)
+            continue
+        if '://' not in source and not os.path.exists(source):
+            print('ERROR: %s does not exist' % source)
+            continue
+        n = merger.merge(commentDB.make_engine(source))
+        print('Merged %d rows from %s' % (n, source))
+    merger.compact(vacuum=args.vacuum)
+    merger.report()
@@ -0,0 +1,172 @@
+##
+# Social Web Comment Ranking
+#
+# Streaming expansion of large comment trees, with bounded memory
+##
+
+from array import array
+from collections import defaultdict, deque
+
+from sqlalchemy import bindparam
+
+import commentDB
+from treewalk import extend_path, subtree_metrics
+
+# 'more comments' children requested per API call
+CHUNK_SIZE = 100
+# Rows per UPDATE batch when filling in tree metrics
+UPDATE_BATCH = 1000
+
+
+class CommentStream(object):
+    """Iterates over a submission's comments as they are fetched, without
+    building the expanded forest in memory.
+
+    Yields (comment, rank, depth) for each comment: parents before their
+    children, siblings in the order reddit returns them. 'More comments'
+    stubs are expanded first in, first out, CHUNK_SIZE children per API
+    call, and each response is dropped once its comments have been
+    handed out. For the whole thread only a fullname -> index map, a
+    reply counter per parent, and compact arrays of parent index and
+    depth are kept.
+
+    num_replies, convo_depth and subtree_size need the whole tree; fill
+    them in afterwards with update_tree_metrics.
+
+    `call` wraps each API call (e.g. safe_praw_call); if it returns False
+    the stub is recorded in `failed` and skipped.
+    """
+
+    def __init__(self, submission, is_comment, call=None, chunk_size=CHUNK_SIZE):
+        self.submission = submission
+        self.is_comment = is_comment
+        self.call = call or (lambda f: f())
+        self.chunk_size = chunk_size
+        self.failed = []
+        self.requests = 0
+        self.index = {}                 # fullname -> index, in arrival order
+        self.parent = array('l')        # parent index, -1 for top-level
+        self.depth = array('l')
+
+    def _expand(self, more):
+        children = list(more.children)
+        if not more.count or len(children) <= self.chunk_size:
+            chunks = [children]     # 'continue this thread' stubs have count 0
+        else:
+            chunks = [children[i:i + self.chunk_size]
+                      for i in range(0, len(children), self.chunk_size)]
+        for chunk in chunks:
+            more.children = chunk
+            more._comments = None
+            self.requests += 1
+            comments = self.call(lambda: more.comments(update=False))
+            if comments is False:
+                self.failed.append(more)
+                continue
+            yield comments or []
+
+    # Output: generator over the first page, then each 'more comments'
+    # response. Pages are popped off `first` so no reference outlives them.
+    def _responses(self, first, pending):
+        yield first.pop()
+        while pending:
+            for comments in self._expand(pending.popleft()):
+                yield comments
+
+    def __iter__(self):
+        submission = self.submission
+        first_page = self.call(lambda: list(submission.comments))
+        if first_page is False:
+            self.failed.append(submission)
+            return
+
+        # Drop the submission's references to its comments (PRAW keeps
+        # every comment in _comments_by_id), so they can be freed once
+        # they have been handed out. They are fetched again if accessed,
+        # e.g. when a failed thread is retried.
+        submission._comments = None
+        by_id = getattr(submission, '_comments_by_id', None)
+        if by_id is not None:
+            by_id.clear()
+
+        index, parents, depths = self.index, self.parent, self.depth
+        replies = defaultdict(int)  # parent fullname -> replies seen so far
+        pending = deque()
+        first = [first_page]
+        del first_page
+        for comments in self._responses(first, pending):
+            stack = list(reversed(comments))
+            del comments
+            while stack:
+                item = stack.pop()
+                if not self.is_comment(item):
+                    # Expanded through the submission's praw.Reddit, which
+                    # may not be the one that fetched the stub
+                    item.submission = submission
+                    if hasattr(item, 'reddit_session'):
+                        item.reddit_session = submission.reddit_session
+                    pending.append(item)
+                    continue
+
+                # PRAW comments from morechildren don't know their
+                # submission, and would fetch it to build a permalink
+                if getattr(item, '_submission', False) is None:
+                    item._submission = submission
+                parent = item.parent_id
+                p = index.get(parent, -1)
+                depth = depths[p] + 1 if p >= 0 else 1
+                index[item.fullname] = len(parents)
+                parents.append(p)
+                depths.append(depth)
+                replies[parent] += 1
+                yield item, replies[parent], depth
+
+                # Comments from the first page or a continued thread
+                # arrive with their replies nested
+                stack.extend(reversed(item.replies))
+
+
+# Input: session, CommentStream that has been run to the end
+# Output: number of comments updated
+#
+# Fills in num_replies, convo_depth, subtree_size and path of the streamed
+# comments. Like walk_comment_tree, deleted comments count towards the
+# metrics of their ancestors though they are not stored.
+def update_tree_metrics(session, stream):
+    if not stream.index:
+        return 0
+    num_replies, convo_depth, subtree_size = subtree_metrics(stream.parent)
+
+    # Parents arrive before their children, so one pass in arrival order
+    # extends each parent's path. A comment that arrived twice keeps its
+    # last index only; its earlier slot has no name.
+    names = [None] * len(stream.parent)
+    for com_id, i in stream.index.items():
+        names[i] = com_id
+    paths = []
+    for i, p in enumerate(stream.parent):
+        path = paths[p] if p >= 0 else ''
+        paths.append(extend_path(path, names[i]) if names[i] else path)
+
+    comments = commentDB.Comment.__table__
+    update = comments.update().where(comments.c.com_id == bindparam('_com_id')). \
+             values(num_replies=bindparam('_num_replies'),
+                    convo_depth=bindparam('_convo_depth'),
+                    subtree_size=bindparam('_subtree_size'),
+                    path=bindparam('_path'))
+    batch = []
+    for i, com_id in enumerate(names):
+        if com_id is None:
+            continue
+        batch.append({'_com_id': com_id,
+                      '_num_replies': int(num_replies[i]),
+                      '_convo_depth': int(convo_depth[i]),
+                      '_subtree_size': int(subtree_size[i]),
+                      '_path': paths[i]})
+        if len(batch) >= UPDATE_BATCH:
+            session.execute(update, batch)
+            batch = []
+    if batch:
+        session.execute(update, batch)
+    session.commit()
+    return len(stream.index)
@@ -0,0 +1,180 @@
+##
+# Social Web Comment Ranking
+#
+# Stub HTTP layer for running real PRAW objects without network access
+##
+
+import json
+import threading
+from collections import OrderedDict, defaultdict
+
+import praw
+import requests
+
+try:
+    from urllib.parse import parse_qs, urlparse
+except ImportError:
+    from urlparse import parse_qs, urlparse
+
+from crawler import TokenBucket
+from pipeline import DeferredLogin, TokenBucketHandler
+
+
+def _comment(com_id, parent_id, sub_id):
+    return {'id': com_id, 'name': 't1_' + com_id, 'parent_id': parent_id,
+            'link_id': sub_id, 'body': 'comment %s' % com_id, 'author': 'user_' + com_id,
+            'score': 1, 'ups': 1, 'downs': 0, 'created_utc': 1420070400.0,
+            'subreddit': 'fake', 'subreddit_id': 't5_fake', 'gilded': 0,
+            'distinguished': None, 'edited': False, 'num_reports': None,
+            'permalink': '/r/fake/comments/%s/thread/%s/' % (sub_id[3:], com_id),
+            'replies': ''}
+
+
+def _more(parent_id, children):
+    ids = [c[3:] for c in children]
+    return {'kind': 'more', 'data': {'id': ids[0], 'name': 't1_' + ids[0],
+                                     'parent_id': parent_id, 'count': len(ids),
+                                     'children': ids}}
+
+
+class FakeThread(object):
+    """A submission whose comments are given as (com_id, parent com_id or
+    None) in pre-order. The first `first_page` comments come on the
+    submission's page, nested as replies; the rest hang off 'more
+    comments' stubs of up to `stub_size` comments each, in order."""
+
+    def __init__(self, sub_id, comments, first_page=10, stub_size=20):
+        self.sub_id = sub_id
+        self.fullname = 't3_' + sub_id
+        self.parent = OrderedDict((c, p) for c, p in comments)
+        self.first_page = list(self.parent)[:first_page]
+        rest = ['t1_' + c for c in list(self.parent)[first_page:]]
+        self.stubs = [rest[i:i + stub_size] for i in range(0, len(rest), stub_size)]
+
+    def _data(self, com_id):
+        parent = self.parent[com_id]
+        return _comment(com_id, 't1_' + parent if parent else self.fullname,
+                        self.fullname)
+
+    def page(self):
+        submission = {'id': self.sub_id, 'name': self.fullname, 'title': 'thread',
+                      'selftext': '', 'is_self': True, 'author': 'op',
+                      'subreddit': 'fake', 'subreddit_id': 't5_fake',
+                      'num_comments': len(self.parent), 'score': 1, 'ups': 1,
+                      'downs': 0, 'created_utc': 1420070400.0, 'edited': False,
+                      'permalink': '/r/fake/comments/%s/thread/' % self.sub_id,
+                      'url': 'https://www.reddit.com/r/fake/comments/%s/' % self.sub_id}
+        nodes = {}
+        top = []
+        for com_id in self.first_page:
+            node = {'kind': 't1', 'data': self._data(com_id)}
+            nodes[com_id] = node
+            parent = nodes.get(self.parent[com_id])
+            if parent is None:
+                top.append(node)
+                continue
+            replies = parent['data']['replies']
+            if not replies:
+                replies = parent['data']['replies'] = \
+                    {'kind': 'Listing', 'data': {'children': []}}
+            replies['data']['children'].append(node)
+        top.extend(_more(self.fullname, stub) for stub in self.stubs)
+        return [{'kind': 'Listing', 'data': {'children': [
+                    {'kind': 't3', 'data': submission}]}},
+                {'kind': 'Listing', 'data': {'children': top}}]
+
+    # Output: {com_id: (depth, num_replies, convo_depth, subtree_size)},
+    # from the parent links
+    def metrics(self):
+        children = defaultdict(list)
+        depth, height, size = {}, {}, {}
+        for com_id, parent in self.parent.items():     # parents come first
+            children[parent].append(com_id)
+            depth[com_id] = depth[parent] + 1 if parent else 1
+        for com_id in reversed(list(self.parent)):
+            kids = children[com_id]
+            height[com_id] = 1 + max([height[c] for c in kids] or [0])
+            size[com_id] = 1 + sum(size[c] for c in kids)
+        return dict((c, (depth[c], len(children[c]), height[c], size[c]))
+                    for c in self.parent)
+
+    def more_children(self, children):
+        return {'json': {'errors': [], 'data': {'things': [
+            {'kind': 't1', 'data': self._data(c)} for c in children]}}}
+
+
+# Output: (com_id, parent com_id or None) of n comments in breadth-first
+# order, comment i replying to comment (i - 1) // fanout
+def tree(sub_id, n, fanout=3):
+    ids = ['%sc%d' % (sub_id, i) for i in range(n)]
+    return [(ids[i], ids[(i - 1) // fanout] if i else None) for i in range(n)]
+
+
+class FakeHTTP(object):
+    """Stands in for the requests.Session of a PRAW handler, answering
+    login, submission page and morechildren requests for FakeThreads.
+    Requests whose number (counting from 1) is in `fail_at` get a 500."""
+
+    def __init__(self, threads=(), fail_at=()):
+        self.threads = dict((t.sub_id, t) for t in threads)
+        self.fail_at = set(fail_at)
+        self.requests = []
+        self._lock = threading.Lock()
+
+    def merge_environment_settings(self, url, proxies, stream, verify, cert):
+        return {'proxies': proxies, 'stream': stream, 'verify': verify, 'cert': cert}
+
+    def _response(self, request, status, body, headers=None):
+        response = requests.Response()
+        response.status_code = status
+        response.url = request.url
+        response.request = request
+        response.headers['content-type'] = 'application/json; charset=UTF-8'
+        response.headers.update(headers or {})
+        response._content = json.dumps(body).encode('utf-8')
+        return response
+
+    def send(self, request, **_):
+        with self._lock:
+            self.requests.append((request.method, request.url))
+            n = len(self.requests)
+        if n in self.fail_at:
+            return self._response(request, 500, {}, {'retry-after': '0'})
+
+        path = urlparse(request.url).path
+        form = parse_qs(request.body or '')
+        if path.startswith('/api/login'):
+            return self._response(request, 200, {'json': {'errors': [], 'data': {
+                'modhash': 'modhash', 'cookie': 'cookie'}}})
+        if path.startswith('/api/morechildren'):
+            thread = self.threads[form['link_id'][0][3:]]
+            return self._response(request, 200, thread.more_children(
+                form['children'][0].split(',')))
+        parts = path.split('/')
+        if 'comments' in parts:     # /comments/<id> or a permalink
+            thread = self.threads[parts[parts.index('comments') + 1].split('.')[0]]
+            return self._response(request, 200, thread.page())
+        return self._response(request, 404, {})
+
+    def close(self):
+        pass
+
+    def count(self, part):
+        return sum(1 for _, url in self.requests if part in urlparse(url).path)
+
+
+# Output: praw.Reddit answering from `http` through a TokenBucketHandler
+def make_reddit(http, bucket=None, cache=None):
+    handler = TokenBucketHandler(bucket or TokenBucket(1000, 1000), cache)
+    handler.http = http
+    return praw.Reddit(user_agent='test', handler=handler, disable_update_check=True)
+
+
+def make_login(http, bucket=None, cache=None):
+    return DeferredLogin(make_reddit(http, bucket, cache), 'user', 'password')
+
+
+# Output: the thread's submission as a search listing returns it, with its
+# comments not yet fetched
+def listed(reddit, thread):
+    return praw.objects.Submission(reddit, json_dict=thread.page()[0]['data']['children'][0]['data'])
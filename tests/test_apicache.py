@@ -0,0 +1,56 @@
+##
+# Social Web Comment Ranking
+#
+# ResponseCache: which cached response a thing is read back from
+##
+
+import json
+import shutil
+import tempfile
+import unittest
+from time import sleep
+
+from sqlalchemy import text
+
+from apicache import ResponseCache
+
+URL = 'https://api.reddit.com/api/info.json'
+
+
+def _body(score):
+    return json.dumps({'kind': 'Listing', 'data': {'children': [
+        {'kind': 't1', 'data': {'id': 'c1', 'name': 't1_c1', 'score': score,
+                                'link_id': 't3_s1', 'subreddit': 'Fake',
+                                'author': 'alice', 'created_utc': 1420070400.0}}]}}). \
+           encode('utf-8')
+
+
+class ResponseCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cachedir = tempfile.mkdtemp()
+        self.cache = ResponseCache(self.cachedir)
+
+    def tearDown(self):
+        self.cache.engine.dispose()
+        shutil.rmtree(self.cachedir)
+
+    def test_latest_fetch_wins_when_an_older_body_returns(self):
+        for score in (1, 2, 1):
+            self.cache.store(URL, _body(score))
+            sleep(0.002)
+        self.assertEqual(self.cache.thing('t1_c1')['score'], 1)
+
+    def test_stored_body_missing_from_the_index_is_indexed_again(self):
+        # As after a crash between writing the body and indexing it
+        self.cache.store(URL, _body(1))
+        with self.cache.engine.begin() as conn:
+            conn.execute(text('DELETE FROM things'))
+            conn.execute(text('DELETE FROM responses'))
+        self.assertIsNone(self.cache.thing('t1_c1'))
+        self.cache.store(URL, _body(1))
+        self.assertEqual(self.cache.thing('t1_c1')['score'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
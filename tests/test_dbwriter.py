@@ -0,0 +1,80 @@
+##
+# Social Web Comment Ranking
+#
+# BulkWriter batches that the database rejects
+##
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker
+
+import commentDB
+from dbwriter import BulkWriter
+
+
+def _comment(i, **kwargs):
+    values = {'com_id': 't1_c%d' % i, 'sub_id': 't3_abc', 'text': 'comment %d' % i}
+    values.update(kwargs)
+    return commentDB.Comment(**values)
+
+
+class RejectedRowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = commentDB.make_engine(os.path.join(self.tmpdir, 'test.sqlite'))
+        commentDB.upgrade_schema(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.writer = BulkWriter(self.session, batch_size=1000)
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def _stored(self):
+        return sorted(c.com_id for c in self.session.query(commentDB.Comment))
+
+    def test_bad_rows_are_set_aside(self):
+        for i in range(20):
+            if i == 3:
+                self.writer.add(_comment(i, timestamp='not a time'))
+            elif i == 17:
+                self.writer.merge(_comment(i, text=None))
+            else:
+                self.writer.add(_comment(i))
+        self.writer.flush()
+
+        self.assertEqual(self._stored(), sorted('t1_c%d' % i for i in range(20)
+                                                if i not in (3, 17)))
+        self.assertEqual(sorted(name for name, _, _ in self.writer.rejected),
+                         ['comments'] * 2)
+        self.assertEqual(self.writer.pending, 0)
+        # Rejected keys are forgotten, so a corrected row can be added again
+        self.assertTrue(self.writer.add(_comment(3)))
+        self.writer.flush()
+        self.assertIn('t1_c3', self._stored())
+        self.assertEqual(self.writer.stats()['rejected'], 2)
+
+    def test_database_errors_keep_the_batch_queued(self):
+        for i in range(5):
+            self.writer.add(_comment(i))
+        with self.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE comments RENAME TO comments_away'))
+        self.assertRaises(OperationalError, self.writer.flush)
+        self.assertEqual(self.writer.pending, 5)
+        self.assertEqual(self.writer.rejected, [])
+
+        with self.engine.begin() as conn:
+            conn.execute(text('ALTER TABLE comments_away RENAME TO comments'))
+        self.writer.flush()
+        self.assertEqual(len(self._stored()), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
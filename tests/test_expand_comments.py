@@ -0,0 +1,87 @@
+##
+# Social Web Comment Ranking
+#
+# _expand_comments and _reset_comments on real PRAW submissions, whose
+# private comment-tree fields they depend on
+##
+
+import unittest
+
+import praw
+
+import pipeline
+from fakereddit import FakeHTTP, FakeThread, listed, make_reddit, tree
+from retry import Retrier
+
+
+def _flatten(comments):
+    found = []
+    stack = list(comments)
+    while stack:
+        comment = stack.pop()
+        found.append(comment)
+        if isinstance(comment, praw.objects.Comment):
+            stack.extend(comment.replies)
+    return found
+
+
+class ExpandCommentsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.retrier = pipeline.retrier
+        pipeline.retrier = Retrier(pipeline.RETRYABLE_ERRORS, pipeline._classify_error,
+                                   base_delay=0.01)
+        self.thread = FakeThread('abc', tree('abc', 60), first_page=10, stub_size=10)
+
+    def tearDown(self):
+        pipeline.retrier = self.retrier
+
+    # Output: the submission as the crawl gets it from a search listing
+    def _submission(self, fail_at=()):
+        self.http = FakeHTTP([self.thread], fail_at)
+        return listed(make_reddit(self.http), self.thread)
+
+    def _check_tree(self, submission):
+        comments = _flatten(submission.comments)
+        self.assertTrue(all(isinstance(c, praw.objects.Comment) for c in comments))
+        self.assertEqual(sorted(c.id for c in comments), sorted(self.thread.parent))
+        for comment in comments:
+            for reply in comment.replies:
+                self.assertEqual(reply.parent_id, comment.name)
+
+    def test_expands_every_stub(self):
+        submission = self._submission()
+        self.assertNotEqual(pipeline._expand_comments(submission), False)
+        self._check_tree(submission)
+        self.assertEqual(self.http.count('/api/morechildren'), 5)
+
+    def test_retry_after_a_failed_stub_starts_from_a_fresh_tree(self):
+        # Request 1 is the submission page, 2 the first stub
+        submission = self._submission(fail_at=(3,))
+        self.assertNotEqual(pipeline._expand_comments(submission), False)
+        self._check_tree(submission)
+        self.assertEqual(self.http.count('/comments/'), 2)
+
+    def test_retrying_praw_alone_truncates_the_tree(self):
+        # Why _expand_comments resets: the stubs taken out by the failed
+        # attempt are not fetched again
+        submission = self._submission(fail_at=(3,))
+        self.assertRaises(praw.errors.HTTPException,
+                          submission.replace_more_comments, limit=None, threshold=0)
+        submission.replace_more_comments(limit=None, threshold=0)
+        self.assertLess(len(_flatten(submission.comments)), len(self.thread.parent))
+
+    def test_reset_refetches_on_access(self):
+        submission = self._submission()
+        pipeline._expand_comments(submission)
+        pipeline._reset_comments(submission)
+        self.assertFalse(submission._replaced_more)
+        self.assertEqual(submission._comments_by_id, {})
+        self.assertEqual(submission._orphaned, {})
+        comments = _flatten(submission.comments)
+        self.assertEqual(sum(isinstance(c, praw.objects.Comment) for c in comments), 10)
+        self.assertEqual(self.http.count('/comments/'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
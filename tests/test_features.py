@@ -0,0 +1,81 @@
+##
+# Social Web Comment Ranking
+#
+# Incremental feature builds, and the inputs they are built from
+##
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from sqlalchemy import select, text
+
+import commentDB
+from features import FeatureBuilder
+
+
+class FeatureBuilderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = commentDB.make_engine(os.path.join(self.tmpdir, 'test.sqlite'))
+        commentDB.upgrade_schema(self.engine)
+        now = datetime(2015, 1, 1)
+        with self.engine.begin() as conn:
+            for sub_id in ('t3_a', 't3_b'):
+                conn.execute(commentDB.Submission.__table__.insert(),
+                             {'sub_id': sub_id, 'timestamp': now, 'title': sub_id,
+                              'text': ''})
+                conn.execute(commentDB.Comment.__table__.insert(), [
+                    {'com_id': '%s_%d' % (sub_id, i), 'sub_id': sub_id,
+                     'text': 'comment', 'score': 10, 'best_rank': 1, 'depth': 1,
+                     'num_replies': 0, 'subtree_size': 1, 'timestamp': now}
+                    for i in range(3)])
+        FeatureBuilder(self.engine).refresh()
+
+    def tearDown(self):
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def _stale(self):
+        stale, _ = FeatureBuilder(self.engine).stale()
+        return [sub_id for sub_id, _ in stale]
+
+    def test_unchanged_submissions_are_not_rebuilt(self):
+        self.assertEqual(self._stale(), [])
+
+    def test_changes_that_cancel_in_sums_are_seen(self):
+        # Totals of score, best_rank and score * best_rank stay the same
+        with self.engine.begin() as conn:
+            conn.execute(text("UPDATE comments SET score = 11 WHERE com_id = 't3_a_0'"))
+            conn.execute(text("UPDATE comments SET score = 9 WHERE com_id = 't3_a_1'"))
+        self.assertEqual(self._stale(), ['t3_a'])
+
+    def test_values_moving_between_comments_are_seen(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("UPDATE comments SET depth = 2 WHERE com_id = 't3_b_0'"))
+            conn.execute(text("UPDATE comments SET depth = 0 WHERE com_id = 't3_b_1'"))
+        self.assertEqual(self._stale(), ['t3_b'])
+
+    def test_features_use_the_latest_of_duplicate_activity_rows(self):
+        with self.engine.begin() as conn:
+            conn.execute(text("UPDATE comments SET user_name = 'alice', "
+                              "subreddit_id = 't5_x' WHERE sub_id = 't3_a'"))
+            conn.execute(commentDB.User.__table__.insert(), {'name': 'alice'})
+            for karma in (5, 8):
+                conn.execute(commentDB.UserActivity.__table__.insert(),
+                             {'user_name': 'alice', 'subreddit_id': 't5_x',
+                              'comment_net_karma': karma})
+        FeatureBuilder(self.engine).refresh()
+        features = commentDB.CommentFeatures.__table__
+        with self.engine.connect() as conn:
+            karma = [r[0] for r in conn.execute(
+                select([features.c.user_comment_karma]).
+                where(features.c.sub_id == 't3_a'))]
+        self.assertEqual(karma, [8, 8, 8])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,114 @@
+##
+# Social Web Comment Ranking
+#
+# TokenBucketHandler, DeferredLogin and ThreadReddit on real PRAW objects
+##
+
+import threading
+import unittest
+from time import time
+
+from crawler import TokenBucket, bounded_map
+from fakereddit import FakeHTTP, FakeThread, listed, make_login, make_reddit
+from pipeline import ThreadReddit
+
+
+def _thread(sub_id, n=30):
+    return FakeThread(sub_id, [('%s%d' % (sub_id, i), None) for i in range(n)],
+                      first_page=5, stub_size=10)
+
+
+class RecordingCache(object):
+    def __init__(self):
+        self.urls = []
+
+    def store(self, url, body):
+        self.urls.append(url)
+
+
+class TokenBucketHandlerTest(unittest.TestCase):
+
+    def test_requests_draw_from_the_bucket_not_praws_delay(self):
+        http = FakeHTTP([_thread('abc')])
+        bucket = TokenBucket(1000, 1000)
+        r = make_reddit(http, bucket)
+        r.config.api_request_delay = 2.0
+        start = time()
+        r.get_submission(submission_id='abc').replace_more_comments(limit=None,
+                                                                     threshold=0)
+        self.assertLess(time() - start, 1.0)
+        self.assertEqual(len(http.requests), 4)
+        self.assertEqual(bucket.acquired, 4)
+
+    def test_rate_is_the_buckets(self):
+        http = FakeHTTP([_thread('abc')])
+        r = make_reddit(http, TokenBucket(20, 1))
+        start = time()
+        r.get_submission(submission_id='abc').replace_more_comments(limit=None,
+                                                                     threshold=0)
+        self.assertGreaterEqual(time() - start, 3 / 20.0 * 0.9)
+
+    def test_json_responses_are_cached(self):
+        http = FakeHTTP([_thread('abc')])
+        cache = RecordingCache()
+        r = make_reddit(http, cache=cache)
+        r.get_submission(submission_id='abc')
+        self.assertEqual([u for _, u in http.requests], cache.urls)
+
+
+class DeferredLoginTest(unittest.TestCase):
+
+    def test_logs_in_once_on_first_use(self):
+        http = FakeHTTP([_thread('abc')])
+        r = make_login(http)
+        self.assertEqual(http.requests, [])
+        threads = [threading.Thread(target=r.get_submission,
+                                    kwargs={'submission_id': 'abc'})
+                   for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(http.count('/api/login'), 1)
+        self.assertEqual(http.count('/comments/'), 4)
+        self.assertEqual(r.modhash, 'modhash')
+
+
+class ThreadRedditTest(unittest.TestCase):
+
+    def test_one_instance_per_thread(self):
+        threads = [_thread('t%d' % i) for i in range(8)]
+        http = FakeHTTP(threads)
+        r = ThreadReddit(lambda: make_login(http))
+        submissions = [listed(r.logged_in(), t) for t in threads]
+
+        def expand(submission):
+            r.adopt(submission)
+            submission.replace_more_comments(limit=None, threshold=0)
+            return threading.current_thread(), submission.reddit_session
+
+        used = dict(result for _, result in bounded_map(expand, submissions, 4))
+        sessions = [s for s in used.values()]
+        self.assertEqual(len(set(map(id, sessions))), len(used))
+        self.assertNotIn(id(r.logged_in()), set(map(id, sessions)))
+        self.assertEqual(http.count('/api/login'), len(used) + 1)
+        for submission in submissions:
+            self.assertEqual(len(submission.comments), 30)
+
+    def test_adopt_rebinds_to_the_calling_thread(self):
+        http = FakeHTTP([_thread('abc')])
+        r = ThreadReddit(lambda: make_login(http))
+        submission = r.get_submission(submission_id='abc')
+        main = submission.reddit_session
+        seen = []
+        worker = threading.Thread(target=lambda: seen.append(
+            r.adopt(submission).reddit_session))
+        worker.start()
+        worker.join()
+        self.assertIsNot(seen[0], main)
+        r.adopt(submission)
+        self.assertIs(submission.reddit_session, main)
+
+
+if __name__ == '__main__':
+    unittest.main()
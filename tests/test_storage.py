@@ -0,0 +1,62 @@
+##
+# Social Web Comment Ranking
+#
+# Merging crawl databases with ShardMerger
+##
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from sqlalchemy import select
+
+import commentDB
+from storage import ShardMerger
+
+
+class MergeActivitiesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _database(self, name, activities):
+        engine = commentDB.make_engine(os.path.join(self.tmpdir, name))
+        commentDB.upgrade_schema(engine)
+        with engine.begin() as conn:
+            conn.execute(commentDB.User.__table__.insert(),
+                         [{'name': 'alice'}, {'name': 'bob'}])
+            for u, s, n in activities:
+                conn.execute(commentDB.UserActivity.__table__.insert(),
+                             {'user_name': u, 'subreddit_id': s, 'comment_count': n})
+        return engine
+
+    def _merged(self, *sources, **kwargs):
+        out = self._database(tempfile.mktemp(suffix='.sqlite', dir=self.tmpdir), [])
+        merger = ShardMerger(out, **kwargs)
+        for source in sources:
+            merger.merge(source)
+        a = commentDB.UserActivity.__table__
+        with out.connect() as conn:
+            return sorted(tuple(r) for r in conn.execute(
+                select([a.c.user_name, a.c.subreddit_id, a.c.comment_count])))
+
+    def test_latest_row_of_each_pair_wins(self):
+        # A rerun stored alice's activity in t5_a twice
+        source = self._database('a.sqlite', [('alice', 't5_a', 1), ('bob', 't5_a', 5),
+                                             ('alice', 't5_a', 2), ('alice', 't5_b', 3)])
+        expected = [('alice', 't5_a', 2), ('alice', 't5_b', 3), ('bob', 't5_a', 5)]
+        self.assertEqual(self._merged(source), expected)
+        self.assertEqual(self._merged(source, chunk_size=1), expected)
+
+    def test_later_source_wins(self):
+        older = self._database('a.sqlite', [('alice', 't5_a', 1), ('alice', 't5_a', 2)])
+        newer = self._database('b.sqlite', [('alice', 't5_a', 7)])
+        self.assertEqual(self._merged(older, newer), [('alice', 't5_a', 7)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+##
+# Social Web Comment Ranking
+#
+# Streaming a real PRAW submission's comments into the database
+##
+
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from sqlalchemy.orm import sessionmaker
+
+import commentDB
+import pipeline
+from dbwriter import BulkWriter
+from fakereddit import FakeHTTP, FakeThread, listed, make_login, tree
+from pipeline import ThreadReddit
+
+
+class LoadCommentsStreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = commentDB.make_engine(os.path.join(self.tmpdir, 'test.sqlite'))
+        commentDB.upgrade_schema(self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        self.writer = BulkWriter(self.session, batch_size=50)
+        # Stubs larger than CHUNK_SIZE are fetched in several requests
+        self.thread = FakeThread('abc', tree('abc', 400), first_page=20, stub_size=150)
+        self.http = FakeHTTP([self.thread])
+        self.reddit = ThreadReddit(lambda: make_login(self.http))
+
+    def tearDown(self):
+        self.session.close()
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_streams_a_page_fetched_on_another_thread(self):
+        submission = listed(self.reddit.logged_in(), self.thread)
+        # As load_subreddits does: the first page is fetched on a worker,
+        # then the thread is stored on the calling thread
+        worker = threading.Thread(target=lambda: pipeline._fetch_comments(
+            self.reddit.adopt(submission), stream_threshold=1))
+        worker.start()
+        worker.join()
+        self.reddit.adopt(submission)
+
+        count = pipeline.load_comments_streaming(submission, self.writer)
+        self.assertEqual(count, 400)
+        stored = dict((c.com_id[3:], (c.depth, c.num_replies, c.convo_depth,
+                                      c.subtree_size))
+                      for c in self.session.query(commentDB.Comment))
+        self.assertEqual(stored, self.thread.metrics())
+        self.assertEqual(self.http.count('/comments/'), 1)
+        self.assertEqual(self.http.count('/api/morechildren'), 5)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+##
+# Social Web Comment Ranking
+#
+# walk_comment_tree and load_comments on real PRAW comment trees
+##
+
+import unittest
+
+import praw
+
+import pipeline
+from fakereddit import FakeHTTP, FakeThread, listed, make_reddit
+from treewalk import MAX_PATH_DEPTH, PATH_SEP, walk_comment_tree
+
+DEPTH = 3000
+
+
+# Output: (com_id, parent) of a chain of `depth` replies, with two leaf
+# replies on every 100th link, in pre-order
+def _chain(depth):
+    comments = []
+    parent = None
+    for i in range(depth):
+        com_id = 'd%d' % i
+        comments.append((com_id, parent))
+        if i % 100 == 0:
+            comments.extend(('d%db%d' % (i, j), com_id) for j in range(2))
+        parent = com_id
+    return comments
+
+
+class RecordingWriter(object):
+    def __init__(self):
+        self.models = []
+
+    def known(self, model, key):
+        return True
+
+    def add(self, model):
+        self.models.append(model)
+        return True
+
+
+class WalkCommentTreeTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        # Only the first few links come nested on the submission page; the
+        # rest arrive flat from 'more comments' requests, and PRAW hangs
+        # each under its parent
+        cls.thread = FakeThread('abc', _chain(DEPTH), first_page=5, stub_size=500)
+        cls.submission = listed(make_reddit(FakeHTTP([cls.thread])), cls.thread)
+        pipeline._expand_comments(cls.submission)
+
+    def test_metrics_match_parent_links(self):
+        walked = dict((c.id, (m.depth, m.num_replies, m.convo_depth, m.subtree_size))
+                      for c, m in walk_comment_tree(self.submission.comments,
+                                                    is_comment=pipeline._is_comment))
+        self.assertEqual(walked, self.thread.metrics())
+        self.assertEqual(walked['d0'], (1, 3, DEPTH, len(self.thread.parent)))
+
+    def test_children_before_parents(self):
+        seen = set()
+        for c, _ in walk_comment_tree(self.submission.comments):
+            self.assertIsInstance(c, praw.objects.Comment)
+            self.assertTrue(all(r.fullname in seen for r in c.replies))
+            seen.add(c.fullname)
+        self.assertEqual(len(seen), len(self.thread.parent))
+
+    def test_load_comments_caps_paths(self):
+        writer = RecordingWriter()
+        count = pipeline.load_comments(self.submission.comments, writer, 't3_abc')
+        self.assertEqual(count, len(self.thread.parent))
+        deepest = max(writer.models, key=lambda m: m.depth)
+        self.assertEqual(deepest.depth, DEPTH)
+        self.assertEqual(deepest.path.count(PATH_SEP), MAX_PATH_DEPTH)
+
+
+if __name__ == '__main__':
+    unittest.main()
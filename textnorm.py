@@ -0,0 +1,387 @@
+#!/usr/bin/env python
+##
+# Social Web Comment Ranking
+#
+# Comment text normalization, and near-duplicate detection with MinHash
+# signatures and an on-disk LSH index
+##
+
+import os
+import re
+import unicodedata
+import zlib
+from argparse import ArgumentParser
+from collections import defaultdict
+
+import numpy as np
+from sqlalchemy import (Column, Index, Integer, LargeBinary, MetaData, String,
+                        Table, bindparam, create_engine, func, select, text)
+
+import commentDB
+
+try:
+    from html import unescape
+except ImportError:     # Python 2
+    from HTMLParser import HTMLParser
+    unescape = HTMLParser().unescape
+try:
+    from urllib.parse import parse_qsl, urlencode, urlsplit
+except ImportError:     # Python 2
+    from urllib import urlencode
+    from urlparse import parse_qsl, urlsplit
+
+
+##################
+# Normalization  #
+##################
+
+REMOVED_BODIES = ('[deleted]', '[removed]')
+
+# Accounts and signatures of well-known bots; accounts named *bot are
+# treated as bots too
+BOT_AUTHORS = frozenset(['automoderator'])
+BOT_SIGNATURES = ('i am a bot', "i'm a bot", 'this action was performed automatically')
+
+# Query parameters that only track where a link was shared
+TRACKING_PARAMS = re.compile(r'^(utm_\w+|ref|ref_src|fbclid|gclid|share_id)$')
+HOST_PREFIXES = ('www.', 'm.', 'np.', 'old.', 'mobile.')
+
+URL = re.compile(r'https?://[^\s<>()\[\]]+', re.I)
+MD_LINK = re.compile(r'\[([^\]]*)\]\(\s*([^)\s]+)[^)]*\)')
+MD_CODE_FENCE = re.compile(r'^\s*(```|~~~).*$', re.M)
+MD_LINE_PREFIX = re.compile(r'^\s*(#{1,6}|>+|[-*+]|\d+[.)])\s+', re.M)
+MD_RULE = re.compile(r'^\s*([-*_]\s*){3,}$', re.M)
+MD_EMPHASIS = re.compile(r'(\*{1,3}|_{1,3}|~~|\^|`+)')
+MD_TABLE = re.compile(r'\s*\|\s*|^\s*:?-{3,}:?\s*$', re.M)
+WHITESPACE = re.compile(r'\s+')
+WORD = re.compile(r'\w+', re.U)
+
+
+def is_removed(body):
+    return body in REMOVED_BODIES
+
+
+# Input: PRAW (or cached) comment
+def is_bot(comment):
+    name = comment.author.name.lower() if comment.author is not None else ''
+    if name in BOT_AUTHORS or name.endswith('bot'):
+        return True
+    tail = comment.body[-300:].lower()
+    return any(signature in tail for signature in BOT_SIGNATURES)
+
+
+# Output: URL without scheme, common host prefixes, default ports,
+# tracking parameters, fragment or trailing slash; query parameters sorted
+def canonical_url(url):
+    url = url.rstrip('.,;:!?\'"')
+    try:
+        parts = urlsplit(url)
+        host = (parts.hostname or '').lower()
+        port = parts.port
+    except ValueError:
+        return url.lower()
+    for prefix in HOST_PREFIXES:
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    if port and port not in (80, 443):
+        host = '%s:%d' % (host, port)
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if not TRACKING_PARAMS.match(k))
+    path = parts.path.rstrip('/')
+    return host + path + ('?' + urlencode(query) if query else '')
+
+
+# Input: comment body as reddit returns it (markdown, HTML entities escaped)
+# Output: plain text: NFKC-normalized, markdown removed, links reduced to
+#         their text and canonical URL, case-folded, single-spaced
+def normalize(body):
+    s = unicodedata.normalize('NFKC', unescape(body))
+    s = MD_LINK.sub(lambda m: '%s %s' % (m.group(1), canonical_url(m.group(2))), s)
+    s = URL.sub(lambda m: canonical_url(m.group(0)), s)
+    s = MD_CODE_FENCE.sub(' ', s)
+    s = MD_RULE.sub(' ', s)
+    s = MD_LINE_PREFIX.sub('', s)
+    s = MD_TABLE.sub(' ', s)
+    s = MD_EMPHASIS.sub('', s)
+    s = s.casefold() if hasattr(s, 'casefold') else s.lower()
+    return WHITESPACE.sub(' ', s).strip()
+
+
+###########################
+# MinHash signatures, LSH #
+###########################
+
+SHINGLE_SIZE = 3        # words per shingle
+NUM_HASHES = 64
+BANDS = 16              # LSH bands of NUM_HASHES / BANDS rows
+# Comments with fewer words are never flagged ("thanks!", "this")
+MIN_WORDS = 8
+# Estimated Jaccard similarity of shingles at which comments are duplicates
+THRESHOLD = 0.7
+
+_PRIME = 4294967291     # largest prime below 2**32
+_rng = np.random.RandomState(224)
+_A = _rng.randint(1, _PRIME, size=NUM_HASHES).astype(np.uint64)
+_B = _rng.randint(0, _PRIME, size=NUM_HASHES).astype(np.uint64)
+_ROWS = NUM_HASHES // BANDS
+_MIX = np.uint64(1000003)
+
+
+# Input: normalized text
+# Output: array of distinct 32-bit shingle hashes, or None if too short.
+#         Words are hashed once, and each run of SHINGLE_SIZE word hashes
+#         is mixed into a shingle hash with vectorized (wrapping) arithmetic
+def shingles(norm):
+    words = WORD.findall(norm)
+    if len(words) < MIN_WORDS:
+        return None
+    h = np.fromiter((zlib.crc32(w.encode('utf-8')) & 0xffffffff for w in words),
+                    dtype=np.uint64, count=len(words))
+    n = len(words) - SHINGLE_SIZE + 1
+    grams = h[:n].copy()
+    for k in range(1, SHINGLE_SIZE):
+        grams = grams * _MIX + h[k:k + n]
+    return np.unique(grams & np.uint64(0xffffffff))
+
+
+# Input: shingle hashes
+# Output: NUM_HASHES minimum hashes, uint32; one vectorized pass over
+#         (shingles x hash functions)
+def minhash(hashes):
+    return ((hashes[:, None] * _A + _B) % _PRIME).min(axis=0).astype(np.uint32)
+
+
+# Output: one bucket key per band; the band number is kept in the high
+# bits so bands never collide
+def band_keys(signature):
+    return [(band << 32) | (zlib.crc32(signature[band * _ROWS:(band + 1) * _ROWS]
+                                       .tobytes()) & 0xffffffff)
+            for band in range(BANDS)]
+
+
+def similarity(a, b):
+    return float(np.count_nonzero(a == b)) / NUM_HASHES
+
+
+# On-disk index, in its own SQLite file: the signature of every original
+# (non-duplicate) comment seen, and its LSH bucket keys
+index_metadata = MetaData()
+signatures = Table('signatures', index_metadata,
+                   Column('seq', Integer, primary_key=True),    # arrival order
+                   Column('com_id', String, unique=True),
+                   Column('minhash', LargeBinary))
+buckets = Table('buckets', index_metadata,
+                Column('key', Integer, nullable=False),
+                Column('seq', Integer, nullable=False),
+                Index('ix_buckets_key', 'key'))
+progress = Table('progress', index_metadata,
+                 Column('name', String, primary_key=True),     # database scanned
+                 Column('last_rowid', Integer))
+
+# Bucket keys per IN (...) lookup
+LOOKUP_BATCH = 400
+
+
+class DedupIndex(object):
+    """Near-duplicate detector backed by an on-disk LSH index.
+
+    check() flags a comment whose shingles are at least THRESHOLD similar
+    (estimated from MinHash signatures) to a comment indexed before it,
+    and otherwise indexes it as an original. Checking a comment again
+    gives the same answer, so crawls can be repeated or resumed with the
+    same index file. New entries are buffered in memory and written every
+    `batch_size` originals, and on flush().
+    """
+
+    def __init__(self, path, threshold=THRESHOLD, batch_size=1000):
+        self.engine = create_engine('sqlite:///' + path)
+        index_metadata.create_all(self.engine)
+        self.conn = self.engine.connect()
+        self._cursor = self.conn.connection.cursor()
+        self.threshold = threshold
+        self.batch_size = batch_size
+
+        self._next_seq = (self.conn.execute(select([func.max(signatures.c.seq)])).
+                          scalar() or 0) + 1
+        self._signatures = {}               # seq -> (com_id, signature), unwritten
+        self._buckets = defaultdict(list)   # key -> [seq], unwritten
+
+        self.checked = 0
+        self.short = 0
+        self.duplicates = 0
+
+    # Lookups run once or twice per comment, so they go straight to the
+    # DB-API cursor rather than through SQLAlchemy statement compilation
+    def _query(self, sql, params):
+        for i in range(0, len(params), LOOKUP_BATCH):
+            batch = params[i:i + LOOKUP_BATCH]
+            self._cursor.execute(sql % ','.join('?' * len(batch)), batch)
+            for row in self._cursor.fetchall():
+                yield row
+
+    def _candidates(self, keys):
+        found = set()
+        for key in keys:
+            found.update(self._buckets.get(key, ()))
+        found.update(seq for (seq,) in
+                     self._query('SELECT seq FROM buckets WHERE key IN (%s)', keys))
+        return found
+
+    def _signatures_of(self, seqs):
+        found = {}
+        stored = []
+        for seq in seqs:
+            if seq in self._signatures:
+                found[seq] = self._signatures[seq]
+            else:
+                stored.append(seq)
+        for seq, com_id, blob in self._query('SELECT seq, com_id, minhash FROM signatures '
+                                             'WHERE seq IN (%s)', stored):
+            found[seq] = (com_id, np.frombuffer(blob, dtype=np.uint32))
+        return found
+
+    # Input: comment ID, normalized text
+    # Output: ID of the earliest near-duplicate, or None if the comment is
+    #         an original (or too short to compare)
+    def check(self, com_id, norm):
+        self.checked += 1
+        hashes = shingles(norm)
+        if hashes is None:
+            self.short += 1
+            return None
+        signature = minhash(hashes)
+        keys = band_keys(signature)
+
+        candidates = self._signatures_of(self._candidates(keys))
+        own = [seq for seq, (c, _) in candidates.items() if c == com_id]
+        before = own[0] if own else self._next_seq
+        for seq in sorted(candidates):
+            if seq >= before:
+                break
+            other_id, other = candidates[seq]
+            if similarity(signature, other) >= self.threshold:
+                self.duplicates += 1
+                return other_id
+        if not own:
+            self._add(com_id, signature, keys)
+        return None
+
+    def _add(self, com_id, signature, keys):
+        seq = self._next_seq
+        self._next_seq += 1
+        self._signatures[seq] = (com_id, signature)
+        for key in keys:
+            self._buckets[key].append(seq)
+        if len(self._signatures) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if not self._signatures:
+            return
+        with self.conn.begin():
+            self._cursor.executemany('INSERT INTO signatures (seq, com_id, minhash) '
+                                     'VALUES (?, ?, ?)',
+                                     [(seq, com_id, sig.tobytes())
+                                      for seq, (com_id, sig) in self._signatures.items()])
+            self._cursor.executemany('INSERT INTO buckets (key, seq) VALUES (?, ?)',
+                                     [(key, seq) for key, seqs in self._buckets.items()
+                                      for seq in seqs])
+        self._signatures = {}
+        self._buckets = defaultdict(list)
+
+    def close(self):
+        self.flush()
+        self.conn.close()
+
+    def stats(self):
+        return {'checked': self.checked, 'short': self.short,
+                'duplicates': self.duplicates}
+
+
+class TextFilter(object):
+    """Pipeline stage applied to each comment before it is stored: drops
+    bot comments, and finds near-duplicates of comments already seen."""
+
+    def __init__(self, index, skip_bots=True):
+        self.index = index
+        self.skip_bots = skip_bots
+        self.bots = 0
+
+    # Output: (keep, ID of the comment it duplicates or None)
+    def check(self, comment):
+        if self.skip_bots and is_bot(comment):
+            self.bots += 1
+            return False, None
+        return True, self.index.check(comment.fullname, normalize(comment.body))
+
+    def stats(self):
+        stats = self.index.stats()
+        stats['bots'] = self.bots
+        return stats
+
+    def close(self):
+        self.index.close()
+
+
+# Input: engine of a comment database, DedupIndex
+# Output: number of comments flagged as duplicates
+#
+# Checks the comments stored since the last run (by SQLite rowid), in
+# arrival order, and sets their dup_of column in batches
+def dedup_database(engine, index, name, chunk_size=5000):
+    comments = commentDB.Comment.__table__
+    last = index.conn.execute(select([progress.c.last_rowid]).
+                              where(progress.c.name == name)).scalar() or 0
+    update = comments.update().where(comments.c.com_id == bindparam('_com_id')). \
+             values(dup_of=bindparam('_dup_of'))
+    flagged = 0
+    while True:
+        with engine.connect() as conn:
+            rows = conn.execute(select([text('rowid'), comments.c.com_id, comments.c.text]).
+                                select_from(comments).
+                                where(text('rowid > :last')).
+                                order_by(text('rowid')).limit(chunk_size),
+                                last=last).fetchall()
+        if not rows:
+            break
+        found = []
+        for rowid, com_id, body in rows:
+            dup_of = index.check(com_id, normalize(body or ''))
+            if dup_of is not None:
+                found.append({'_com_id': com_id, '_dup_of': dup_of})
+        if found:
+            with engine.begin() as conn:
+                conn.execute(update, found)
+        flagged += len(found)
+        last = rows[-1][0]
+
+        # Progress is saved only once the index holds every original up to it
+        index.flush()
+        with index.conn.begin():
+            index.conn.execute(progress.insert().prefix_with('OR REPLACE'),
+                               name=name, last_rowid=last)
+        print('Checked comments up to row %d, %d duplicates' % (last, flagged))
+    return flagged
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Flag near-duplicate comments in a database')
+    parser.add_argument('-d', '--dbfile', type=str, default='redditDB.sqlite',
+                        help="SQLite database file of comments.")
+    parser.add_argument('-i', '--index', type=str, default='dedup.sqlite',
+                        help="Dedup index file; kept between runs, so only new "
+                             "comments are checked.")
+    parser.add_argument('--threshold', type=float, default=THRESHOLD,
+                        help="Estimated shingle similarity at which comments are duplicates.")
+    args = parser.parse_args()
+
+    engine = commentDB.make_engine(args.dbfile)
+    commentDB.upgrade_schema(engine)
+    index = DedupIndex(args.index, threshold=args.threshold)
+    try:
+        n = dedup_database(engine, index, os.path.abspath(args.dbfile))
+    finally:
+        index.close()
+    print('Flagged %d duplicates of %d comments checked (%d too short to compare)' %
+          (n, index.checked, index.short))
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+##
+# Social Web Comment Ranking
+#
+# Thread index: materialized comment paths for subtree, ancestor and
+# sibling queries, and a compact array form of the comment forest
+##
+
+from argparse import ArgumentParser
+from time import time
+
+import numpy as np
+from sqlalchemy import and_, bindparam, select
+
+import commentDB
+from treewalk import PATH_SEP, extend_path, path_segment
+
+# Submissions filled in per transaction; also keeps IN (...) lists within
+# SQLite's bound parameter limit
+SUBMISSION_BATCH = 400
+
+# Sorts right after PATH_SEP: every path below prefix P is in [P, P[:-1] + PATH_END)
+PATH_END = chr(ord(PATH_SEP) + 1)
+
+# Comments are given their path as they are loaded (see
+# pipeline.load_comments and streaming.update_tree_metrics). The path
+# includes removed comments, which are walked though not stored, so a
+# subtree is one range of the (sub_id, path) index even where it has holes.
+#
+# Paths stop growing at MAX_PATH_DEPTH segments (see treewalk.extend_path),
+# which bounds them to a few hundred characters. Comments deeper than that
+# share their ancestor's path: they are still in the path range of every
+# shallower ancestor, but their own subtrees and deep ancestors are found
+# by following parent_id, which misses comments below a removed one.
+
+
+def _require_path(comment):
+    if comment.path is None:
+        raise ValueError('Comment %s has no path; fill it in with threadindex.py'
+                         % comment.com_id)
+
+
+# Output: True if the comment is deeper than MAX_PATH_DEPTH, so its path
+#         is its ancestor's
+def capped(comment):
+    return not comment.path.endswith(path_segment(comment.com_id))
+
+
+# Output: recursive CTE of the IDs of `start` and the comments it leads to
+#         by following `link`
+def _follow(start, link):
+    c = commentDB.Comment.__table__
+    found = select([c.c.com_id, c.c.parent_id]).where(c.c.com_id == start). \
+            cte('linked', recursive=True)
+    previous = found.alias()
+    condition = c.c.parent_id == previous.c.com_id if link == 'down' \
+                else c.c.com_id == previous.c.parent_id
+    return found.union_all(select([c.c.com_id, c.c.parent_id]).where(condition))
+
+
+# Input: session, stored Comment, whether to include the comment itself
+# Output: query of the comments in its subtree, in pre-order (parents
+#         before children, siblings in ID order) down to MAX_PATH_DEPTH,
+#         and by depth below it
+def subtree(session, comment, include_self=True):
+    _require_path(comment)
+    Comment = commentDB.Comment
+    if capped(comment):
+        linked = _follow(comment.com_id, 'down')
+        query = session.query(Comment). \
+                filter(Comment.com_id.in_(select([linked.c.com_id])))
+    else:
+        query = session.query(Comment). \
+                filter(Comment.sub_id == comment.sub_id,
+                       Comment.path >= comment.path,
+                       Comment.path < comment.path[:-1] + PATH_END)
+    if not include_self:
+        query = query.filter(Comment.com_id != comment.com_id)
+    return query.order_by(Comment.path, Comment.depth)
+
+
+# Output: query of the stored ancestors of a comment, top-level comment
+#         first
+def ancestors(session, comment):
+    _require_path(comment)
+    Comment = commentDB.Comment
+    c = Comment.__table__
+    path = comment.path[:-1]
+    prefixes = [path[:i + 1] for i, ch in enumerate(path) if ch == PATH_SEP]
+    if capped(comment):
+        # Its ancestors from the one whose path it shares up are found
+        # through parent_id; the path prefixes still find those above a
+        # removed comment
+        linked = _follow(comment.parent_id, 'up')
+        ids = select([c.c.com_id]).where(and_(c.c.sub_id == comment.sub_id,
+                                              c.c.path.in_(prefixes))). \
+              union(select([linked.c.com_id]))
+        match = Comment.com_id.in_(ids)
+    else:
+        match = and_(Comment.sub_id == comment.sub_id, Comment.path.in_(prefixes))
+    return session.query(Comment).filter(match). \
+           order_by(Comment.path, Comment.depth)
+
+
+# Output: query of the other replies to the comment's parent, in 'best'
+#         order. The parent_id index already holds them in one range.
+def siblings(session, comment):
+    Comment = commentDB.Comment
+    return session.query(Comment). \
+           filter(Comment.parent_id == comment.parent_id,
+                  Comment.com_id != comment.com_id). \
+           order_by(Comment.best_rank)
+
+
+# Input: (com_id, parent_id, path) of every stored comment of some
+#        submissions
+# Output: {com_id: path} for the comments without one
+#
+# Comments stored before paths were recorded only know their stored
+# ancestors: one whose parent was removed is placed under that parent's
+# segment alone, so it sorts apart from the rest of its thread.
+def resolve_paths(rows):
+    parent_of = {}
+    paths = {}
+    for com_id, parent_id, path in rows:
+        parent_of[com_id] = parent_id
+        if path is not None:
+            paths[com_id] = path
+
+    found = {}
+    for com_id in parent_of:
+        chain = []
+        seen = set()
+        node = com_id
+        while node not in paths and node in parent_of and node not in seen:
+            chain.append(node)
+            seen.add(node)
+            node = parent_of[node]
+        if node in paths:
+            base = paths[node]
+        elif node in parent_of or node is None or not node.startswith('t1_'):
+            base = ''       # a submission, or a cycle in bad data
+        else:
+            base = path_segment(node)
+        for node in reversed(chain):
+            base = extend_path(base, node)
+            paths[node] = found[node] = base
+    return found
+
+
+# Fills in the paths of stored comments that have none, e.g. those
+# crawled before paths were recorded
+# Output: comments updated
+def refresh(engine, batch_size=SUBMISSION_BATCH):
+    comments = commentDB.Comment.__table__
+    with engine.connect() as conn:
+        sub_ids = sorted(r[0] for r in conn.execute(
+            select([comments.c.sub_id]).distinct().
+            where(comments.c.path == None)) if r[0] is not None)
+
+    update = comments.update().where(comments.c.com_id == bindparam('_com_id')). \
+             values(path=bindparam('_path'))
+    updated = 0
+    for i in range(0, len(sub_ids), batch_size):
+        batch = sub_ids[i:i + batch_size]
+        with engine.begin() as conn:
+            rows = conn.execute(select([comments.c.com_id, comments.c.parent_id,
+                                        comments.c.path]).
+                                where(comments.c.sub_id.in_(batch))).fetchall()
+            paths = resolve_paths(rows)
+            if paths:
+                conn.execute(update, [{'_com_id': com_id, '_path': path}
+                                      for com_id, path in paths.items()])
+        updated += len(paths)
+        print('Filled in paths of %d of %d submissions' %
+              (min(i + batch_size, len(sub_ids)), len(sub_ids)))
+    return updated
+
+
+class ThreadArrays(object):
+    """The comment forest as flat arrays, in pre-order, for in-memory
+    thread queries and for export to analysis code.
+
+    Comment i's subtree is the slice [i, end[i]) (nested-set numbering),
+    parent[i] is the index of its nearest stored ancestor or -1, and the
+    comments of submission sub_ids[s] are [sub_start[s], sub_start[s + 1]).
+    Built from the path index, so rebuild it after crawling to take in
+    new comments; save() and load() keep it in one .npz file.
+    """
+
+    FIELDS = ('ids', 'sub', 'parent', 'end', 'depth', 'sub_ids', 'sub_start', 'by_id')
+
+    def __init__(self, ids, sub, parent, end, depth, sub_ids, sub_start, by_id=None):
+        self.ids = ids
+        self.sub = sub
+        self.parent = parent
+        self.end = end
+        self.depth = depth
+        self.sub_ids = sub_ids
+        self.sub_start = sub_start
+        self.by_id = np.argsort(ids, kind='mergesort') if by_id is None else by_id
+
+    def __len__(self):
+        return len(self.ids)
+
+    # Input: engine, optionally submission IDs to take (default: all)
+    @classmethod
+    def build(cls, engine, sub_ids=None):
+        comments = commentDB.Comment.__table__
+        query = select([comments.c.sub_id, comments.c.com_id, comments.c.parent_id,
+                        comments.c.path]). \
+                where(comments.c.path != None). \
+                order_by(comments.c.sub_id, comments.c.path, comments.c.depth)
+        if sub_ids is not None:
+            query = query.where(comments.c.sub_id.in_(sub_ids))
+
+        arrays = ([], [], [], [], [])       # ids, sub, parent, end, depth
+        subs, sub_start = [], []
+        thread = []
+        conn = engine.connect().execution_options(stream_results=True)
+        try:
+            for row in conn.execute(query):
+                if thread and row[0] != thread[0][0]:
+                    cls._add_thread(thread, arrays, subs, sub_start)
+                    thread = []
+                thread.append(row)
+            if thread:
+                cls._add_thread(thread, arrays, subs, sub_start)
+        finally:
+            conn.close()
+        ids, sub, parent, end, depth = arrays
+        sub_start.append(len(ids))
+
+        return cls(np.array(ids, dtype=bytes), np.array(sub, dtype=np.int32),
+                   np.array(parent, dtype=np.int32), np.array(end, dtype=np.int32),
+                   np.array(depth, dtype=np.int32),
+                   np.array([s.encode('ascii') for s in subs], dtype=bytes),
+                   np.array(sub_start, dtype=np.int32))
+
+    # Appends one submission's comments, given as (sub_id, com_id,
+    # parent_id, path) rows in path order, in pre-order. A comment whose
+    # parent is not stored hangs from its nearest stored ancestor on its
+    # path, if any.
+    @staticmethod
+    def _add_thread(rows, arrays, subs, sub_start):
+        ids, sub, parent, end, depth = arrays
+        index = dict((row[1], k) for k, row in enumerate(rows))
+        children = [[] for _ in rows]
+        roots = []
+        for k, (_, com_id, parent_id, path) in enumerate(rows):
+            p = index.get(parent_id)
+            if p is None:
+                for segment in reversed(path.split(PATH_SEP)[:-1]):
+                    p = index.get('t1_' + segment)
+                    if p is not None and p != k:
+                        break
+                    p = None
+            (children[p] if p is not None else roots).append(k)
+
+        first = len(ids)
+        subs.append(rows[0][0])
+        sub_start.append(first)
+        order = []
+        stack = [(k, -1, 1) for k in reversed(roots)]
+        while stack:
+            k, p, d = stack.pop()
+            ids.append(rows[k][1].encode('ascii'))
+            sub.append(len(subs) - 1)
+            parent.append(p)
+            depth.append(d)
+            end.append(0)
+            order.append(len(ids) - 1)
+            stack.extend((c, len(ids) - 1, d + 1) for c in reversed(children[k]))
+        size = dict((i, 1) for i in order)
+        for i in reversed(order):
+            end[i] = i + size[i]
+            if parent[i] >= 0:
+                size[parent[i]] += size[i]
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(*[data[f] for f in cls.FIELDS])
+
+    def save(self, filename):
+        np.savez(filename, **dict((f, getattr(self, f)) for f in self.FIELDS))
+
+    # Output: index of the comment, or -1 if it is not in the arrays
+    def find(self, com_id):
+        key = com_id.encode('ascii')
+        i = np.searchsorted(self.ids, key, sorter=self.by_id)
+        if i < len(self.ids) and self.ids[self.by_id[i]] == key:
+            return int(self.by_id[i])
+        return -1
+
+    def _index(self, com_id):
+        i = self.find(com_id)
+        if i < 0:
+            raise KeyError(com_id)
+        return i
+
+    def _names(self, indexes):
+        return [self.ids[i].decode('ascii') for i in indexes]
+
+    # Output: indexes of the immediate children of comment i, or of the
+    #         top-level comments of submission `s` if i is -1
+    def children(self, i, s=None):
+        if i < 0:
+            j, stop = self.sub_start[s], self.sub_start[s + 1]
+        else:
+            j, stop = i + 1, self.end[i]
+        found = []
+        while j < stop:
+            found.append(j)
+            j = self.end[j]
+        return found
+
+    # Output: comment IDs of the subtree, in pre-order
+    def subtree(self, com_id, include_self=True):
+        i = self._index(com_id)
+        return self._names(range(i if include_self else i + 1, self.end[i]))
+
+    # Output: comment IDs of the stored ancestors, top-level comment first
+    def ancestors(self, com_id):
+        found = []
+        i = self.parent[self._index(com_id)]
+        while i >= 0:
+            found.append(i)
+            i = self.parent[i]
+        return self._names(reversed(found))
+
+    def siblings(self, com_id):
+        i = self._index(com_id)
+        return self._names(j for j in self.children(self.parent[i], self.sub[i])
+                           if j != i)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Fill in comment paths, export the thread '
+                                        'arrays, or show the thread around a comment')
+    parser.add_argument('-d', '--dbfile', type=str, default='redditDB.sqlite',
+                        help="SQLite database file of comments.")
+    parser.add_argument('--arrays', type=str,
+                        help="Write the thread arrays to this .npz file.")
+    parser.add_argument('--show', type=str, metavar='COM_ID',
+                        help="Print the ancestors, siblings and replies of a comment.")
+    parser.add_argument('--batch-size', dest='batch_size', type=int,
+                        default=SUBMISSION_BATCH,
+                        help="Submissions filled in per transaction.")
+    parser.add_argument('--fast-sqlite', dest='fast_sqlite', action='store_true',
+                        help="Use the SQLite performance profile (WAL, relaxed fsync, mmap).")
+    args = parser.parse_args()
+
+    engine = commentDB.make_engine(args.dbfile, performance=args.fast_sqlite)
+    commentDB.upgrade_schema(engine)
+    start = time()
+    n = refresh(engine, batch_size=args.batch_size)
+    print('Filled in %d paths in %.2fs' % (n, time() - start))
+
+    if args.arrays:
+        start = time()
+        arrays = ThreadArrays.build(engine)
+        arrays.save(args.arrays)
+        print('Wrote %d comments of %d submissions to %s in %.2fs' %
+              (len(arrays), len(arrays.sub_ids), args.arrays, time() - start))
+
+    if args.show:
+        from sqlalchemy.orm import sessionmaker
+        session = sessionmaker(bind=engine)()
+        comment = session.query(commentDB.Comment).get(args.show)
+        if comment is None:
+            parser.error('no comment %s in %s' % (args.show, args.dbfile))
+        start = time()
+        chain = ancestors(session, comment).all()
+        others = siblings(session, comment).all()
+        below = subtree(session, comment, include_self=False).all()
+        elapsed = time() - start
+        for d, c in enumerate(chain + [comment]):
+            print('%s%s %s' % ('  ' * min(d, 20), c.com_id,
+                               (c.text or '')[:60].replace('\n', ' ')))
+        print('%d ancestors, %d siblings, %d replies below in %.1f ms' %
+              (len(chain), len(others), len(below), 1000 * elapsed))
@@ -0,0 +1,133 @@
+##
+# Social Web Comment Ranking
+#
+# Iterative comment tree traversal
+##
+
+from collections import namedtuple
+
+# rank:         position among sibling comments, in 'best' order
+# depth:        distance from the submission; top-level comments are 1
+# num_replies:  number of immediate replies
+# convo_depth:  height of the subtree rooted here; a leaf is 1
+# subtree_size: number of comments in the subtree, including this one
+# path:         materialized path, see extend_path
+TreeMetrics = namedtuple('TreeMetrics',
+                         'rank depth num_replies convo_depth subtree_size path')
+
+# Ends each segment of a materialized path. It sorts before every
+# character of a reddit ID, so a comment's descendants sort right after
+# it and before its next sibling.
+PATH_SEP = '/'
+
+# Segments a path holds at most. Paths repeat every ancestor's ID, so
+# uncapped they would take O(comments x depth) space: a 5000-deep thread
+# would store paths of ~40k characters.
+MAX_PATH_DEPTH = 32
+
+
+# Input: comment fullname, e.g. t1_c0ffee
+# Output: its segment of the materialized paths below it, e.g. c0ffee/
+def path_segment(fullname):
+    return fullname.split('_', 1)[-1] + PATH_SEP
+
+
+# Input: path of a comment's parent ('' for top-level comments), the
+#        comment's fullname
+# Output: the comment's path: the segments of its ancestors, root first,
+#         then its own. Comments more than MAX_PATH_DEPTH deep take the
+#         path of their ancestor at that depth, so they still fall in the
+#         path range of every ancestor down to it.
+def extend_path(path, fullname):
+    if path.count(PATH_SEP) >= MAX_PATH_DEPTH:
+        return path
+    return path + path_segment(fullname)
+
+
+class _Frame(object):
+    __slots__ = ('node', 'rank', 'depth', 'children', 'path', 'next',
+                 'replies', 'height', 'size')
+
+    def __init__(self, node, rank, depth, children, path):
+        self.node = node
+        self.rank = rank
+        self.depth = depth
+        self.children = children
+        self.path = path
+        self.next = 0       # index of next child to visit
+        self.replies = 0    # comment children seen so far
+        self.height = 0     # max convo_depth over children
+        self.size = 1
+
+
+# Input: top-level comments (e.g. submission.comments), and optionally a
+#        predicate to skip non-comment nodes such as MoreComments stubs
+# Output: generator of (comment, TreeMetrics) for every comment in the
+#         forest, children before their parents (post-order)
+#
+# Uses an explicit stack, so very deep threads cannot overflow the
+# interpreter stack, and visits each node once.
+def walk_comment_tree(roots, is_comment=None):
+    top = _Frame(None, 0, 0, list(roots), '')
+    stack = [top]
+    while stack:
+        frame = stack[-1]
+        if frame.next < len(frame.children):
+            child = frame.children[frame.next]
+            frame.next += 1
+            if is_comment is not None and not is_comment(child):
+                continue
+            frame.replies += 1
+            stack.append(_Frame(child, frame.replies, frame.depth + 1,
+                                child.replies,
+                                extend_path(frame.path, child.fullname)))
+            continue
+
+        stack.pop()
+        if frame is top:
+            break
+        parent = stack[-1]
+        convo_depth = frame.height + 1
+        if convo_depth > parent.height:
+            parent.height = convo_depth
+        parent.size += frame.size
+        yield frame.node, TreeMetrics(frame.rank, frame.depth, frame.replies,
+                                      convo_depth, frame.size, frame.path)
+
+
+# Input: parent index of each node (-1 for roots, or nodes whose parent
+#        is not in the set), with every parent index valid
+# Output: arrays num_replies, convo_depth and subtree_size, as in
+#         TreeMetrics
+#
+# For trees known only as (id, parent) rows, e.g. comments streamed to the
+# database before the whole thread was seen. Processes one depth level at
+# a time, deepest first, so each level is a few vectorized operations.
+def subtree_metrics(parent):
+    import numpy as np
+    parent = np.asarray(parent, dtype=np.int64)
+    n = len(parent)
+    has_parent = parent >= 0
+
+    # Depth by pointer jumping: O(log depth) vectorized passes
+    depth = np.where(has_parent, 1, 0).astype(np.int64)
+    anc = np.where(has_parent, parent, np.arange(n))
+    while True:
+        step = depth[anc]       # roots are their own ancestor, at depth 0
+        if not step.any():
+            break
+        depth = depth + step
+        anc = anc[anc]
+
+    num_replies = np.bincount(parent[has_parent], minlength=n).astype(np.int64)
+    convo_depth = np.ones(n, dtype=np.int64)
+    subtree_size = np.ones(n, dtype=np.int64)
+    order = np.argsort(-depth, kind='mergesort')
+    levels = np.split(order, np.flatnonzero(np.diff(depth[order])) + 1)
+    for level in levels:
+        level = level[has_parent[level]]
+        if len(level) == 0:
+            continue
+        np.add.at(subtree_size, parent[level], subtree_size[level])
+        np.maximum.at(convo_depth, parent[level], convo_depth[level] + 1)
+    return num_replies, convo_depth, subtree_size